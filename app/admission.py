@@ -0,0 +1,198 @@
+"""
+Filename: admission.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Admission control for the enrollment routes, per-family rate limits, a cap on concurrent
+             enrollment requests and a FIFO waiting room for registration opening
+
+Configured from the environment:
+    ADMISSION_ENABLED           0 turns every check off (1)
+    ADMISSION_FAMILY_RATE       enrollment requests per second one family may sustain (5)
+    ADMISSION_FAMILY_BURST      requests a family may make at once before the rate applies (20)
+    ADMISSION_MAX_CONCURRENT    enrollment requests handled at once, keep under the pool size plus overflow (25)
+    ADMISSION_SLOT_TIMEOUT      seconds a request waits for a free slot before 503 (5)
+    WAITING_ROOM_RATE           families let in per second while the waiting room is open (10)
+    WAITING_ROOM_BURST          families let in as soon as the waiting room opens (50)
+"""
+
+import asyncio
+import math
+import os
+import time
+from abc import ABC, abstractmethod
+from fastapi import Depends, HTTPException, status
+from .cache import TTLCache
+from .metrics import Counter, Gauge, collector
+from .routers.auth import get_current_family
+
+admission_decisions = Counter("admission_decisions_total", "Enrollment requests by admission outcome", ("outcome",))
+
+
+class AdmissionBackend(ABC):
+    """
+    Where admission state lives. The in-memory backend below serves a single node; running more than
+    one node needs a shared implementation (Redis or the database) of these same methods, set with
+    set_backend() at startup.
+    """
+
+    @abstractmethod
+    async def take_token(self, family_id: int) -> float:
+        """Spends one of the family's tokens, returns 0 or the seconds until one is available"""
+        ...
+
+    @abstractmethod
+    async def acquire_slot(self, timeout: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def release_slot(self):
+        ...
+
+    @abstractmethod
+    async def open_waiting_room(self, rate: float, burst: int):
+        ...
+
+    @abstractmethod
+    async def close_waiting_room(self):
+        ...
+
+    @abstractmethod
+    async def queue_position(self, family_id: int):
+        """
+        None while the waiting room is closed, else (place in line, seconds until admitted),
+        (0, 0) once the family is admitted
+        """
+        ...
+
+    @abstractmethod
+    async def status(self) -> dict:
+        ...
+
+
+class InMemoryAdmissionBackend(AdmissionBackend):
+    def __init__(self, family_rate: float, family_burst: int, max_concurrent: int):
+        self.family_rate = family_rate
+        self.family_burst = family_burst
+        self.max_concurrent = max_concurrent
+        # idle families fall out once their bucket would be full again anyway
+        self._buckets = TTLCache(maxsize = 100000, ttl = max(60.0, family_burst / family_rate))
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._in_use = 0
+        self._room = None
+
+    async def take_token(self, family_id: int) -> float:
+        now = time.monotonic()
+        tokens, last = self._buckets.get(family_id, (float(self.family_burst), now))
+        tokens = min(float(self.family_burst), tokens + (now - last) * self.family_rate)
+        if tokens < 1:
+            self._buckets.set(family_id, (tokens, now))
+            return (1 - tokens) / self.family_rate
+        self._buckets.set(family_id, (tokens - 1, now))
+        return 0.0
+
+    async def acquire_slot(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._in_use += 1
+        return True
+
+    async def release_slot(self):
+        self._in_use -= 1
+        self._slots.release()
+
+    async def open_waiting_room(self, rate: float, burst: int):
+        # tickets are handed out in arrival order, ticket n is admitted once burst + rate * elapsed reaches it
+        self._room = {"opened": time.monotonic(), "rate": rate, "burst": burst, "tickets": {}}
+
+    async def close_waiting_room(self):
+        self._room = None
+
+    def _admitted_upto(self) -> float:
+        room = self._room
+        return room["burst"] + (time.monotonic() - room["opened"]) * room["rate"]
+
+    async def queue_position(self, family_id: int):
+        room = self._room
+        if room is None:
+            return None
+        ticket = room["tickets"].get(family_id)
+        if ticket is None:
+            ticket = room["tickets"][family_id] = len(room["tickets"]) + 1
+        position = max(0, math.ceil(ticket - self._admitted_upto()))
+        return position, math.ceil(position / room["rate"]) if position else 0
+
+    async def status(self) -> dict:
+        room = self._room
+        waiting_room = None
+        if room is not None:
+            admitted = min(len(room["tickets"]), int(self._admitted_upto()))
+            waiting_room = {"tickets": len(room["tickets"]), "admitted": admitted,
+                            "waiting": len(room["tickets"]) - admitted, "rate": room["rate"]}
+        return {"in_use": self._in_use, "max_concurrent": self.max_concurrent, "waiting_room": waiting_room}
+
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+SLOT_TIMEOUT = float(os.environ.get('ADMISSION_SLOT_TIMEOUT', '5'))
+WAITING_ROOM_RATE = float(os.environ.get('WAITING_ROOM_RATE', '10'))
+WAITING_ROOM_BURST = int(os.environ.get('WAITING_ROOM_BURST', '50'))
+
+admission_backend = InMemoryAdmissionBackend(
+    family_rate = float(os.environ.get('ADMISSION_FAMILY_RATE', '5')),
+    family_burst = int(os.environ.get('ADMISSION_FAMILY_BURST', '20')),
+    max_concurrent = int(os.environ.get('ADMISSION_MAX_CONCURRENT', '25')),
+)
+
+
+def set_backend(backend: AdmissionBackend):
+    global admission_backend
+    admission_backend = backend
+
+
+@collector
+def admission_metrics():
+    lines = admission_decisions.render()
+    if isinstance(admission_backend, InMemoryAdmissionBackend):
+        gauge = Gauge("admission_slots_in_use", "Enrollment requests being handled")
+        gauge.set(value = admission_backend._in_use)
+        lines += gauge.render()
+    return lines
+
+
+async def admit(family: dict = Depends(get_current_family)):
+    """
+    Dependency for the enrollment routes. In order: the family's token bucket (429), its place in
+    the waiting room when one is open (503 with queue_position), then a slot under the global
+    concurrency cap, held until the request is done (503 after ADMISSION_SLOT_TIMEOUT).
+    """
+    if not ADMISSION_ENABLED:
+        yield
+        return
+    backend = admission_backend
+
+    retry_after = await backend.take_token(family.get('family_id'))
+    if retry_after:
+        admission_decisions.inc("throttled")
+        raise HTTPException(status_code = status.HTTP_429_TOO_MANY_REQUESTS, detail = "Too many requests",
+                            headers = {"Retry-After": str(math.ceil(retry_after))})
+
+    queue = await backend.queue_position(family.get('family_id'))
+    if queue is not None and queue[0]:
+        admission_decisions.inc("queued")
+        position, wait = queue
+        raise HTTPException(status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail = {"message": "Registration is busy, you are in line", "queue_position": position,
+                                      "retry_after": wait},
+                            headers = {"Retry-After": str(wait)})
+
+    if not await backend.acquire_slot(SLOT_TIMEOUT):
+        admission_decisions.inc("overloaded")
+        raise HTTPException(status_code = status.HTTP_503_SERVICE_UNAVAILABLE, detail = "Registration is busy, try again",
+                            headers = {"Retry-After": "1"})
+    admission_decisions.inc("admitted")
+    try:
+        yield
+    finally:
+        await backend.release_slot()
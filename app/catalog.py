@@ -0,0 +1,124 @@
+"""
+Filename: catalog.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: In-process cache of the CurrentClasses catalog, keyed by year and category list
+
+Every worker keeps its own copy. An admin write bumps the catalog's row in cache_version, and each
+worker compares that row with the version it built from at most every CATALOG_VERSION_TTL seconds,
+so a change reaches all workers within that time.
+
+Configured from the environment:
+    CATALOG_VERSION_TTL     seconds between checks of the shared catalog version (5)
+"""
+
+import asyncio
+import os
+import time
+from sqlalchemy import select, case
+from sqlalchemy.ext.asyncio import AsyncSession
+from .database import upsert
+from .models import CacheVersion, CurrentClasses
+from .serializers import compile_serializer
+from .etag import make_etag
+
+serialize_class = compile_serializer(CurrentClasses)
+
+CATALOG_VERSION_TTL = float(os.environ.get('CATALOG_VERSION_TTL', '5'))
+
+
+class CatalogCache:
+    """
+    Holds each catalog listing already sorted by category order and weight. The catalog only
+    changes a few times a season, so entries live until the shared version moves (bump()) or
+    invalidate() drops this worker's listings.
+    """
+
+    def __init__(self, name: str = "catalog", version_ttl: float = None):
+        self.name = name
+        self.version_ttl = CATALOG_VERSION_TTL if version_ttl is None else version_ttl
+        self.version = 0
+        self.shared_version = None
+        self._next_check = 0.0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._etags = {}
+        self._lock = asyncio.Lock()
+
+    def invalidate(self) -> int:
+        self.version += 1
+        self._entries = {}
+        self._etags = {}
+        return self.version
+
+    async def bump(self, db: AsyncSession) -> int:
+        """Invalidates the catalog in every worker, commits, returns the new shared version"""
+        await db.execute(upsert(db, CacheVersion, {"name": self.name, "version": 1},
+                                {"version": CacheVersion.version + 1}, ["name"]))
+        await db.commit()
+        self.shared_version = await db.scalar(select(CacheVersion.version).filter(CacheVersion.name == self.name))
+        self.invalidate()
+        return self.shared_version
+
+    async def _check_version(self, db: AsyncSession):
+        # set first, so concurrent requests do not all run the check
+        self._next_check = time.monotonic() + self.version_ttl
+        shared = await db.scalar(select(CacheVersion.version).filter(CacheVersion.name == self.name))
+        if shared != self.shared_version:
+            self.shared_version = shared
+            self.invalidate()
+
+    def etag(self, year: int, category_order: list, entry: tuple) -> str:
+        """Content hash of a listing returned by get(), computed once per cached listing"""
+        key = (year, tuple(category_order))
+        etag = self._etags.get(key)
+        if etag is None or self._entries.get(key) is not entry:
+            etag = make_etag(entry)
+            if self._entries.get(key) is entry:
+                self._etags[key] = etag
+        return etag
+
+    async def get(self, db: AsyncSession, year: int, category_order: list) -> tuple:
+        if time.monotonic() >= self._next_check:
+            await self._check_version(db)
+        key = (year, tuple(category_order))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        async with self._lock:
+            # another request may have built it while we waited
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            version = self.version
+            entry = await self._build(db, category_order)
+            if version == self.version:
+                self._entries[key] = entry
+            return entry
+
+    @staticmethod
+    async def _build(db: AsyncSession, category_order: list) -> tuple:
+        category_rank = case(
+            {cat: i for i, cat in enumerate(category_order)},
+            value=CurrentClasses.category,
+            else_=len(category_order)
+        )
+
+        class_query = (
+            select(CurrentClasses)
+            .filter(CurrentClasses.category.in_(category_order))
+            .order_by(category_rank, CurrentClasses.weight)
+        )
+
+        results = (await db.execute(class_query)).scalars().all()
+
+        return tuple(serialize_class(class_obj) for class_obj in results)
+
+
+catalog_cache = CatalogCache()
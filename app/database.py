@@ -2,22 +2,76 @@
 Filename: database.py
 Author: Meghan Dang
 Date: 2025-01-16
-Version: 1.0
-Description: Establishes connection to database
+Version: 1.2
+Description: Establishes connection to database, and to an optional read replica
+
+Configured from the environment:
+    DATABASE_URL            primary database
+    DATABASE_REPLICA_URL    read replica for read-only handlers, defaults to the primary
+    DB_POOL_SIZE            connections kept open per engine (10)
+    DB_MAX_OVERFLOW         extra connections allowed under burst load (20)
+    DB_POOL_TIMEOUT         seconds to wait for a free connection before failing (10)
+    DB_POOL_RECYCLE         seconds before a connection is replaced, below MySQL wait_timeout (1800)
+    DB_POOL_PRE_PING        1 to test connections on checkout (1)
+    DB_CONNECT_TIMEOUT      seconds to wait when opening a new connection (5)
 """
 
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.dialects import mysql, sqlite
 
 if os.environ.get('TESTING') == '1':
-    DATABASE_URL = 'sqlite:///./test.db' 
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite+aiosqlite:///./test.db')
 else:
-    DATABASE_URL = 'mysql+pymysql://test' # connect database
-    engine = create_engine(DATABASE_URL)
+    DATABASE_URL = os.environ.get('DATABASE_URL', 'mysql+aiomysql://test') # connect database
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+
+
+def create_engine_from_env(url: str, env = os.environ):
+    """Async engine for url with pool settings read from env"""
+    connect_timeout = int(env.get('DB_CONNECT_TIMEOUT', '5'))
+    if url.startswith('sqlite'):
+        connect_args = {"check_same_thread": False, "timeout": connect_timeout}
+    else:
+        connect_args = {"connect_timeout": connect_timeout}
+
+    return create_async_engine(
+        url,
+        connect_args = connect_args,
+        pool_size = int(env.get('DB_POOL_SIZE', '10')),
+        max_overflow = int(env.get('DB_MAX_OVERFLOW', '20')),
+        pool_timeout = float(env.get('DB_POOL_TIMEOUT', '10')),
+        pool_recycle = int(env.get('DB_POOL_RECYCLE', '1800')),
+        pool_pre_ping = env.get('DB_POOL_PRE_PING', '1') == '1',
+    )
+
+
+def create_sessionmaker(bind):
+    # expire_on_commit is off so that objects returned from a handler after commit
+    # can still be serialized without lazy loading outside of the event loop
+    return async_sessionmaker(bind = bind, class_ = AsyncSession, autoflush = False, expire_on_commit = False)
 
-SessionLocal = sessionmaker(autocommit = False, autoflush = False, bind = engine)
+
+engine = create_engine_from_env(DATABASE_URL)
+SessionLocal = create_sessionmaker(engine)
+
+# Replica reads may lag the primary, only handlers that never read their own writes use it
+read_engine = create_engine_from_env(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL else engine
+ReadSessionLocal = create_sessionmaker(read_engine)
 
 Base = declarative_base()
+
+
+def insert_ignore(db: AsyncSession, model):
+    """INSERT that silently skips rows colliding with a primary or unique key, for the bound dialect"""
+    if db.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return mysql.insert(model).prefix_with('IGNORE')
+
+
+def upsert(db: AsyncSession, model, values: dict, update: dict, index_elements: list):
+    """INSERT of one row that updates the update columns instead when it collides with the unique index_elements"""
+    if db.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert(model).values(**values).on_conflict_do_update(index_elements = index_elements, set_ = update)
+    return mysql.insert(model).values(**values).on_duplicate_key_update(**update)
@@ -0,0 +1,164 @@
+"""
+Filename: encoding.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Response content negotiation, MessagePack selection and brotli/gzip compression
+
+Configured from the environment:
+    COMPRESSION_MIN_SIZE    responses smaller than this many bytes are sent uncompressed (1024)
+    GZIP_LEVEL              zlib level, 1 fastest to 9 smallest (6)
+    BROTLI_QUALITY          brotli quality, 0 fastest to 11 smallest (4)
+"""
+
+import os
+import time
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from .serializers import accepts_msgpack, use_msgpack
+from .metrics import Counter, Histogram, collector
+
+try:
+    import brotli
+except ImportError:     # optional, gzip only without it
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '4'))
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# each event is a few bytes pushed to many connections, a compressor per connection costs more than it saves
+UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+compression_time = Histogram("http_response_compression_seconds", "Time spent compressing response bodies", ("encoding",),
+                             buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+response_bytes = Counter("http_response_bytes_total", "Response body bytes before and after compression", ("encoding", "stage"))
+compression_skipped = Counter("http_response_compression_skipped_total", "Responses sent uncompressed", ("reason",))
+
+
+@collector
+def compression_metrics():
+    return compression_time.render() + response_bytes.render() + compression_skipped.render()
+
+
+def choose_encoding(accept_encoding: str):
+    """br or gzip, whichever the client ranks higher (br on a tie), None for identity"""
+    ranks = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        name, _, value = params.strip().partition("=")
+        if name == "q":
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0.0
+        ranks[coding.strip().lower()] = q
+
+    wildcard = ranks.get("*", 0.0)
+    candidates = [("gzip", ranks.get("gzip", wildcard))]
+    if brotli is not None:
+        candidates.insert(0, ("br", ranks.get("br", wildcard)))
+    encoding, q = max(candidates, key = lambda candidate: candidate[1])
+    return encoding if q > 0 else None
+
+
+class Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality = BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.elapsed = 0.0
+
+    def compress(self, data: bytes, more: bool) -> bytes:
+        start = time.perf_counter()
+        if self.encoding == "br":
+            out = self._compressor.process(data) + (self._compressor.flush() if more else self._compressor.finish())
+        else:
+            out = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH if more else zlib.Z_FINISH)
+        self.elapsed += time.perf_counter() - start
+        response_bytes.inc(self.encoding, "identity", amount = len(data))
+        response_bytes.inc(self.encoding, "compressed", amount = len(out))
+        if not more:
+            compression_time.observe(self.elapsed, self.encoding)
+        return out
+
+
+class EncodingMiddleware:
+    """
+    Plain ASGI middleware. Picks MessagePack over JSON from the Accept header for FastJSONResponse,
+    then compresses the body with the best encoding from Accept-Encoding. Whole bodies under
+    COMPRESSION_MIN_SIZE go out as they are, the framing overhead and CPU would outweigh the savings.
+    Streamed bodies (the admin exports) are compressed chunk by chunk.
+    """
+
+    def __init__(self, app, minimum_size: int = None):
+        self.app = app
+        self.minimum_size = COMPRESSION_MIN_SIZE if minimum_size is None else minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_headers = Headers(scope = scope)
+        token = use_msgpack.set(accepts_msgpack(request_headers.get("accept", "")))
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""))
+        try:
+            if encoding is None:
+                return await self.app(scope, receive, send)
+            await self.app(scope, receive, CompressingSender(send, encoding, self.minimum_size))
+        finally:
+            use_msgpack.reset(token)
+
+
+class CompressingSender:
+    def __init__(self, send, encoding: str, minimum_size: int):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw = message["headers"])
+            content_type = headers.get("content-type", "")
+            if ("content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_TYPES)
+                    or content_type.startswith(UNCOMPRESSED_TYPES)):
+                self.passthrough = True
+                compression_skipped.inc("type")
+                return await self.send(message)
+            self.start_message = message
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            return await self.send(message)
+
+        body = message.get("body", b"")
+        more = message.get("more_body", False)
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw = start["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            if not more and len(body) < self.minimum_size:
+                self.passthrough = True
+                compression_skipped.inc("small")
+                await self.send(start)
+                return await self.send(message)
+
+            self.compressor = Compressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            body = self.compressor.compress(body, more)
+            if more:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(body))
+            await self.send(start)
+            return await self.send({"type": "http.response.body", "body": body, "more_body": more})
+
+        await self.send({"type": "http.response.body", "body": self.compressor.compress(body, more), "more_body": more})
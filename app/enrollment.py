@@ -0,0 +1,342 @@
+"""
+Filename: enrollment.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Seat reservation against Classes.seats_x, used when students select classes,
+             promotion of waitlisted selections when seats open up, and expiry of unpaid holds
+
+A seated, unpaid selection holds its seat until StudentClass.removed, set to the selection (or
+promotion) time plus the hold window. Waitlisted selections hold no seat and keep removed equal to
+created until they are promoted. Rows written before holds existed also have removed equal to
+created; their hold is taken to end at created plus the window. Expired holds are deleted by
+expire_holds(), run every HOLD_SWEEP_INTERVAL seconds in the app when HOLD_SWEEP=1, or from cron
+with the CLI.
+
+Configured from the environment:
+    HOLD_WINDOW_MINUTES     minutes an unpaid seat is held (2880)
+    HOLD_SWEEP_INTERVAL     seconds between sweeps in the app (60)
+    HOLD_SWEEP_BATCH        expired holds released per transaction (500)
+
+Seat counters (class_seats) are only kept up to date by the app. Selections deleted or capacity
+edited straight in the database leave them wrong until reconcile_seats() recounts them, which the
+promote command does before promoting.
+
+Usage: python -m app.enrollment promote|expire|reconcile [--year 2026]
+"""
+
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func, case, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from .database import SessionLocal, insert_ignore
+from .metrics import Counter, Gauge, collector
+from .models import Classes, ClassSeats, StudentClass
+from .seats import seats_changed
+
+logger = logging.getLogger(__name__)
+
+HOLD_WINDOW = timedelta(minutes = float(os.environ.get('HOLD_WINDOW_MINUTES', '2880')))
+HOLD_SWEEP_INTERVAL = float(os.environ.get('HOLD_SWEEP_INTERVAL', '60'))
+HOLD_SWEEP_BATCH = int(os.environ.get('HOLD_SWEEP_BATCH', '500'))
+
+waitlist_promotions = Counter("waitlist_promotions_total", "Waitlisted selections given a seat")
+holds_expired = Counter("holds_expired_total", "Unpaid selections whose hold ran out")
+hold_sweep_batches = Counter("hold_sweep_batches_total", "Transactions committed by the hold sweeper")
+hold_sweep_lag = Gauge("hold_sweep_lag_seconds", "Age of the oldest expired hold at the start of the last sweep")
+hold_sweep_duration = Gauge("hold_sweep_duration_seconds", "Time the last sweep took")
+
+
+@collector
+def enrollment_metrics():
+    lines = []
+    for metric in (waitlist_promotions, holds_expired, hold_sweep_batches, hold_sweep_lag, hold_sweep_duration):
+        lines += metric.render()
+    return lines
+
+
+def hold_deadline(now: datetime) -> datetime:
+    """StudentClass.removed for a selection seated at now"""
+    return now + HOLD_WINDOW
+
+
+async def _create_seat_counter(db: AsyncSession, year: int, class_id: int) -> bool:
+    # First selection of a class this year, seed its counter from the catalog capacity
+    # and the seats already held. Concurrent first selections race on the primary key
+    # and all but one insert are ignored. Returns False for classes with no catalog row.
+    seats_x = await db.scalar(select(Classes.seats_x).filter(Classes.class_id == class_id))
+    if seats_x is None:
+        return False
+
+    taken = await db.scalar(
+        select(func.count(StudentClass.sc_id))
+        .filter(StudentClass.year == year)
+        .filter(StudentClass.class_id == class_id)
+        .filter(StudentClass.wait == 0)
+    )
+    await db.execute(insert_ignore(db, ClassSeats).values(year=year, class_id=class_id, seats_x=seats_x, taken=taken))
+    return True
+
+
+async def reserve_seat(db: AsyncSession, year: int, class_id: int) -> bool:
+    """
+    Atomically takes one seat in a class. Returns True if a seat was reserved and False
+    if the class is full and the selection belongs on the waitlist.
+
+    The seat is taken with a single conditional UPDATE on the class's counter row, so only
+    that one row is locked until the caller commits. Classes with no catalog row have no
+    capacity to enforce and always get a seat.
+    """
+    reserve = (
+        update(ClassSeats)
+        .filter(ClassSeats.year == year)
+        .filter(ClassSeats.class_id == class_id)
+        .filter(ClassSeats.taken < ClassSeats.seats_x)
+        .values(taken = ClassSeats.taken + 1)
+        .execution_options(synchronize_session = False)
+    )
+
+    if (await db.execute(reserve)).rowcount == 1:
+        seats_changed(db, year, [class_id])
+        return True
+
+    taken = await db.scalar(
+        select(ClassSeats.taken).filter(ClassSeats.year == year, ClassSeats.class_id == class_id)
+    )
+    if taken is not None:
+        return False
+
+    if not await _create_seat_counter(db, year, class_id):
+        return True
+    seats_changed(db, year, [class_id])
+    return (await db.execute(reserve)).rowcount == 1
+
+
+async def release_seats(db: AsyncSession, year: int, released: dict):
+    """
+    Gives back the seats held by removed selections in one UPDATE. released maps class_id
+    to the number of seats freed in that class.
+    """
+    if not released:
+        return
+
+    await db.execute(
+        update(ClassSeats)
+        .filter(ClassSeats.year == year)
+        .filter(ClassSeats.class_id.in_(released))
+        .values(taken = ClassSeats.taken - case(released, value = ClassSeats.class_id, else_ = 0))
+        .execution_options(synchronize_session = False)
+    )
+    seats_changed(db, year, released)
+
+
+async def promote_waitlist(db: AsyncSession, year: int, class_ids) -> dict:
+    """
+    Gives the open seats of each class to its waitlist, oldest selection first, and returns
+    class_id -> promoted sc_ids. Each class costs a locked read of its counter row, one indexed
+    read of at most as many waitlist rows as there are open seats (ix_student_class_waitlist),
+    and one UPDATE each for the promoted rows and the counter. Nothing is committed, the caller's
+    transaction covers the seats freed and the promotions together.
+    """
+    promoted = {}
+    # fixed lock order, two transactions promoting overlapping classes cannot deadlock
+    for class_id in sorted(set(class_ids)):
+        counter = (await db.execute(
+            select(ClassSeats.seats_x, ClassSeats.taken)
+            .filter(ClassSeats.year == year, ClassSeats.class_id == class_id)
+            .with_for_update()
+        )).first()
+        if counter is None or counter.taken >= counter.seats_x:
+            continue
+
+        sc_ids = (await db.scalars(
+            select(StudentClass.sc_id)
+            .filter(StudentClass.year == year)
+            .filter(StudentClass.class_id == class_id)
+            .filter(StudentClass.wait == 1)
+            .order_by(StudentClass.created, StudentClass.sc_id)
+            .limit(counter.seats_x - counter.taken)
+        )).all()
+        if not sc_ids:
+            continue
+
+        await db.execute(
+            update(StudentClass)
+            .filter(StudentClass.sc_id.in_(sc_ids))
+            .values(wait = 0, removed = hold_deadline(datetime.now()))
+            .execution_options(synchronize_session = False)
+        )
+        await db.execute(
+            update(ClassSeats)
+            .filter(ClassSeats.year == year, ClassSeats.class_id == class_id)
+            .values(taken = ClassSeats.taken + len(sc_ids))
+            .execution_options(synchronize_session = False)
+        )
+        promoted[class_id] = list(sc_ids)
+        seats_changed(db, year, [class_id])
+        waitlist_promotions.inc(amount = len(sc_ids))
+    return promoted
+
+
+async def set_capacity(db: AsyncSession, year: int, class_id: int, seats_x: int) -> list:
+    """Changes a class's capacity and promotes from its waitlist if seats were added, commits"""
+    await db.execute(update(Classes).filter(Classes.class_id == class_id).values(seats_x = seats_x))
+    await db.execute(
+        update(ClassSeats)
+        .filter(ClassSeats.year == year, ClassSeats.class_id == class_id)
+        .values(seats_x = seats_x)
+        .execution_options(synchronize_session = False)
+    )
+    seats_changed(db, year, [class_id])
+    promoted = await promote_waitlist(db, year, [class_id])
+    await db.commit()
+    return promoted.get(class_id, [])
+
+
+async def reconcile_seats(db: AsyncSession, year: int) -> list:
+    """
+    Recounts the year's seat counters from their sources: taken from the seated student_class
+    rows, seats_x from Classes. Returns the class_ids whose counter was wrong, commits.
+    """
+    taken = (
+        select(func.count(StudentClass.sc_id))
+        .filter(StudentClass.year == ClassSeats.year, StudentClass.class_id == ClassSeats.class_id,
+                StudentClass.wait == 0)
+        .scalar_subquery()
+    )
+    seats_x = func.coalesce(
+        select(Classes.seats_x).filter(Classes.class_id == ClassSeats.class_id).scalar_subquery(),
+        ClassSeats.seats_x,
+    )
+    stale = (await db.scalars(
+        select(ClassSeats.class_id)
+        .filter(ClassSeats.year == year, (ClassSeats.taken != taken) | (ClassSeats.seats_x != seats_x))
+    )).all()
+    if stale:
+        await db.execute(
+            update(ClassSeats)
+            .filter(ClassSeats.year == year, ClassSeats.class_id.in_(stale))
+            .values(taken = taken, seats_x = seats_x)
+            .execution_options(synchronize_session = False)
+        )
+        seats_changed(db, year, stale)
+    await db.commit()
+    return sorted(stale)
+
+
+async def promote_all(db: AsyncSession, year: int) -> dict:
+    """
+    Reconciles the seat counters, then promotes every class with a waitlist, one transaction
+    per class. For seats freed outside the app, such as orders cancelled by staff, and replaces
+    the overnight waitlist pass.
+    """
+    await reconcile_seats(db, year)
+    class_ids = (await db.scalars(
+        select(StudentClass.class_id).filter(StudentClass.year == year, StudentClass.wait == 1).distinct()
+    )).all()
+    promoted = {}
+    for class_id in sorted(class_ids):
+        promoted.update(await promote_waitlist(db, year, [class_id]))
+        await db.commit()
+    return promoted
+
+
+async def expire_holds(db: AsyncSession, year: int, now: datetime = None, batch_size: int = None) -> int:
+    """
+    Deletes seated, unpaid selections whose hold ended before now and returns how many.
+    Each batch of at most batch_size rows is one transaction: lock the oldest expired rows
+    (skipping rows a checkout has locked), delete them, give their seats back and promote
+    those seats' waitlists, then commit.
+    """
+    now = now or datetime.now()
+    batch_size = batch_size or HOLD_SWEEP_BATCH
+    started = time.perf_counter()
+    has_deadline = StudentClass.removed > StudentClass.created
+    expired = (
+        StudentClass.year == year,
+        StudentClass.paid == 0,
+        StudentClass.wait == 0,
+        StudentClass.removed <= now,
+        # rows without a deadline of their own (removed == created) get created plus the window
+        or_(has_deadline, StudentClass.created <= now - HOLD_WINDOW),
+    )
+
+    oldest_deadline, oldest_created = (await db.execute(
+        select(func.min(case((has_deadline, StudentClass.removed))),
+               func.min(case((~has_deadline, StudentClass.created))))
+        .filter(*expired)
+    )).one()
+    oldest = min(filter(None, (oldest_deadline, oldest_created and oldest_created + HOLD_WINDOW)), default = None)
+    hold_sweep_lag.set(value = (now - oldest).total_seconds() if oldest else 0.0)
+
+    total = 0
+    while True:
+        rows = (await db.execute(
+            select(StudentClass.sc_id, StudentClass.class_id)
+            .filter(*expired)
+            .order_by(StudentClass.removed, StudentClass.sc_id)
+            .limit(batch_size)
+            .with_for_update(skip_locked = True)
+        )).all()
+        if not rows:
+            await db.rollback()
+            break
+
+        await db.execute(delete(StudentClass).filter(StudentClass.sc_id.in_([row.sc_id for row in rows])))
+        freed = collections.Counter(row.class_id for row in rows)
+        await release_seats(db, year, freed)
+        await promote_waitlist(db, year, freed)
+        await db.commit()
+
+        total += len(rows)
+        holds_expired.inc(amount = len(rows))
+        hold_sweep_batches.inc()
+        if len(rows) < batch_size:
+            break
+
+    hold_sweep_duration.set(value = time.perf_counter() - started)
+    return total
+
+
+async def run_hold_sweeper(interval: float = None):
+    """Runs expire_holds for the current year every interval seconds until cancelled"""
+    interval = interval or HOLD_SWEEP_INTERVAL
+    while True:
+        try:
+            async with SessionLocal() as db:
+                await expire_holds(db, datetime.now().year)
+        except Exception:
+            logger.exception("hold sweep failed")
+        await asyncio.sleep(interval)
+
+
+async def _main(command: str, year: int) -> int:
+    async with SessionLocal() as db:
+        if command == "expire":
+            print(f"{await expire_holds(db, year)} expired holds released")
+            return 0
+        if command == "reconcile":
+            class_ids = await reconcile_seats(db, year)
+            for class_id in class_ids:
+                print(f"class {class_id}: seat counter recounted")
+            print(f"{len(class_ids)} seat counters recounted")
+            return 0
+        promoted = await promote_all(db, year)
+    for class_id, sc_ids in promoted.items():
+        print(f"class {class_id}: promoted {len(sc_ids)}")
+    print(f"{sum(len(sc_ids) for sc_ids in promoted.values())} selections promoted")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Promote waitlisted selections into open seats, release expired unpaid holds, or recount seat counters")
+    parser.add_argument("command", choices=["promote", "expire", "reconcile"])
+    parser.add_argument("--year", type=int, default=datetime.now().year)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args.command, args.year)))
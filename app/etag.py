@@ -0,0 +1,38 @@
+"""
+Filename: etag.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: ETags and 304 Not Modified responses for endpoints that are refreshed constantly
+"""
+
+import hashlib
+from fastapi import Request, Response
+
+# browsers keep the copy but ask again every time, private because every payload is per family
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """Weak ETag from version parts that change whenever the payload would, not from the payload"""
+    return 'W/"' + hashlib.blake2b(repr(parts).encode(), digest_size = 12).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # weak comparison, as If-None-Match requires
+    return etag.removeprefix("W/") in {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code = 304, headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
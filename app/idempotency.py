@@ -0,0 +1,155 @@
+"""
+Filename: idempotency.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Idempotency-Key support for write requests, so client retries do not repeat the write
+
+Configured from the environment:
+    IDEMPOTENCY_TTL         seconds a completed response is kept for replay (86400)
+    IDEMPOTENCY_MAX_KEYS    completed responses kept at most, least recently used dropped first (20000)
+    IDEMPOTENCY_MAX_BODY    largest request body in bytes a keyed request may carry, larger ones get 413 (1048576)
+"""
+
+import asyncio
+import hashlib
+import os
+from starlette.datastructures import Headers
+from .cache import TTLCache
+from .metrics import Counter, collector
+
+UNSAFE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+MAX_KEY_LENGTH = 255
+MAX_BODY = int(os.environ.get('IDEMPOTENCY_MAX_BODY', '1048576'))
+
+# completed responses by (caller, method, path, key)
+idempotency_store = TTLCache(maxsize = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', '20000')),
+                             ttl = float(os.environ.get('IDEMPOTENCY_TTL', '86400')))
+
+idempotency_requests = Counter("idempotency_requests_total", "Requests carrying an Idempotency-Key", ("outcome",))
+
+
+@collector
+def idempotency_metrics():
+    return idempotency_requests.render()
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status", "headers", "body")
+
+    def __init__(self, fingerprint: bytes, status: int, headers: list, body: bytes):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+async def send_json(send, status: int, body: bytes):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """
+    Plain ASGI middleware for writes that carry an Idempotency-Key header. The first request with a key
+    runs and its response is kept, keyed by the caller's Authorization, method, path and key. Retries
+    get that response back (marked Idempotent-Replayed) without running the handler again. A retry
+    arriving while the first is still running waits for it instead of racing it. Reusing a key with a
+    different body is refused with 422. Requests without an Authorization header are passed through
+    untouched, anonymous callers share no namespace to replay each other's responses from. The body
+    is buffered to compare retries, so it is capped at IDEMPOTENCY_MAX_BODY. Only 2xx responses are kept: a 429 from admission control, a 409
+    "try again" or a 5xx means the write did not happen, so those retries run again.
+
+    Keys live in this worker only. Retries routed to another worker run again, where the unique key on
+    student_class (one selection per student, class and year, added by python -m app.migrate) still
+    stops duplicate selections.
+    """
+
+    def __init__(self, app, store: TTLCache = None):
+        self.app = app
+        self.store = idempotency_store if store is None else store
+        self.in_flight = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in UNSAFE_METHODS:
+            return await self.app(scope, receive, send)
+        headers = Headers(scope = scope)
+        key = headers.get("idempotency-key")
+        if key is None:
+            return await self.app(scope, receive, send)
+        authorization = headers.get("authorization")
+        if not authorization:
+            idempotency_requests.inc("anonymous")
+            return await self.app(scope, receive, send)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return await send_json(send, 400, b'{"detail":"Idempotency-Key must be 1 to 255 characters"}')
+
+        too_large = b'{"detail":"Request body is too large for an Idempotency-Key request"}'
+        if int(headers.get("content-length") or 0) > MAX_BODY:
+            return await send_json(send, 413, too_large)
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if size > MAX_BODY:
+                return await send_json(send, 413, too_large)
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        fingerprint = hashlib.blake2b(body, digest_size = 16).digest()
+        caller = hashlib.blake2b(authorization.encode(), digest_size = 16).digest()
+        store_key = (caller, scope["method"], scope["path"], key)
+
+        while True:
+            stored = self.store.get(store_key)
+            if stored is not None:
+                if stored.fingerprint != fingerprint:
+                    idempotency_requests.inc("conflict")
+                    return await send_json(send, 422, b'{"detail":"Idempotency-Key was already used with a different request"}')
+                idempotency_requests.inc("replayed")
+                await send({"type": "http.response.start", "status": stored.status,
+                            "headers": stored.headers + [(b"idempotent-replayed", b"true")]})
+                return await send({"type": "http.response.body", "body": stored.body})
+            pending = self.in_flight.get(store_key)
+            if pending is None:
+                break
+            idempotency_requests.inc("waited")
+            await pending.wait()
+
+        done = self.in_flight[store_key] = asyncio.Event()
+        idempotency_requests.inc("new")
+        try:
+            await self._run(scope, receive, send, body, store_key, fingerprint)
+        finally:
+            del self.in_flight[store_key]
+            done.set()
+
+    async def _run(self, scope, receive, send, body: bytes, store_key: tuple, fingerprint: bytes):
+        replayed = False
+
+        async def receive_body():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # the body is already read, what is left on the channel is the disconnect
+            return await receive()
+
+        start = None
+        parts = []
+
+        async def capture(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # copied now, outer middleware edits the headers of the message it is sent
+                start = {"status": message["status"], "headers": list(message["headers"])}
+            elif message["type"] == "http.response.body":
+                parts.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, receive_body, capture)
+        if start is not None and 200 <= start["status"] < 300:
+            self.store.set(store_key, StoredResponse(fingerprint, start["status"], start["headers"], b"".join(parts)))
@@ -0,0 +1,121 @@
+"""
+Filename: instrumentation.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Per-request SQL counting and timing with repeated statement (N+1) warnings
+"""
+
+import logging
+import os
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+SQL_DEBUG = os.environ.get('SQL_DEBUG') == '1'                       # adds X-DB-* headers to responses
+REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', '5'))   # warn past this many runs of one statement
+
+_current = ContextVar("sql_request_stats", default=None)
+_expanded_in = re.compile(r"\((?:\?|%s)(?:, (?:\?|%s))+\)")
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_time", "shapes")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.shapes = Counter()
+
+    def repeated(self) -> dict:
+        return {shape: count for shape, count in self.shapes.items() if count > REPEAT_THRESHOLD}
+
+
+class RouteStats:
+    __slots__ = ("requests", "queries", "db_time", "max_queries")
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.max_queries = 0
+
+
+# totals per route template since the process started
+route_stats = {}
+
+
+def statement_shape(statement: str) -> str:
+    # expanded IN lists differ only by length, count them as one statement
+    return _expanded_in.sub("(?...)", " ".join(statement.split()))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _current.get() is not None:
+        context._sql_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = getattr(context, "_sql_started", None)
+    if stats is None or started is None:
+        return
+    stats.queries += 1
+    stats.db_time += time.perf_counter() - started
+    stats.shapes[statement_shape(statement)] += 1
+
+
+def install():
+    """Hooks every engine, statements run outside of a request are ignored"""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+async def sql_stats_middleware(request: Request, call_next):
+    stats = RequestStats()
+    token = _current.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        _current.reset(token)
+
+    route = request.scope.get("route")
+    # unmatched paths share one entry, a scanner must not grow the dict without bound
+    path = route.path if route is not None else "<unmatched>"
+    totals = route_stats.get(path)
+    if totals is None:
+        totals = route_stats[path] = RouteStats()
+    totals.requests += 1
+    totals.queries += stats.queries
+    totals.db_time += stats.db_time
+    totals.max_queries = max(totals.max_queries, stats.queries)
+
+    repeated = stats.repeated()
+    for shape, count in repeated.items():
+        logger.warning("%s %s ran the same statement %d times: %s", request.method, path, count, shape)
+
+    if SQL_DEBUG:
+        response.headers["X-DB-Queries"] = str(stats.queries)
+        response.headers["X-DB-Time-ms"] = f"{stats.db_time * 1000:.2f}"
+        response.headers["X-DB-Repeated"] = str(max(stats.shapes.values(), default=0))
+    return response
+
+
+def route_summary() -> dict:
+    return {
+        path: {
+            "requests": totals.requests,
+            "queries": totals.queries,
+            "avg_queries": round(totals.queries / totals.requests, 2),
+            "max_queries": totals.max_queries,
+            "db_time_ms": round(totals.db_time * 1000, 2),
+        }
+        for path, totals in route_stats.items()
+    }
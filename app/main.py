@@ -4,24 +4,94 @@ Author: Meghan Dang
 Date: 2025-01-16
 Version: 1.0
 Description: Main entry point, registers routers
+
+Importing this module only builds the app. Work against the database happens in the lifespan:
+    CREATE_SCHEMA=1     create missing tables on startup (off by default, run python -m app.migrate before
+                        starting a release instead, it also adds the indexes and constraints)
+    WARM_UP=1           open pool connections and load the current catalog before taking traffic
+    HOLD_SWEEP=1        release expired unpaid holds in the background (see enrollment.py)
 """
 
 
+import asyncio
+import os
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime
+from sqlalchemy import text
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from .models import *
-from .database import engine
+from .database import engine, read_engine, ReadSessionLocal
 from .routers import auth, family, student, register, admin, payments
+from . import order_summary     # registers the order_summary maintenance hook
+from . import enrollment
 
 from starlette.middleware.sessions import SessionMiddleware
 from .routers.auth import SECRET_KEY
-
-
-app = FastAPI()
+from .serializers import FastJSONResponse
+from . import instrumentation, metrics
+from .encoding import EncodingMiddleware
+from .idempotency import IdempotencyMiddleware, idempotency_store
+from .catalog import catalog_cache
+from .pricing import pricing_cache
+
+
+async def create_schema():
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+
+async def warm_up():
+    # one round trip per pooled connection so the first requests do not pay for connecting
+    async def ping(target):
+        async with target.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    for target in {engine, read_engine}:
+        size = target.sync_engine.pool.size()
+        await asyncio.gather(*(ping(target) for _ in range(size)))
+
+    year = datetime.now().year
+    async with ReadSessionLocal() as db:
+        for category_order in (register.LC_CATEGORIES, register.EP_CATEGORIES):
+            await catalog_cache.get(db, year, category_order)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.environ.get('CREATE_SCHEMA') == '1':
+        await create_schema()
+    if os.environ.get('WARM_UP') == '1':
+        await warm_up()
+    sweeper = None
+    if os.environ.get('HOLD_SWEEP') == '1':
+        sweeper = asyncio.create_task(enrollment.run_hold_sweeper())
+    yield
+    if sweeper is not None:
+        sweeper.cancel()
+        with suppress(asyncio.CancelledError):
+            await sweeper
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
+
+
+app = FastAPI(lifespan = lifespan, default_response_class = FastJSONResponse)
 app.add_middleware(SessionMiddleware, secret_key = SECRET_KEY, https_only = False)
 
+instrumentation.install()
+app.middleware("http")(instrumentation.sql_stats_middleware)
+app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(EncodingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
-Base.metadata.create_all(bind = engine)
-
+metrics.watch_pool(engine)
+if read_engine is not engine:
+    metrics.watch_pool(read_engine, "replica")
+metrics.watch_cache(auth.token_cache, "token")
+metrics.watch_cache(catalog_cache, "catalog")
+metrics.watch_cache(idempotency_store, "idempotency")
+metrics.watch_cache(pricing_cache, "pricing")
 
 
 @app.get("/healthy")
@@ -29,6 +99,11 @@ def health_check():
     return {'status': 'Healthy'}
 
 
+@app.get("/metrics", response_class = PlainTextResponse, include_in_schema = False)
+def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type = "text/plain; version=0.0.4")
+
+
 app.include_router(auth.router)
 app.include_router(family.router)
 app.include_router(student.router)
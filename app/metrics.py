@@ -0,0 +1,176 @@
+"""
+Filename: metrics.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Request, connection pool and cache metrics rendered in the Prometheus text format
+"""
+
+import time
+from contextlib import contextmanager
+from bisect import bisect_left
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in sorted(self.values.items())]
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+    def render(self) -> list:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        # per label set: one count per bucket (not cumulative until render), then sum and count
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels((*self.labels, 'le'), (*key, bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+request_latency = Histogram("http_request_duration_seconds", "Request latency by route", ("method", "route"))
+requests_in_flight = Gauge("http_requests_in_flight", "Requests currently being handled")
+request_errors = Counter("http_request_errors_total", "Responses with a 4xx or 5xx status", ("method", "route", "status"))
+pool_events = Counter("db_pool_events_total", "Connection pool checkouts, new connections, invalidations and timeouts", ("engine", "event"))
+
+# collectors run when /metrics is scraped, for values that are cheaper to read than to track
+_collectors = []
+
+
+def collector(fn):
+    _collectors.append(fn)
+    return fn
+
+
+def watch_pool(engine, name: str = "primary"):
+    """Counts pool events for an engine and reports its pool size, checked out and overflow connections"""
+    pool = engine.sync_engine.pool if hasattr(engine, "sync_engine") else engine.pool
+    event.listen(pool, "checkout", lambda *args: pool_events.inc(name, "checkout"))
+    event.listen(pool, "connect", lambda *args: pool_events.inc(name, "connect"))
+    event.listen(pool, "invalidate", lambda *args: pool_events.inc(name, "invalidate"))
+
+    @collector
+    def pool_status():
+        gauge = Gauge("db_pool_connections", "Connection pool state", ("engine", "state"))
+        for state in ("size", "checkedout", "checkedin", "overflow"):
+            method = getattr(pool, state, None)
+            if method is not None:
+                gauge.set(name, state, value=method())
+        return gauge.render()
+
+
+@contextmanager
+def count_pool_timeouts(name: str):
+    """Counts a pool checkout timeout raised inside the block against the named engine, pools
+    have no event for it, so the session dependencies wrap the requests using each engine"""
+    try:
+        yield
+    except PoolTimeoutError:
+        pool_events.inc(name, "timeout")
+        raise
+
+
+def watch_cache(cache, name: str):
+    """Reports hits, misses and hit ratio of any cache with hits and misses counters"""
+    @collector
+    def cache_status():
+        lines = []
+        for metric, help, value in (
+            ("cache_hits_total", "Cache hits", cache.hits),
+            ("cache_misses_total", "Cache misses", cache.misses),
+        ):
+            counter = Counter(metric, help, ("cache",))
+            counter.inc(name, amount=value)
+            lines += counter.render()
+        lookups = cache.hits + cache.misses
+        ratio = Gauge("cache_hit_ratio", "Share of lookups served from the cache", ("cache",))
+        ratio.set(name, value=round(cache.hits / lookups, 4) if lookups else 0.0)
+        return lines + ratio.render()
+
+
+def render() -> str:
+    lines = []
+    for metric in (request_latency, requests_in_flight, request_errors, pool_events):
+        lines += metric.render()
+    for fn in _collectors:
+        lines += fn()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, records latency, in-flight requests and error statuses per route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_flight.dec()
+            route = scope.get("route")
+            path = route.path if route is not None else "<unmatched>"
+            request_latency.observe(time.perf_counter() - start, scope["method"], path)
+            if status_code >= 400:
+                request_errors.inc(scope["method"], path, status_code)
@@ -0,0 +1,212 @@
+"""
+Filename: migrate.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Brings an existing database up to the schema the models describe, run before starting
+             a new release
+
+Every step looks at the live schema first and does nothing once it already holds, so the script is
+safe to run on every deploy. Steps run in order, each in its own transaction.
+
+Usage: python -m app.migrate [--check]
+    --check     list the pending steps and change nothing, exits 1 when something is pending
+"""
+
+import argparse
+import asyncio
+import sys
+from itertools import groupby
+from sqlalchemy import inspect, select, insert, delete, update, func, exists, text, true
+from .database import Base, engine
+from .models import ClassSeats, Order, OrderStudentClass, OrderSummary, StudentClass, UserInfo
+from .order_summary import class_count
+
+STEPS = []
+
+
+def step(fn):
+    """Registers a migration step. A step gets the connection and whether to apply, and returns
+    what it did (or would do) as a list of lines, empty when there is nothing to do."""
+    STEPS.append(fn)
+    return fn
+
+
+async def inspect_with(connection, fn):
+    return await connection.run_sync(lambda sync_connection: fn(inspect(sync_connection)))
+
+
+@step
+async def create_missing_tables(connection, apply: bool) -> list:
+    # new tables of this release: class_seats, order_summary and so on, with their indexes
+    existing = set(await inspect_with(connection, lambda inspector: inspector.get_table_names()))
+    missing = [table for table in Base.metadata.sorted_tables if table.name not in existing]
+    if apply and missing:
+        await connection.run_sync(Base.metadata.create_all, tables = missing)
+    return [f"create table {table.name}" for table in missing]
+
+
+async def index_names(connection, table: str) -> set:
+    """Indexes and unique constraints on table, MySQL lists a unique key as both"""
+    def names(inspector):
+        return ({index["name"] for index in inspector.get_indexes(table)}
+                | {constraint["name"] for constraint in inspector.get_unique_constraints(table)})
+    return await inspect_with(connection, names)
+
+
+async def create_unique_index(connection, name: str, table: str, columns: tuple):
+    await connection.execute(text(f"CREATE UNIQUE INDEX {name} ON {table} ({', '.join(columns)})"))
+
+
+@step
+async def student_class_unique(connection, apply: bool) -> list:
+    # one selection per student, class and year, the 409 guard in select_classes and sync_cart
+    # and the idempotency fallback rely on it
+    name, columns = "uq_student_class_year_student_class", ("year", "student_id", "class_id")
+    if name in await index_names(connection, "student_class"):
+        return []
+
+    duplicated = (
+        select(StudentClass.year, StudentClass.student_id, StudentClass.class_id)
+        .group_by(StudentClass.year, StudentClass.student_id, StudentClass.class_id)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    referenced = exists().where(OrderStudentClass.sc_id == StudentClass.sc_id)
+    rows = (await connection.execute(
+        select(StudentClass.sc_id, StudentClass.year, StudentClass.student_id, StudentClass.class_id,
+               StudentClass.paid, StudentClass.wait, referenced.label("referenced"))
+        .join(duplicated, (duplicated.c.year == StudentClass.year)
+              & (duplicated.c.student_id == StudentClass.student_id)
+              & (duplicated.c.class_id == StudentClass.class_id))
+        .order_by(StudentClass.year, StudentClass.student_id, StudentClass.class_id)
+    )).all()
+
+    # per group keep the row an order points at, else a paid one, else a seated one, else the oldest
+    extra = []
+    for key, group in groupby(rows, key = lambda row: (row.year, row.student_id, row.class_id)):
+        keep, *others = sorted(group, key = lambda row: (not row.referenced, not row.paid, bool(row.wait), row.sc_id))
+        if any(row.referenced for row in others):
+            raise RuntimeError(f"student_class {key} is duplicated across orders, merge those orders by hand first")
+        extra += [row.sc_id for row in others]
+
+    done = [f"student_class: remove {len(extra)} duplicate selections"] if extra else []
+    done.append(f"create unique index {name}")
+    if not apply:
+        return done
+
+    if extra:
+        await connection.execute(delete(StudentClass).filter(StudentClass.sc_id.in_(extra)))
+        if "class_seats" in await inspect_with(connection, lambda inspector: inspector.get_table_names()):
+            # seats held by the removed rows go back to their counters
+            await connection.execute(update(ClassSeats).values(taken = (
+                select(func.count(StudentClass.sc_id))
+                .filter(StudentClass.year == ClassSeats.year, StudentClass.class_id == ClassSeats.class_id,
+                        StudentClass.wait == 0)
+                .scalar_subquery()
+            )))
+    await create_unique_index(connection, name, "student_class", columns)
+    return done
+
+
+@step
+async def create_missing_indexes(connection, apply: bool) -> list:
+    # lookup indexes declared on the models (index=True and Index() in __table_args__) that an
+    # existing table lacks, unique ones need their duplicates removed and have their own steps
+    existing_tables = set(await inspect_with(connection, lambda inspector: inspector.get_table_names()))
+    done = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = await index_names(connection, table.name)
+        for index in sorted(table.indexes, key = lambda index: index.name):
+            if index.unique or index.name in existing:
+                continue
+            if apply:
+                await connection.run_sync(index.create)
+            done.append(f"create index {index.name} on {table.name}")
+    return done
+
+
+@step
+async def userinfo_email_unique(connection, apply: bool) -> list:
+    # complete_oauth_login upserts on email, ON DUPLICATE KEY UPDATE needs the key to exist
+    done = []
+    if "ix_userinfo_email" not in await index_names(connection, "userinfo"):
+        rows = (await connection.execute(
+            select(UserInfo.id, UserInfo.email, UserInfo.profile_created)
+            .filter(UserInfo.email.in_(
+                select(UserInfo.email).group_by(UserInfo.email).having(func.count() > 1)))
+            .order_by(UserInfo.email)
+        )).all()
+        # per email keep the row whose profile was completed, else the oldest
+        extra = []
+        for email, group in groupby(rows, key = lambda row: row.email):
+            keep, *others = sorted(group, key = lambda row: (not row.profile_created, row.id))
+            extra += [row.id for row in others]
+        if extra:
+            done.append(f"userinfo: remove {len(extra)} duplicate logins")
+        done.append("create unique index ix_userinfo_email")
+        if apply:
+            if extra:
+                await connection.execute(delete(UserInfo).filter(UserInfo.id.in_(extra)))
+            await create_unique_index(connection, "ix_userinfo_email", "userinfo", ("email",))
+
+    # Google access tokens are longer than the legacy 100 characters, sqlite does not enforce lengths
+    if connection.dialect.name == "mysql":
+        columns = await inspect_with(connection, lambda inspector: inspector.get_columns("userinfo"))
+        token = next(column for column in columns if column["name"] == "token_")
+        if (token["type"].length or 0) < UserInfo.token_.type.length:
+            done.append(f"widen userinfo.token_ to {UserInfo.token_.type.length}")
+            if apply:
+                await connection.execute(text(
+                    f"ALTER TABLE userinfo MODIFY token_ VARCHAR({UserInfo.token_.type.length}) NOT NULL"))
+    return done
+
+
+@step
+async def order_summary_backfill(connection, apply: bool) -> list:
+    # the payments list reads class counts from order_summary, orders placed before it existed
+    # (or while it was missing) get their row here, python -m app.order_summary check finds stale ones
+    tables = set(await inspect_with(connection, lambda inspector: inspector.get_table_names()))
+    if "orders" not in tables:
+        return []
+    missing = ~exists().where(OrderSummary.order_id == Order.order_id) if "order_summary" in tables else true()
+    count = await connection.scalar(select(func.count(Order.order_id)).filter(missing))
+    if not count:
+        return []
+    if apply:
+        await connection.execute(insert(OrderSummary).from_select(
+            ["order_id", "family_id", "number_of_classes"],
+            select(Order.order_id, Order.family_id, class_count(Order.order_id)).filter(missing)))
+    return [f"order_summary: summarize {count} orders"]
+
+
+async def migrate(target = None, apply: bool = True) -> list:
+    """Runs every step against target (the app's engine by default), returns what was done"""
+    target = engine if target is None else target
+    done = []
+    for fn in STEPS:
+        async with target.begin() as connection:
+            done += await fn(connection, apply)
+    return done
+
+
+async def _main(check: bool) -> int:
+    try:
+        done = await migrate(apply = not check)
+    finally:
+        await engine.dispose()
+    for line in done:
+        print(line)
+    if check:
+        print(f"{len(done)} pending changes")
+        return 1 if done else 0
+    print(f"{len(done)} changes applied")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring the database schema up to date")
+    parser.add_argument("--check", action="store_true", help="list pending changes without applying them")
+    sys.exit(asyncio.run(_main(parser.parse_args().check)))
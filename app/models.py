@@ -7,7 +7,7 @@ Description: Models for tables in database
 """
 
 from .database import Base
-from sqlalchemy import Column, Integer, Numeric, String, Boolean, ForeignKey, SmallInteger, DateTime, Text
+from sqlalchemy import Column, Integer, Numeric, String, Boolean, ForeignKey, SmallInteger, DateTime, Text, UniqueConstraint, Index
 from datetime import datetime
 
 
@@ -38,6 +38,26 @@ class Classes(Base):
     weight = Column(Integer, nullable=False)
 
 
+class ClassSeats(Base):
+    __tablename__ = "class_seats"
+
+    # one counter row per class per year, seats are reserved with a conditional
+    # update on this row so enrollment never has to lock student_class
+    year = Column(Integer, primary_key=True)
+    class_id = Column(Integer, primary_key=True)
+
+    seats_x = Column(SmallInteger, nullable=False)
+    taken = Column(SmallInteger, nullable=False, default=0)
+
+
+class CacheVersion(Base):
+    __tablename__ = "cache_version"
+
+    # shared version of an in-process cache, bumped to invalidate it in every worker
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
 class CurrentClasses(Base):
     __tablename__ = "current_classes"
 
@@ -75,7 +95,7 @@ class Family(Base):
     zip = Column(String(20), nullable=False)
     country = Column(String(2), nullable=False)
 
-    email = Column(String(50), nullable=False)
+    email = Column(String(50), nullable=False, index=True)     # login, signup and OAuth lookups
     email2 = Column(String(50), nullable=False)
 
     phone = Column(String(20), nullable=False)
@@ -120,7 +140,7 @@ class FamilyYear(Base):
     __tablename__ = "family_year"
 
     year = Column(Integer, primary_key=True, nullable=False)
-    family_id = Column(Integer, primary_key=True, nullable=False, default=0)
+    family_id = Column(Integer, primary_key=True, nullable=False, default=0, index=True)
 
     paid = Column(Boolean, nullable=True)   # tinyint(1)
     vay_id = Column(Integer, nullable=True)    
@@ -132,7 +152,7 @@ class Student(Base):
     student_id = Column(Integer, primary_key=True)
     o_student_id = Column(String(20), nullable=False)
 
-    family_id = Column(Integer, ForeignKey("families.family_id"), nullable=False)
+    family_id = Column(Integer, ForeignKey("families.family_id"), nullable=False, index=True)
     first_name = Column(String(40), nullable=False)
     last_name = Column(String(20), nullable=False)
     chinese_name = Column(String(256), nullable=False)
@@ -160,6 +180,12 @@ class Student(Base):
 
 class StudentClass(Base):
     __tablename__ = "student_class"
+    __table_args__ = (
+        UniqueConstraint("year", "student_id", "class_id", name="uq_student_class_year_student_class"),
+        Index("ix_student_class_student_year_paid", "student_id", "year", "paid"),
+        Index("ix_student_class_waitlist", "year", "class_id", "wait", "created"),      # waitlist order per class
+        Index("ix_student_class_hold", "year", "paid", "wait", "removed"),              # expired unpaid holds
+    )
 
     sc_id = Column(Integer, primary_key=True)
 
@@ -173,7 +199,7 @@ class StudentClass(Base):
     paid_price = Column(Integer, nullable=True)
 
     created = Column(DateTime, nullable=False)
-    removed = Column(DateTime, nullable=False)    
+    removed = Column(DateTime, nullable=False)    # end of the unpaid hold, see enrollment.py
 
 
 class Order(Base):
@@ -192,15 +218,24 @@ class Order(Base):
     amount = Column(Numeric(10, 2), nullable=False)
 
     payment_method = Column(String(15), nullable=False)
-    transaction_id = Column(String(30), nullable=False)
+    transaction_id = Column(String(30), nullable=False, index=True)
+
+
+class OrderSummary(Base):
+    __tablename__ = "order_summary"
+
+    # read model for the payments list, kept in step with order_student_class by order_summary.py
+    order_id = Column(Integer, primary_key=True)
+    family_id = Column(Integer, nullable=False, index=True)
+    number_of_classes = Column(Integer, nullable=False, default=0)
 
 
 class OrderStudentClass(Base):
     __tablename__ = "order_student_class"
 
     osc_id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer,default=None)
-    sc_id = Column(Integer,default=None)
+    order_id = Column(Integer,default=None, index=True)
+    sc_id = Column(Integer,default=None, index=True)
 
 
 class UserInfo(Base):
@@ -209,9 +244,9 @@ class UserInfo(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     first_name = Column(String(100), nullable=True)
     last_name = Column(String(100), nullable=True)
-    email = Column(String(100), nullable=False) 
+    email = Column(String(100), nullable=False, index=True, unique=True)
     profile_created = Column(Boolean, default=False)
-    token_ = Column(String(100), nullable=False)
+    token_ = Column(String(2048), nullable=False)     # provider access token, longer than 100 chars for Google
 
 
 class VolunteerActivities(Base):
@@ -0,0 +1,204 @@
+"""
+Filename: order_summary.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Keeps the order_summary table in step with order_student_class, plus backfill and
+             consistency check commands
+
+Rows added, moved between orders or removed through the ORM are counted in the flush. INSERT,
+UPDATE and DELETE statements run on order_student_class through a session recount the orders they
+touch. Writes that bypass the session (raw SQL, other applications) are only caught by check and
+fixed by backfill. Orders placed before this table existed get their summary from python -m app.migrate.
+
+Usage: python -m app.order_summary backfill|check
+"""
+
+import argparse
+import asyncio
+import sys
+from collections import Counter
+from sqlalchemy import event, inspect, select, update, delete, insert, func, literal
+from sqlalchemy.orm import Session
+from .database import SessionLocal, insert_ignore
+from .models import Order, OrderStudentClass, OrderSummary
+
+
+def class_count(order_id):
+    """Number of classes on an order counted from order_student_class, order_id may be a column"""
+    return (select(func.count(OrderStudentClass.osc_id))
+            .filter(OrderStudentClass.order_id == order_id)
+            .scalar_subquery())
+
+
+def _insert_summary(session, order_id):
+    # order predates the summary table, start it from the full count
+    session.connection().execute(insert_ignore(session, OrderSummary).from_select(
+        ["order_id", "family_id", "number_of_classes"],
+        select(Order.order_id, Order.family_id, class_count(order_id)).filter(Order.order_id == order_id)))
+
+
+def _recount(session, order_ids):
+    connection = session.connection()
+    for order_id in sorted(order_ids):
+        updated = connection.execute(
+            update(OrderSummary)
+            .filter(OrderSummary.order_id == order_id)
+            .values(number_of_classes=class_count(order_id))
+        )
+        if updated.rowcount == 0:
+            _insert_summary(session, order_id)
+
+
+@event.listens_for(OrderStudentClass.order_id, "set", active_history=True)
+def _load_previous_order(target, value, oldvalue, initiator):
+    # active_history loads the order a row is moved away from, for the flush to count it down
+    pass
+
+
+@event.listens_for(Session, "after_flush")
+def maintain_order_summaries(session, flush_context):
+    # Runs inside the flush, so summary changes commit or roll back with the rows that caused them.
+    deltas = Counter()
+    new_orders = []
+
+    for obj in session.new:
+        if isinstance(obj, Order):
+            new_orders.append(obj)
+        elif isinstance(obj, OrderStudentClass) and obj.order_id is not None:
+            deltas[int(obj.order_id)] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, OrderStudentClass) and obj.order_id is not None:
+            deltas[int(obj.order_id)] -= 1
+
+    for obj in session.dirty:
+        if isinstance(obj, OrderStudentClass):
+            history = inspect(obj).attrs.order_id.history
+            for order_id in history.added:
+                if order_id is not None:
+                    deltas[int(order_id)] += 1
+            for order_id in history.deleted:
+                if order_id is not None:
+                    deltas[int(order_id)] -= 1
+
+    if not new_orders and not deltas:
+        return
+
+    connection = session.connection()
+    for order in new_orders:
+        connection.execute(insert_ignore(session, OrderSummary).values(
+            order_id=order.order_id, family_id=order.family_id, number_of_classes=class_count(order.order_id)))
+        deltas.pop(int(order.order_id), None)
+
+    for order_id, delta in deltas.items():
+        if delta == 0:
+            continue
+        updated = connection.execute(
+            update(OrderSummary)
+            .filter(OrderSummary.order_id == order_id)
+            .values(number_of_classes=OrderSummary.number_of_classes + delta)
+        )
+        if updated.rowcount == 0:
+            _insert_summary(session, order_id)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def recount_after_bulk_writes(orm_execute_state):
+    # Statements on order_student_class skip the flush. The orders they touch are read before
+    # (and for an UPDATE, again after) the statement runs, then recounted in the same transaction.
+    state = orm_execute_state
+    if not (state.is_insert or state.is_update or state.is_delete):
+        return None
+    statement = state.statement
+    if statement.table.name != OrderStudentClass.__tablename__:
+        return None
+
+    session = state.session
+    params = state.parameters if isinstance(state.parameters, list) else [state.parameters or {}]
+    order_ids = set()
+    if state.is_insert:
+        if state.parameters:
+            order_ids.update(row.get("order_id") for row in params)
+        else:
+            # values given on the statement itself, "order_id_m<n>" for a multi-row VALUES
+            order_ids.update(value for key, value in statement.compile().params.items()
+                             if key == "order_id" or key.startswith("order_id_m"))
+        result = state.invoke_statement()
+    else:
+        affected = select(OrderStudentClass.osc_id, OrderStudentClass.order_id)
+        if statement.whereclause is not None:
+            affected = affected.filter(statement.whereclause)
+        if all("osc_id" in row for row in params):
+            # bulk UPDATE by primary key, one parameter set per row
+            affected = affected.filter(OrderStudentClass.osc_id.in_([row["osc_id"] for row in params]))
+        before = session.execute(affected).all()
+        result = state.invoke_statement()
+        order_ids.update(row.order_id for row in before)
+        if state.is_update and before:
+            order_ids.update(session.scalars(
+                select(OrderStudentClass.order_id)
+                .filter(OrderStudentClass.osc_id.in_([row.osc_id for row in before]))
+            ))
+
+    _recount(session, {int(order_id) for order_id in order_ids if order_id is not None})
+    return result
+
+
+async def backfill(db) -> int:
+    """Rebuilds every summary row from orders and order_student_class, returns the number of orders"""
+    await db.execute(delete(OrderSummary))
+    await db.execute(insert(OrderSummary).from_select(
+        ["order_id", "family_id", "number_of_classes"],
+        select(Order.order_id, Order.family_id, func.count(OrderStudentClass.osc_id))
+        .outerjoin(OrderStudentClass, OrderStudentClass.order_id == Order.order_id)
+        .group_by(Order.order_id, Order.family_id)))
+    await db.commit()
+    return await db.scalar(select(func.count(OrderSummary.order_id)))
+
+
+async def check(db) -> list:
+    """Returns the orders whose summary row is missing, stale or orphaned"""
+    actual = (
+        select(Order.order_id, Order.family_id, func.count(OrderStudentClass.osc_id).label("number_of_classes"))
+        .outerjoin(OrderStudentClass, OrderStudentClass.order_id == Order.order_id)
+        .group_by(Order.order_id, Order.family_id)
+        .subquery()
+    )
+
+    mismatched = await db.execute(
+        select(actual.c.order_id, actual.c.number_of_classes, OrderSummary.number_of_classes.label("summary"))
+        .outerjoin(OrderSummary, OrderSummary.order_id == actual.c.order_id)
+        .filter((OrderSummary.order_id.is_(None))
+                | (OrderSummary.number_of_classes != actual.c.number_of_classes)
+                | (OrderSummary.family_id != actual.c.family_id))
+    )
+    orphaned = await db.execute(
+        select(OrderSummary.order_id, literal(None).label("number_of_classes"), OrderSummary.number_of_classes.label("summary"))
+        .outerjoin(Order, Order.order_id == OrderSummary.order_id)
+        .filter(Order.order_id.is_(None))
+    )
+
+    return [
+        {"order_id": row.order_id, "number_of_classes": row.number_of_classes, "summary": row.summary}
+        for row in [*mismatched.all(), *orphaned.all()]
+    ]
+
+
+async def _main(command: str) -> int:
+    async with SessionLocal() as db:
+        if command == "backfill":
+            print(f"backfilled {await backfill(db)} orders")
+            return 0
+
+        problems = await check(db)
+        for problem in problems:
+            print(problem)
+        print(f"{len(problems)} inconsistent orders")
+        return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the order_summary read model")
+    parser.add_argument("command", choices=["backfill", "check"])
+    sys.exit(asyncio.run(_main(parser.parse_args().command)))
@@ -0,0 +1,211 @@
+"""
+Filename: pricing.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Cart pricing, line prices per class category plus the discount and fee rules applied
+             to a family's whole cart
+
+The rules are read once from the JSON file named by PRICING_FILE, for example
+    {
+        "prices": {"LC": 400, "EP": 250, "BOOK": 30},
+        "default_price": 0,
+        "sibling_discount": 15,
+        "early_bird": {"until": "2026-06-01", "per_class": 20},
+        "volunteer_buyout": 100
+    }
+Any key left out keeps its default. The sibling discount defaults to the legacy $15 for every student
+after the first. There is no early-bird discount or volunteer buy-out (a fee for families with no
+volunteer activity this year) unless configured. The tree stores no class prices, so without prices
+(or a default_price) carts are not quoted at all. Discounts never take a total below 0.
+
+Configured from the environment:
+    PRICING_FILE        JSON pricing rules as above (none)
+    PRICING_CACHE_TTL   seconds a priced cart is kept for its cart version (600)
+"""
+
+import json
+import os
+from datetime import date
+from sqlalchemy import select, func, and_, exists
+from sqlalchemy.ext.asyncio import AsyncSession
+from .cache import TTLCache
+from .etag import make_etag
+from .models import Family, FamilyYear, Student, StudentClass, Classes
+
+DEFAULT_RULES = {
+    "prices": {},
+    "default_price": 0,
+    "sibling_discount": 15,
+    "early_bird": None,
+    "volunteer_buyout": None,
+}
+
+pricing_cache = TTLCache(maxsize = 10000, ttl = float(os.environ.get('PRICING_CACHE_TTL', '600')))
+
+
+def cart_query(family_id: int, current_year: int, *columns):
+    """The family's seated, unpaid selections for the year, the rows checkout charges for"""
+    return (
+        select(*columns)
+        .select_from(Family)
+        .join(Student, Student.family_id == Family.family_id)
+        .join(
+            StudentClass,
+            and_(
+                StudentClass.student_id == Student.student_id,
+                StudentClass.paid == 0,
+                StudentClass.wait == 0,
+                StudentClass.year == current_year,
+            ),
+        )
+        .join(Classes, Classes.class_id == StudentClass.class_id)
+        .filter(Family.family_id == family_id)
+    )
+
+
+def volunteered(family_id: int, current_year: int):
+    return exists().where(
+        FamilyYear.family_id == family_id,
+        FamilyYear.year == current_year,
+        FamilyYear.vay_id > 0,
+    )
+
+
+async def cart_version(db: AsyncSession, family_id: int, current_year: int) -> str:
+    """
+    One aggregate row over the cart versions it: rows come and go by sc_id, edits to the
+    students, classes or family bump modified or verified, and signing up to volunteer
+    changes whether the buy-out applies
+    """
+    version = (await db.execute(cart_query(
+        family_id, current_year,
+        func.count(StudentClass.sc_id),
+        func.sum(StudentClass.sc_id),
+        func.sum(StudentClass.class_id),
+        func.max(StudentClass.removed),
+        func.max(Student.modified),
+        func.max(Classes.modified),
+        func.max(Family.verified),
+        volunteered(family_id, current_year).label("volunteered"),
+    ))).one()
+    return make_etag(*version)
+
+
+class PricingRules:
+    """
+    The configured rules compiled once into plain functions, so pricing a cart is a pass over
+    its few grouped rows and a call per enabled rule. Each rule takes the cart's totals and the
+    day and returns an adjustment line or None.
+    """
+
+    def __init__(self, config: dict):
+        config = {**DEFAULT_RULES, **config}
+        self.prices = config["prices"]
+        self.default_price = config["default_price"]
+        self.sibling_amount = config["sibling_discount"] or 0
+        self.configured = bool(self.prices) or bool(self.default_price)
+        # part of every quote's ETag and cache key, a new rules file never serves an old quote
+        self.fingerprint = make_etag(json.dumps(config, sort_keys = True))
+        self.rules = self._compile(config)
+
+    def _compile(self, config: dict) -> list:
+        rules = []
+        if self.sibling_amount:
+            def sibling(cart: dict, today: date):
+                amount = self.sibling_discount(cart["students"])
+                return {"name": "Sibling Discount", "amount": amount} if amount else None
+            rules.append(sibling)
+
+        early_bird = config["early_bird"]
+        if early_bird:
+            until = date.fromisoformat(early_bird["until"])
+            per_class = early_bird["per_class"]
+
+            def early_bird_discount(cart: dict, today: date):
+                if today > until or not cart["classes"]:
+                    return None
+                return {"name": "Early Bird Discount", "amount": -per_class * cart["classes"]}
+            rules.append(early_bird_discount)
+
+        buyout = config["volunteer_buyout"]
+        if buyout:
+            def volunteer_buyout(cart: dict, today: date):
+                if cart["volunteered"] or not cart["classes"]:
+                    return None
+                return {"name": "Volunteer Buy-out", "amount": buyout}
+            rules.append(volunteer_buyout)
+        return rules
+
+    def sibling_discount(self, student_count: int):
+        """Negative amount taken off for every student after the first"""
+        return -(student_count - 1) * self.sibling_amount if student_count > 1 else 0
+
+    def unit_price(self, category: str):
+        return self.prices.get(category, self.default_price)
+
+    def price(self, rows: list, volunteered: bool, today: date) -> dict:
+        """rows are (student_id, category, number of classes), one per student and category"""
+        lines = [
+            {"student_id": student_id, "category": category, "classes": classes,
+             "unit_price": self.unit_price(category), "amount": self.unit_price(category) * classes}
+            for student_id, category, classes in rows
+        ]
+        cart = {
+            "students": len({line["student_id"] for line in lines}),
+            "classes": sum(line["classes"] for line in lines),
+            "volunteered": volunteered,
+        }
+        adjustments = [adjustment for adjustment in (rule(cart, today) for rule in self.rules) if adjustment]
+        subtotal = sum(line["amount"] for line in lines)
+        return {
+            "lines": lines,
+            "subtotal": subtotal,
+            "adjustments": adjustments,
+            "total": max(0, subtotal + sum(adjustment["amount"] for adjustment in adjustments)),
+        }
+
+
+def load_rules(path: str = None) -> PricingRules:
+    path = os.environ.get('PRICING_FILE') if path is None else path
+    if not path:
+        return PricingRules({})
+    with open(path, encoding = "utf-8") as f:
+        return PricingRules(json.load(f))
+
+
+pricing_rules = load_rules()
+
+
+def quote_etag(version: str, today: date) -> str:
+    # the early-bird rule depends on the day, so a quote is only good for the day it was made
+    return make_etag(version, pricing_rules.fingerprint, today.isoformat())
+
+
+async def price_cart(db: AsyncSession, family_id: int, current_year: int, version: str) -> dict:
+    """
+    The family's cart priced under the current rules. All the input comes from one query
+    grouped by student and category, and the result is kept for the cart version from
+    cart_version(), so repeated checkout views reuse it until the cart changes.
+    """
+    today = date.today()
+    key = (family_id, quote_etag(version, today))
+    quote = pricing_cache.get(key)
+    if quote is not None:
+        return quote
+
+    rows = (await db.execute(
+        cart_query(
+            family_id, current_year,
+            Student.student_id,
+            Classes.category,
+            func.count(StudentClass.sc_id),
+            volunteered(family_id, current_year).label("volunteered"),
+        )
+        .group_by(Student.student_id, Classes.category)
+        .order_by(Student.student_id, Classes.category)
+    )).all()
+
+    quote = pricing_rules.price([row[:3] for row in rows], bool(rows and rows[0].volunteered), today)
+    pricing_cache.set(key, quote)
+    return quote
@@ -2,23 +2,129 @@
 Filename: admin.py
 Author: Meghan Dang
 Date: 2025-01-16
-Version: 1.0
+Version: 1.1
 Description: Endpoints for reading all families and students, will not be needed in actual app
 """
 
-from fastapi import APIRouter
+import csv
+import io
+import json
+from datetime import datetime
+from enum import Enum
+from fastapi import APIRouter, Path, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from ..models import Student, Family
-from .auth import db_dependency
+from .auth import db_dependency, admin_dependency
+from ..catalog import catalog_cache
+from ..enrollment import set_capacity, promote_all
+from ..serializers import json_default
+from ..instrumentation import route_summary
+from .. import admission
 
 router = APIRouter(
     prefix = '/admin',
     tags = ['admin']
 )
 
+EXPORT_BATCH_SIZE = 500
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+# Keyset pagination on the primary key, pass next_after back as after to get the following page
+async def read_page(db: AsyncSession, model, key, after: int, limit: int) -> dict:
+    rows = (await db.execute(select(model).filter(key > after).order_by(key).limit(limit))).scalars().all()
+    return {
+        "items": rows,
+        "next_after": getattr(rows[-1], key.key) if len(rows) == limit else None
+    }
+
+
+# Streams every row without holding the table in memory, rows come off a server side cursor in batches
+async def export_rows(db: AsyncSession, model, key, export_format: ExportFormat):
+    columns = model.__table__.columns
+    result = await db.stream(select(*columns).order_by(key).execution_options(yield_per = EXPORT_BATCH_SIZE))
+
+    if export_format == ExportFormat.csv:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([c.name for c in columns])
+        async for partition in result.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        async for partition in result.mappings().partitions():
+            yield "".join(json.dumps(dict(row), default=json_default, ensure_ascii=False) + "\n" for row in partition)
+
+
+def export_response(db: AsyncSession, model, key, export_format: ExportFormat, name: str) -> StreamingResponse:
+    media_type = "text/csv" if export_format == ExportFormat.csv else "application/x-ndjson"
+    return StreamingResponse(
+        export_rows(db, model, key, export_format),
+        media_type = media_type,
+        headers = {"Content-Disposition": f'attachment; filename="{name}.{export_format.value}"'}
+    )
+
+
 @router.get("/read_families")
-async def read_all_families(db: db_dependency):
-    return db.query(Family).all()
+async def read_all_families(db: db_dependency, after: int = 0, limit: int = Query(100, ge=1, le=1000)):
+    return await read_page(db, Family, Family.family_id, after, limit)
 
 @router.get("/read_students")
-async def read_all_students(db: db_dependency):
-    return db.query(Student).all()
\ No newline at end of file
+async def read_all_students(db: db_dependency, after: int = 0, limit: int = Query(100, ge=1, le=1000)):
+    return await read_page(db, Student, Student.student_id, after, limit)
+
+@router.get("/read_families/export")
+async def export_all_families(db: db_dependency, format: ExportFormat = ExportFormat.ndjson):
+    return export_response(db, Family, Family.family_id, format, "families")
+
+@router.get("/read_students/export")
+async def export_all_students(db: db_dependency, format: ExportFormat = ExportFormat.ndjson):
+    return export_response(db, Student, Student.student_id, format, "students")
+
+# Call after changing current_classes so every worker rebuilds its cached catalog
+@router.post("/catalog/invalidate")
+async def invalidate_catalog(admin: admin_dependency, db: db_dependency):
+    return {"version": await catalog_cache.bump(db)}
+
+# Query count and database time per route since the process started
+@router.get("/sql_stats")
+async def read_sql_stats(admin: admin_dependency):
+    return route_summary()
+
+# Opens the registration waiting room, families are then let in first come first served at rate per second
+@router.post("/waiting_room/open")
+async def open_waiting_room(admin: admin_dependency, rate: float = Query(None, gt=0), burst: int = Query(None, ge=0)):
+    await admission.admission_backend.open_waiting_room(rate or admission.WAITING_ROOM_RATE,
+                                                        admission.WAITING_ROOM_BURST if burst is None else burst)
+    return await admission.admission_backend.status()
+
+@router.post("/waiting_room/close")
+async def close_waiting_room(admin: admin_dependency):
+    await admission.admission_backend.close_waiting_room()
+    return await admission.admission_backend.status()
+
+@router.get("/admission")
+async def read_admission(admin: admin_dependency):
+    return await admission.admission_backend.status()
+
+# Changes a class's capacity for the current year, added seats go to its waitlist first
+@router.put("/classes/{class_id}/seats")
+async def update_class_seats(admin: admin_dependency, db: db_dependency, class_id: int = Path(gt=0), seats_x: int = Query(ge=0)):
+    promoted = await set_capacity(db, datetime.now().year, class_id, seats_x)
+    await catalog_cache.bump(db)
+    return {"class_id": class_id, "seats_x": seats_x, "promoted": promoted}
+
+# Gives every open seat to the waitlist, after seats were freed outside the app
+@router.post("/waitlist/promote")
+async def promote_all_waitlists(admin: admin_dependency, db: db_dependency):
+    promoted = await promote_all(db, datetime.now().year)
+    return {"promoted": promoted}
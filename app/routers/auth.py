@@ -7,18 +7,20 @@ Description: Authentication, session, third-party OAuth (Google, Facebook, Yahoo
 """
 
 from fastapi import FastAPI, APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 from pydantic import BaseModel
 from jose import jwt, JWTError
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from starlette.requests import Request
-from authlib.integrations.starlette_client import OAuth, OAuthError
 import os 
 from dotenv import load_dotenv
-from ..models import Family, UserInfo
-from ..database import SessionLocal 
+from ..models import Family, UserInfo, Student
+from ..database import SessionLocal, ReadSessionLocal, engine, read_engine, upsert
+from ..metrics import count_pool_timeouts
+from ..cache import TTLCache
 
 
 router = APIRouter(
@@ -31,15 +33,29 @@ ALGORITHM = 'HS256'
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl = 'token')
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_db():
+    async with SessionLocal() as db:
+        with count_pool_timeouts("primary"):
+            yield db
+
+
+# Read replica session, for handlers that do not need to see writes made moments ago
+async def get_read_db():
+    async with ReadSessionLocal() as db:
+        with count_pool_timeouts("replica" if read_engine is not engine else "primary"):
+            yield db
+
+
+# Claims of recently verified tokens. A page load sends the same bearer token many times, so
+# only the first request pays for the signature check. Entries never outlive the token's exp.
+token_cache = TTLCache(maxsize = 10000, ttl = 300)
 
 
 async def get_current_family(token: str = Depends(oauth2_bearer)):
+    claims = token_cache.get(token)
+    if claims is not None:
+        return dict(claims)
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms = [ALGORITHM])
         email : str = payload.get('sub')
@@ -48,15 +64,29 @@ async def get_current_family(token: str = Depends(oauth2_bearer)):
         if email is None or family_id is None:
             raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED,
                                 detail = 'Could not validate credentials')
-        return {'email': email, 'family_id': family_id}
+        claims = {'email': email, 'family_id': family_id, 'student_ids': payload.get('sids')}
+        token_cache.set(token, claims, expires_at = payload.get('exp'))
+        return dict(claims)
     except JWTError:
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED)        
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+read_db_dependency = Annotated[AsyncSession, Depends(get_read_db)]
 family_dependency = Annotated[dict, Depends(get_current_family)]
 
 
+# Staff accounts are families with Family.level set, checked on the primary so a revoked flag applies at once
+async def get_current_admin(family: family_dependency, db: db_dependency):
+    level = await db.scalar(select(Family.level).filter(Family.family_id == family.get('family_id')))
+    if not level:
+        raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = 'Admin access required')
+    return family
+
+
+admin_dependency = Annotated[dict, Depends(get_current_admin)]
+
+
 class CreateFamilyRequest(BaseModel):
     email: str
     password: str
@@ -68,8 +98,8 @@ class Token(BaseModel):
     token_type: str
 
 
-def authenticate_user(email: str, password: str, db):
-    profile = db.query(Family).filter(Family.email == email).first()
+async def authenticate_user(email: str, password: str, db: AsyncSession):
+    profile = (await db.execute(select(Family).filter(Family.email == email))).scalars().first()
     if not profile:
         return False
     if not password == profile.password:
@@ -77,104 +107,157 @@ def authenticate_user(email: str, password: str, db):
     return profile
 
 
-def create_access_token(email: str, family_id: int, expires_delta: timedelta):
+# sids lists the family's students so ownership checks don't need the database. Tokens issued before
+# a student was added don't list them, create_child hands back a fresh token for that reason
+def create_access_token(email: str, family_id: int, expires_delta: timedelta, student_ids: list = None):
     encode = {'sub': email, 'id': family_id}
+    if student_ids is not None:
+        encode['sids'] = sorted(student_ids)
     expires = datetime.now(timezone.utc) + expires_delta
     encode.update({'exp': expires})
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
-# google log in
+
+async def get_family_student_ids(family_id: int, db: AsyncSession) -> list:
+    return list((await db.execute(select(Student.student_id).filter(Student.family_id == family_id))).scalars().all())
+
+
+async def check_student_owner(family: dict, student_id: int, db: AsyncSession) -> bool:
+    """True if the student belongs to the family, answered from the token claims when it carries them"""
+    student_ids = family.get('student_ids')
+    if student_ids is not None:
+        return student_id in student_ids
+    owner = await db.scalar(select(Student.student_id).filter(Student.student_id == student_id,
+                                                              Student.family_id == family.get('family_id')))
+    return owner is not None
+
+
+async def get_family_student(family: dict, student_id: int, db: AsyncSession):
+    """Loads a student row only if it belongs to the family, returns None otherwise"""
+    student_ids = family.get('student_ids')
+    if student_ids is None:
+        return (await db.execute(select(Student).filter(Student.student_id == student_id,
+                                                       Student.family_id == family.get('family_id')))).scalars().first()
+    if student_id not in student_ids:
+        return None
+    return await db.get(Student, student_id)
+
+# Third-party OAuth providers. Each is registered on its first login, not at import, so workers
+# start without importing authlib and a provider with missing credentials only fails its own routes.
 
 load_dotenv()
-CLIENT_ID = os.environ.get('google-id', None)
-CLIENT_SECRET = os.environ.get('google-secret', None)
-
-oauth = OAuth()
-oauth.register(
-    name = 'google',
-    server_metadata_url = 'https://accounts.google.com/.well-known/openid-configuration',
-    client_id = CLIENT_ID,
-    client_secret = CLIENT_SECRET,
-    client_kwargs = {
-        'scope': 'email openid profile',
-        'redirect_url': 'http://localhost:8080/auth/google'
-    }
-)    
 
+OAUTH_PROVIDERS = {
+    'google': dict(
+        env = ('google-id', 'google-secret'),
+        server_metadata_url = 'https://accounts.google.com/.well-known/openid-configuration',
+        client_kwargs = {
+            'scope': 'email openid profile',
+            'redirect_url': 'http://localhost:8080/auth/google'
+        }
+    ),
+    'facebook': dict(
+        env = ('facebook-id', 'facebook-secret'),
+        authorize_url="https://www.facebook.com/v20.0/dialog/oauth",
+        access_token_url="https://graph.facebook.com/v20.0/oauth/access_token",
+        api_base_url="https://graph.facebook.com/",
+        client_kwargs={"scope": "email"},
+    ),
+    'yahoo': dict(
+        env = ('yahoo-id', 'yahoo-secret'),
+        server_metadata_url="https://api.login.yahoo.com/.well-known/openid-configuration",
+        client_kwargs={"scope": "openid email profile"}
+    ),
+}
+
+oauth = None
+
+
+def get_oauth_client(name: str):
+    global oauth
+    if oauth is None:
+        from authlib.integrations.starlette_client import OAuth
+        oauth = OAuth()
+
+    client = oauth.create_client(name)
+    if client is None:
+        settings = dict(OAUTH_PROVIDERS[name])
+        id_key, secret_key = settings.pop('env')
+        client_id, client_secret = os.environ.get(id_key), os.environ.get(secret_key)
+        if not client_id or not client_secret:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail=f"{name} login is not configured")
+        client = oauth.register(name = name, client_id = client_id, client_secret = client_secret, **settings)
+    return client
+
+
+async def authorize_access_token(client, request: Request):
+    from authlib.integrations.starlette_client import OAuthError
+    try:
+        return await client.authorize_access_token(request)
+    except OAuthError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+
+async def resolve_identity(email: str, db: AsyncSession):
+    """UserInfo id and Family id for an email, each None when missing, in one round trip"""
+    row = (await db.execute(select(
+        select(UserInfo.id).filter(UserInfo.email == email).limit(1).scalar_subquery(),
+        select(Family.family_id).filter(Family.email == email).limit(1).scalar_subquery(),
+    ))).one()
+    return row[0], row[1]
+
+
+async def complete_oauth_login(db: AsyncSession, token: dict, email: str, first_name: str, last_name: str):
+    """
+    Shared tail of the OAuth callbacks. Users with a family profile are let in after a single query.
+    Anyone else gets their UserInfo inserted, or updated when a concurrent login or an earlier visit
+    already created it, with profile_created off so they are prompted to fill out the family profile.
+    """
+    if not email:
+        raise HTTPException(status_code=400, detail="User info not found")
+
+    user_info_id, family_id = await resolve_identity(email, db)
+    if user_info_id is None or family_id is None:
+        values = dict(email = email, first_name = first_name, last_name = last_name,
+                      profile_created = False, token_ = token["access_token"])
+        await db.execute(upsert(db, UserInfo, values, index_elements = [UserInfo.email],
+                                update = dict(profile_created = False, token_ = token["access_token"])))
+        await db.commit()
+    return {"access_token": token["access_token"], "token_type": "bearer"}
+
+
+# google log in
 
 @router.get("/login/google")
 async def login_google(request: Request): 
     url = request.url_for('auth_google')
-    return await oauth.google.authorize_redirect(request, url)
+    return await get_oauth_client('google').authorize_redirect(request, url)
 
 
 @router.get('/auth/google', response_model = Token)
 async def auth_google(request: Request, db: db_dependency): 
-    try: 
-        token = await oauth.google.authorize_access_token(request)
-    except OAuthError as error:
-        raise HTTPException(status_code=400, detail=str(error))
-    
-    user = token.get('userinfo')
-    exists_in_user_info = db.query(UserInfo).filter(UserInfo.email == user.get('email')).first()
-
-    if not exists_in_user_info:      # if completely new user
-        if user:
-            db = SessionLocal()
-            userinfo = UserInfo(
-                email=user.get('email'), 
-                first_name=user.get('given_name'),
-                last_name=user.get('family_name'),
-                profile_created=False,           # will prompt user to fill out family profile
-                token_=token
-            )
-            db.add(userinfo)
-            db.commit()
-            db.close()
-            return {"access_token": token["access_token"], "token_type": "bearer"}
-    else:
-        exists_in_family = db.query(Family).filter(Family.email == user.get('email'))
-        if exists_in_family:              # if in family database
-            return {"access_token": token["access_token"], "token_type": "bearer"}
-        else: 
-            exists_in_user_info.profile_created = False
-    
-    raise HTTPException(status_code=400, detail="User info not found")   
+    token = await authorize_access_token(get_oauth_client('google'), request)
+    user = token.get('userinfo') or {}
+    return await complete_oauth_login(db, token, user.get('email'), user.get('given_name'), user.get('family_name'))
 
 
 # log in with facebook
 
-CLIENT_ID = os.environ.get('facebook-id', None)
-CLIENT_SECRET = os.environ.get('facebook-secret', None)
-
-
-oauth.register(
-    name = 'facebook', 
-    client_id = CLIENT_ID,
-    client_secret = CLIENT_SECRET,
-    authorize_url="https://www.facebook.com/v20.0/dialog/oauth",
-    access_token_url="https://graph.facebook.com/v20.0/oauth/access_token",
-    api_base_url="https://graph.facebook.com/",
-    client_kwargs={"scope": "email"},
-) 
-
-
 @router.get("/login/facebook")
 async def login_fb(request: Request):
     redirect_uri = request.url_for("auth_fb")  
-    return await oauth.facebook.authorize_redirect(request, redirect_uri)
+    return await get_oauth_client('facebook').authorize_redirect(request, redirect_uri)
 
 
 @router.get('/auth/facebook', response_model = Token)
 async def auth_fb(request: Request, db: db_dependency):
-    try:
-        token = await oauth.facebook.authorize_access_token(request)
-    except OAuthError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    facebook = get_oauth_client('facebook')
+    token = await authorize_access_token(facebook, request)
 
     # Fetch user profile from Facebook Graph API
     # fields: add/remove as needed
-    resp = await oauth.facebook.get(
+    resp = await facebook.get(
         "me",
         token=token,
         params={"fields": "id, first_name, last_name ,email"},
@@ -188,68 +271,25 @@ async def auth_fb(request: Request, db: db_dependency):
             status_code=400,
             detail="Facebook did not return an email. Ensure 'email' permission is granted and the FB account has an email."
         )
-
-    exists_in_user_info = (
-        db.query(UserInfo).filter(UserInfo.email == email).first()
-    )
-
-    if not exists_in_user_info:
-        userinfo = UserInfo(
-            email=email,
-            first_name=user.get("first_name"),
-            last_name=user.get("last_name"),
-            profile_created=False,
-            token_=token
-        )
-        db.add(userinfo)
-        db.commit()
-        db.refresh(userinfo)
-        return {"access_token": token["access_token"], "token_type": "bearer"}
-
-    exists_in_family = db.query(Family).filter(Family.email == email).first()
-    if exists_in_family:
-        return {"access_token": token["access_token"], "token_type": "bearer"}
-
-    exists_in_user_info.profile_created = False
-    db.commit()
-    return {"access_token": token["access_token"], "token_type": "bearer"}
+    return await complete_oauth_login(db, token, email, user.get("first_name"), user.get("last_name"))
 
 
 # log in with yahoo
 
-CLIENT_ID = os.environ.get('yahoo-id', None)
-CLIENT_SECRET = os.environ.get('yahoo-secret', None)
-
-if not CLIENT_ID or not CLIENT_SECRET:
-    raise RuntimeError("Missing YAHOO_ID or YAHOO_SECRET")
-
-
-oauth.register(
-    name="yahoo",
-    server_metadata_url="https://api.login.yahoo.com/.well-known/openid-configuration",
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    client_kwargs={"scope": "openid email profile"}
-)
-
-
 @router.get("/login/yahoo")
 async def login_yh(request: Request):
+    yahoo = get_oauth_client('yahoo')
     redirect_uri = "https://somesite.com"   # temporary. yahoo only takes https for redirect url, so i could not route it to /auth/yahoo
-    print("YAHOO redirect_uri:", redirect_uri)
-    print("YAHOO client_id:", CLIENT_ID)
-    return await oauth.yahoo.authorize_redirect(request, redirect_uri)
+    return await yahoo.authorize_redirect(request, redirect_uri)
 
 
 @router.get('/auth/yahoo', response_model = Token)
 async def auth_yh(request: Request, db: db_dependency):
-    try:
-        token = await oauth.yahoo.authorize_access_token(request)
-    except OAuthError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    yahoo = get_oauth_client('yahoo')
+    token = await authorize_access_token(yahoo, request)
 
   
-    resp = await oauth.yahoo.get("userinfo", token=token)
+    resp = await yahoo.get("userinfo", token=token)
     user = resp.json()
 
     email = user.get("email")
@@ -258,40 +298,17 @@ async def auth_yh(request: Request, db: db_dependency):
             status_code=400,
             detail="yahoo did not return an email. Ensure 'email' permission is granted and the yahoo account has an email."
         )
-
-    exists_in_user_info = (
-        db.query(UserInfo).filter(UserInfo.email == email).first()
-    )
-
-    if not exists_in_user_info:
-        userinfo = UserInfo(
-            email=email,
-            first_name=user.get("given_name"),
-            last_name=user.get("family_name"),
-            profile_created=False,
-            token_=token
-        )
-        db.add(userinfo)
-        db.commit()
-        db.refresh(userinfo)
-        return {"access_token": token["access_token"], "token_type": "bearer"}
-
-    exists_in_family = db.query(Family).filter(Family.email == email).first()
-    if exists_in_family:
-        return {"access_token": token["access_token"], "token_type": "bearer"}
-
-    exists_in_user_info.profile_created = False
-    db.commit()
-    return {"access_token": token["access_token"], "token_type": "bearer"}
+    return await complete_oauth_login(db, token, email, user.get("given_name"), user.get("family_name"))
 
 
 # log in for token, non oauth
 @router.post("/token", response_model = Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
                                  db: db_dependency):
-    profile = authenticate_user(form_data.username, form_data.password, db)
+    profile = await authenticate_user(form_data.username, form_data.password, db)
     if not profile:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail='Could not validate credentials')
-    token = create_access_token(profile.email, profile.family_id, timedelta(minutes=20))
+    student_ids = await get_family_student_ids(profile.family_id, db)
+    token = create_access_token(profile.email, profile.family_id, timedelta(minutes=20), student_ids)
     return {'access_token': token, 'token_type': 'bearer'}
@@ -9,8 +9,9 @@ Description: Endpoints handling Family object creation, update, and getting.
 from fastapi import APIRouter,HTTPException, status
 from datetime import datetime
 from pydantic import BaseModel, Field
+from sqlalchemy import select
 from ..models import Family, VolunteerActivities, VolunteerActivityYear, FamilyYear     # Later include UserInfo to connect with OAuth
-from .auth import db_dependency, family_dependency
+from .auth import db_dependency, read_db_dependency, family_dependency
 
 
 router = APIRouter(
@@ -67,7 +68,7 @@ async def initial_family_signup(db: db_dependency, req: InitialFamilyRequest):
             detail="Passwords do not match"
         )
 
-    existing_profile = db.query(Family).filter(Family.email == req.email).first()
+    existing_profile = (await db.execute(select(Family).filter(Family.email == req.email))).scalars().first()
     if existing_profile:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -130,8 +131,8 @@ async def initial_family_signup(db: db_dependency, req: InitialFamilyRequest):
     )
 
     db.add(new_family)
-    db.commit()
-    db.refresh(new_family)
+    await db.commit()
+    await db.refresh(new_family)
     return {"family_id": new_family.family_id}
 
 # From profile.php lines 26-44, returns all fields of Family object
@@ -139,22 +140,22 @@ async def initial_family_signup(db: db_dependency, req: InitialFamilyRequest):
 async def get_family(family: family_dependency, db: db_dependency):
     if family is None:
         raise HTTPException(status_code=404, detail="Family not found")
-    return db.query(Family).filter(Family.family_id == family.get('family_id')).first()
+    return (await db.execute(select(Family).filter(Family.family_id == family.get('family_id')))).scalars().first()
 
 
 # From profile.php linles 59-65, returns Volunteer History
 @router.get("/profile/volunteer", status_code = status.HTTP_200_OK)
-async def get_family_volunteer(family: family_dependency, db: db_dependency):
+async def get_family_volunteer(family: family_dependency, db: read_db_dependency):
     if family is None:
         raise HTTPException(status_code=404, detail="Family not found")
-    volunteer_log = (db.query(VolunteerActivityYear, VolunteerActivityYear.year, VolunteerActivities.volunteer_id.label("code"), VolunteerActivities.name)
+    volunteer_log = (select(VolunteerActivityYear.year, VolunteerActivities.volunteer_id.label("code"), VolunteerActivities.name)
                     .join(VolunteerActivities, VolunteerActivities.volunteer_id == VolunteerActivityYear.volunteer_id)
                     .join(FamilyYear, FamilyYear.vay_id == VolunteerActivityYear.vay_id)
                     .filter(FamilyYear.family_id == family.get("family_id"))
                     .filter(FamilyYear.paid != 0)
     )
 
-    results = volunteer_log.all()
+    results = (await db.execute(volunteer_log)).all()
 
     final_log = []
     for row in results:
@@ -174,7 +175,7 @@ async def update_family_profile(db: db_dependency, family: family_dependency, pr
     if family is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
 
-    profile_model = db.query(Family).filter(Family.family_id == family.get('family_id')).first()
+    profile_model = (await db.execute(select(Family).filter(Family.family_id == family.get('family_id')))).scalars().first()
     if profile_model is None:
         raise HTTPException(status_code=404, detail="Not Found")
 
@@ -211,7 +212,7 @@ async def update_family_profile(db: db_dependency, family: family_dependency, pr
     profile_model.modified = now
 
     db.add(profile_model)
-    db.commit()
+    await db.commit()
 
 
 ''' Not needed anymore if not storing passwords
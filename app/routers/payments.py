@@ -6,11 +6,16 @@ Version: 1.0
 Description: Endpoints points handling Order viewing
 """
 
-from fastapi import APIRouter,HTTPException, status
-from datetime import datetime
-from sqlalchemy import func, desc, and_
-from ..models import Family, Order, OrderStudentClass, StudentClass, Student, Classes, VolunteerActivities, VolunteerActivityYear
-from .auth import db_dependency, family_dependency
+from fastapi import APIRouter,HTTPException, Request, status
+from datetime import datetime, date
+from sqlalchemy import select, func, desc, and_
+from ..models import Family, Order, OrderStudentClass, OrderSummary, StudentClass, Student, Classes, VolunteerActivities
+from .auth import db_dependency, read_db_dependency, family_dependency
+from ..serializers import compile_serializer, FastJSONResponse
+from ..etag import etag_matches, not_modified, with_etag
+from .. import pricing
+from ..pricing import cart_query, cart_version, price_cart, quote_etag
+from ..order_summary import class_count
 
 
 router = APIRouter(
@@ -18,40 +23,35 @@ router = APIRouter(
     tags = ['payments']
 )
 
+serialize_student_class = compile_serializer(StudentClass)
+serialize_order = compile_serializer(Order)
+
+# what the legacy checkout took off paid orders for every student after the first
+ORDER_SIBLING_DISCOUNT = 15
+
 
 # from checkout.php 53-72
 @router.get("/checkout", status_code = status.HTTP_200_OK)
-async def view_cart(db: db_dependency, family: family_dependency):
+async def view_cart(request: Request, db: db_dependency, family: family_dependency):
     current_year = datetime.now().year
 
-    cart = (
-        db.query(
-            Family.verified.label("verified"),
-            Student.first_name.label("first_name"),
-            Student.last_name.label("last_name"),
-            Student.chinese_name.label("chinese_name"),
-            StudentClass,  
-            Classes.class_id.label("class_id"),
-            Classes.title.label("title"),
-            Classes.chinese_title.label("chinese_title"),
-        )
-        .select_from(Family)
-        .join(Student, Student.family_id == Family.family_id)
-        .join(
-            StudentClass,
-            and_(
-                StudentClass.student_id == Student.student_id,
-                StudentClass.paid == 0,
-                StudentClass.wait == 0,
-                StudentClass.year == current_year,
-            ),
-        )
-        .join(Classes, Classes.class_id == StudentClass.class_id)
-        .filter(Family.family_id == family.get("family_id"))
-        .order_by(Student.dob, StudentClass.class_id)
-    )
+    etag = await cart_version(db, family.get("family_id"), current_year)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    cart = cart_query(
+        family.get("family_id"), current_year,
+        Family.verified.label("verified"),
+        Student.first_name.label("first_name"),
+        Student.last_name.label("last_name"),
+        Student.chinese_name.label("chinese_name"),
+        StudentClass,  
+        Classes.class_id.label("class_id"),
+        Classes.title.label("title"),
+        Classes.chinese_title.label("chinese_title"),
+    ).order_by(Student.dob, StudentClass.class_id)
 
-    results = cart.all()
+    results = (await db.execute(cart)).all()
 
     final_data = []
 
@@ -66,10 +66,7 @@ async def view_cart(db: db_dependency, family: family_dependency):
         chinese_title,
     ) in results:
 
-        item = {
-            c.name: getattr(sc_obj, c.name)
-            for c in sc_obj.__table__.columns
-        }
+        item = serialize_student_class(sc_obj)
 
         item.update({
             "verified": verified,
@@ -83,36 +80,52 @@ async def view_cart(db: db_dependency, family: family_dependency):
 
         final_data.append(item)
 
-    return final_data
+    return with_etag(FastJSONResponse(final_data), etag)
+
+
+# Price of the cart from checkout: a line per student and class category, then the discounts and fees
+@router.get("/checkout/total", status_code = status.HTTP_200_OK)
+async def view_cart_total(request: Request, db: db_dependency, family: family_dependency):
+    if not pricing.pricing_rules.configured:
+        raise HTTPException(status_code=503, detail="Class prices are not configured")
+    current_year = datetime.now().year
+
+    version = await cart_version(db, family.get("family_id"), current_year)
+    etag = quote_etag(version, date.today())
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    quote = await price_cart(db, family.get("family_id"), current_year, version)
+    return with_etag(FastJSONResponse(quote), etag)
 
 
 # From payments.php lines 30-39, returns 10 fields, 5 of which are displayed by front-end
 @router.get("/payments", status_code = status.HTTP_200_OK)
-async def view_payments(db: db_dependency, family: family_dependency):
+async def view_payments(db: read_db_dependency, family: family_dependency):
     order_query = (
-        db.query(Order, func.count(OrderStudentClass.osc_id).label("number_of_classes"))
-        .outerjoin(OrderStudentClass, Order.order_id == OrderStudentClass.order_id)
+        # an order without a summary row yet is counted directly rather than shown as empty
+        select(Order, func.coalesce(OrderSummary.number_of_classes, class_count(Order.order_id)).label("number_of_classes"))
+        .outerjoin(OrderSummary, Order.order_id == OrderSummary.order_id)
         .filter(Order.family_id == family.get('family_id'))
         .filter(Order.paid.isnot(False))   
-        .group_by(Order.order_id)
         .order_by(Order.paid)
-        .all()
     )
+    order_query = (await db.execute(order_query)).all()
 
-    return [
+    return FastJSONResponse([
         {
-            **{c.key: getattr(order, c.key) for c in order.__table__.columns},
+            **serialize_order(order),
             "number_of_classes": int(class_count),
         }
         for order, class_count in order_query
-    ]
+    ])
 
 
 # From view_order.php lines 30-42, returns 16 fields, 9 of which are displayed by front-end
 @router.get("/payments/view_order_details/{order_id}")
-async def view_order_details(db: db_dependency, family: family_dependency, order_id: int):
+async def view_order_details(db: read_db_dependency, family: family_dependency, order_id: int):
     order_query = (
-        db.query(Order, func.count(OrderStudentClass.osc_id).label('number_of_classes'), 
+        select(Order, func.count(OrderStudentClass.osc_id).label('number_of_classes'), 
                 Family.family_id, Family.father_fname, Family.father_lname, Family.mother_fname,
                 Family.mother_lname, Family.father_cname, Family.mother_cname)
         .select_from(Order)
@@ -121,66 +134,60 @@ async def view_order_details(db: db_dependency, family: family_dependency, order
         .filter(Order.order_id == order_id)
         .filter(Order.family_id == family.get('family_id'))
         .filter(Order.paid.isnot(None))
-        .group_by(Order.order_id)
-        .first())
+        .group_by(Order.order_id))
+    order_query = (await db.execute(order_query)).first()
 
     if not order_query:
         raise HTTPException(status_code=404, detail="Order not found")
     
     order, number_of_classes, fam_id, father_fname, father_lname, mother_fname, mother_lname, father_cname, mother_cname = order_query
 
-    return {
-        **{c.key: getattr(order, c.key) for c in order.__table__.columns},
+    return FastJSONResponse({
+        **serialize_order(order),
         "number_of_classes": int(number_of_classes), "family_id": fam_id, "father_fname": father_fname,
         "father_lname": father_lname, "mother_fname": mother_fname, "mother_lname": mother_lname,
         "father_cname": father_cname, "mother_cname": mother_cname
-    }
+    })
 
 
 # from view_order.php lines 60-124, returns table with details on every class/product/volunteer/discount in the order
 @router.get("/payments/view_order_classes/{order_id}")
-async def view_order_classes(db: db_dependency, family: family_dependency, order_id: int):
+async def view_order_classes(db: read_db_dependency, family: family_dependency, order_id: int):
+    # volunteer lines have no student, their class_id holds the volunteer_id instead
     order_query = (
-        db.query(Order.created,
+        select(Order.created,
                 Student.student_id, 
                 Student.first_name, 
                 Student.last_name, 
                 Student.chinese_name, 
+                StudentClass.student_id.label("sc_student_id"),
                 StudentClass.class_id, 
                 StudentClass.paid_price, 
                 Classes.title, 
-                Classes.chinese_title)
+                Classes.chinese_title,
+                VolunteerActivities.name.label("volunteer_title"))
         .select_from(Order)
         .join(OrderStudentClass, (OrderStudentClass.order_id == Order.order_id))
         .join(StudentClass, StudentClass.sc_id == OrderStudentClass.sc_id)
         .outerjoin(Student, Student.student_id == StudentClass.student_id)
         .outerjoin(Classes, Classes.class_id == StudentClass.class_id)
+        .outerjoin(VolunteerActivities, and_(Student.student_id.is_(None),
+                                             VolunteerActivities.volunteer_id == StudentClass.class_id))
         .filter(Order.order_id == order_id)
         .filter(Order.family_id == family.get('family_id'))
         .filter(Order.paid != 0)
         .order_by(desc(Student.dob), StudentClass.sc_id)
     )
 
-    if not order_query:
-        raise HTTPException(status_code=404, detail="No classes found for this order")
-
-    results = order_query.all()
+    results = (await db.execute(order_query)).all()
 
     # goes through every row, if it is a volunteer log (class_id == 0), then replaces row
     total = 0
     final_data = []
+    students = set()
     for row in results:
     
         if row.student_id == None: 
-            # get volunteer activity
-            vol_query = (db.query(VolunteerActivities.name.label("title"))
-                .join(
-                    VolunteerActivityYear,
-                    VolunteerActivityYear.volunteer_id == VolunteerActivities.volunteer_id
-                )
-                .filter(VolunteerActivityYear.volunteer_id == row.class_id)
-                .first())    
-
             item = {
                 "created": row.created,
                 "student_id": row.student_id,
@@ -188,7 +195,7 @@ async def view_order_classes(db: db_dependency, family: family_dependency, order
                 "chinese_name": row.chinese_name,
                 "class_id": row.class_id,
                 "paid_price": str(row.paid_price), # Convert Decimal to string for JSON if needed
-                "title": vol_query.title,
+                "title": row.volunteer_title,
                 "chinese_title": row.chinese_title
             }
 
@@ -208,19 +215,15 @@ async def view_order_classes(db: db_dependency, family: family_dependency, order
     
             final_data.append(item)
 
+        if row.sc_student_id and row.sc_student_id > 0:
+            students.add(row.sc_student_id)
         total += row.paid_price
 
-    # sibling discount   
-    student_count = (
-                db.query(func.count(func.distinct(StudentClass.student_id)))
-                .join(OrderStudentClass, OrderStudentClass.sc_id == StudentClass.sc_id)
-                .filter(OrderStudentClass.order_id == order_id)
-                .filter(StudentClass.student_id > 0)
-                .scalar()
-            )
-    
-    if student_count > 1:
-            discount = (student_count - 1) * -15
+    # sibling discount at the amount the legacy checkout charged, a receipt is never repriced
+    # with the rules loaded today
+    student_count = len(students)
+    discount = (student_count - 1) * -ORDER_SIBLING_DISCOUNT if student_count > 1 else 0
+    if discount:
             total += discount 
             item = {
                 "name": "Sibling Discount", 
@@ -6,13 +6,21 @@ Version: 1.0
 Description: Endpoints points handling student registration, current class viewing
 """
 
-from fastapi import APIRouter, HTTPException, status
-from sqlalchemy.orm import Session 
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 from pydantic import BaseModel
-from ..models import Student, StudentClass, CurrentClasses
-from .auth import db_dependency, family_dependency
-from sqlalchemy import func, case
+from collections import Counter
+from ..models import Student, StudentClass
+from .auth import db_dependency, read_db_dependency, family_dependency, get_family_student
+from ..enrollment import reserve_seat, release_seats, promote_waitlist, hold_deadline
+from .. import admission, seats
+from ..catalog import catalog_cache
+from ..serializers import FastJSONResponse
+from ..etag import make_etag, etag_matches, not_modified, with_etag
+from sqlalchemy import select, func, insert, delete
 
 
 router = APIRouter(
@@ -20,10 +28,24 @@ router = APIRouter(
     tags = ['register']
 )
 
+# catalog page order of the class categories
+LC_CATEGORIES = ['LC', 'CSL', 'AC', 'SP-FULL','SP-HALF','SP-EC','BOOK', 'SP-lang', 'SP-AC']
+EP_CATEGORIES = ['EP','EP-AM', 'SP-EP']
+
+
 class StudentRegisterRequest(BaseModel):
     class_id: int
 
 
+class StudentCartRequest(BaseModel):
+    student_id: int
+    class_ids: list[int]
+
+
+class CartSyncRequest(BaseModel):
+    students: list[StudentCartRequest]
+
+
 def verify_student(student: Student):
     if not student: raise HTTPException(status_code=404, detail="Student not in your family")
 
@@ -39,81 +61,153 @@ def verify_student(student: Student):
         raise HTTPException(status_code=401, detail='Authentication Failed')
 
 
-async def read_classes_by_category(category_order: list, student_id: int, db: Session):
+async def read_classes_by_category(request: Request, category_order: list, student_id: int, db: AsyncSession, read_db: AsyncSession):
+    # the catalog comes from the replica, the student's own selections from the primary
     current_year = datetime.now().year
-    category_rank = case(
-        {cat: i for i, cat in enumerate(category_order)},
-        value=CurrentClasses.category,
-        else_=len(category_order)
+    catalog = await catalog_cache.get(read_db, current_year, category_order)
+
+    selected = await db.execute(
+        select(StudentClass.class_id, func.count(StudentClass.sc_id))
+        .filter(StudentClass.student_id == student_id)
+        .filter(StudentClass.year == current_year)
+        .filter((StudentClass.paid == 0) | (StudentClass.paid.is_(None)))
+        .group_by(StudentClass.class_id)
     )
+    selected = dict(selected.all())
 
-    class_query = (
-        db.query(
-            CurrentClasses,
-            func.count(StudentClass.student_id).label("is_selected")
-        )
-        .outerjoin(StudentClass, 
-            (StudentClass.class_id == CurrentClasses.class_id) &
-            (StudentClass.student_id == student_id) &
-            (StudentClass.year == current_year) &
-            ((StudentClass.paid == 0) | (StudentClass.paid.is_(None)))
-        )
-        .filter(CurrentClasses.category.in_(category_order))
-        .group_by(CurrentClasses.class_id)
-        .order_by(category_rank, CurrentClasses.weight)
-    )
-
-    results = class_query.all()
+    # the page is the cached catalog plus these counts, so together they version it
+    etag = make_etag(catalog_cache.etag(current_year, category_order, catalog), sorted(selected.items()))
+    if etag_matches(request, etag):
+        return not_modified(etag)
 
-    final_data = []
-    for class_obj, count in results:
-        item = {c.name: getattr(class_obj, c.name) for c in class_obj.__table__.columns}
-        item["class_selected"] = count
-        final_data.append(item) 
+    return with_etag(FastJSONResponse([{**item, "class_selected": selected.get(item["class_id"], 0)} for item in catalog]), etag)
 
 
-    return final_data
-
 # From select_classes.php lines 69-76
-@router.get("/{student_id}/read_current_LC_classes", status_code = status.HTTP_200_OK)
-async def read_current_LC_classes(student_id: int, db: db_dependency, family: family_dependency):
-    student = db.query(Student).filter(Student.student_id == student_id, Student.family_id == family.get('family_id')).first()
+@router.get("/{student_id}/read_current_LC_classes", status_code = status.HTTP_200_OK, dependencies = [Depends(admission.admit)])
+async def read_current_LC_classes(request: Request, student_id: int, db: db_dependency, read_db: read_db_dependency, family: family_dependency):
+    student = await get_family_student(family, student_id, db)
     verify_student(student)
-    category_order = ['LC', 'CSL', 'AC', 'SP-FULL','SP-HALF','SP-EC','BOOK', 'SP-lang', 'SP-AC']
-    return await read_classes_by_category(category_order, student_id, db)
+    return await read_classes_by_category(request, LC_CATEGORIES, student_id, db, read_db)
     
     
 # From select_classes2.php lines 82-88    
-@router.get("/{student_id}/read_current_EP_classes", status_code = status.HTTP_200_OK)
-async def read_current_EP_classes(student_id: int, db: db_dependency, family: family_dependency):
-    student = db.query(Student).filter(Student.student_id == student_id, Student.family_id == family.get('family_id')).first()
+@router.get("/{student_id}/read_current_EP_classes", status_code = status.HTTP_200_OK, dependencies = [Depends(admission.admit)])
+async def read_current_EP_classes(request: Request, student_id: int, db: db_dependency, read_db: read_db_dependency, family: family_dependency):
+    student = await get_family_student(family, student_id, db)
     verify_student(student)
-    category_order = category_order = ['EP','EP-AM', 'SP-EP']
-    return await read_classes_by_category(category_order, student_id, db)   
+    return await read_classes_by_category(request, EP_CATEGORIES, student_id, db, read_db)   
 
 
 # From select_classes.php 
-# Simply asks for class_id and adds to StudentClass
+# Asks for class_id, reserves a seat and adds to StudentClass. Full classes are added to the waitlist (wait = 1)
 # Endpoint used by with frontend checkboxes. Frontend sends the class as input. Frontend ensures there are no duplicated
-@router.post("/{student_id}/select_classes", status_code = status.HTTP_201_CREATED)
+@router.post("/{student_id}/select_classes", status_code = status.HTTP_201_CREATED, dependencies = [Depends(admission.admit)])
 async def select_classes(student_id: int, db: db_dependency, family: family_dependency, register: StudentRegisterRequest):
-    student = db.query(Student).filter(Student.student_id == student_id, Student.family_id == family.get('family_id')).first()
+    student = await get_family_student(family, student_id, db)
     verify_student(student)
     
     current_year = datetime.now().year
     now = datetime.now()
+
+    has_seat = await reserve_seat(db, current_year, register.class_id)
     
     class_list = StudentClass(
         year = current_year,
         student_id = student_id,
         class_id = register.class_id, # user input
-        wait = 0,        
+        wait = 0 if has_seat else 1,
         paid = 0,      
         created = now,
-        removed = now  # fix: use datetime, not 0
+        removed = hold_deadline(now) if has_seat else now  # a seat is held unpaid until then, the waitlist holds none
     )
 
     db.add(class_list)
-    db.commit()
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Class already selected")
+    return {"class_id": register.class_id, "wait": not has_seat}
+
+
+# Replaces the per-checkbox select_classes calls. Frontend sends the full set of classes wanted for each student,
+# unpaid selections not in the set are removed and new ones are added, all in one transaction
+@router.put("/cart", status_code = status.HTTP_200_OK, dependencies = [Depends(admission.admit)])
+async def sync_cart(db: db_dependency, family: family_dependency, cart: CartSyncRequest):
+    desired = {item.student_id: set(item.class_ids) for item in cart.students}
+
+    # ownership comes from the token claims when it carries them, as in get_family_student
+    student_ids = family.get('student_ids')
+    if student_ids is not None:
+        for student_id in desired:
+            if student_id not in student_ids:
+                verify_student(None)
+        owned = Student.student_id.in_(desired)
+    else:
+        owned = Student.student_id.in_(desired) & (Student.family_id == family.get('family_id'))
+
+    # the rows are still loaded, verify_student checks each profile is complete
+    students = (await db.execute(select(Student).filter(owned))).scalars().all()
+    students = {student.student_id: student for student in students}
+    for student_id in desired:
+        verify_student(students.get(student_id))
 
+    current_year = datetime.now().year
+    now = datetime.now()
 
+    current = (await db.execute(
+        select(StudentClass.sc_id, StudentClass.student_id, StudentClass.class_id, StudentClass.wait, StudentClass.paid)
+        .filter(StudentClass.student_id.in_(desired))
+        .filter(StudentClass.year == current_year)
+    )).all()
+
+    existing = {(row.student_id, row.class_id) for row in current}
+    removed = [row for row in current if not row.paid and row.class_id not in desired[row.student_id]]
+    added = sorted((student_id, class_id) for student_id, class_ids in desired.items()
+                   for class_id in class_ids if (student_id, class_id) not in existing)
+
+    if removed:
+        await db.execute(delete(StudentClass).filter(StudentClass.sc_id.in_([row.sc_id for row in removed])))
+        freed = Counter(row.class_id for row in removed if not row.wait)
+        await release_seats(db, current_year, freed)
+        # the waitlist gets freed seats before this cart's own additions are seated
+        await promote_waitlist(db, current_year, freed)
+
+    new_rows = []
+    for student_id, class_id in added:
+        has_seat = await reserve_seat(db, current_year, class_id)
+        new_rows.append({"year": current_year, "student_id": student_id, "class_id": class_id,
+                         "wait": 0 if has_seat else 1, "paid": 0, "created": now, "removed": hold_deadline(now) if has_seat else now})
+    try:
+        if new_rows:
+            await db.execute(insert(StudentClass), new_rows)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Cart changed while saving, try again")
+
+    return {
+        "added": [{"student_id": row["student_id"], "class_id": row["class_id"], "wait": bool(row["wait"])} for row in new_rows],
+        "removed": [{"student_id": row.student_id, "class_id": row.class_id} for row in removed]
+    }
+
+
+# Lets a family in the waiting room poll its place in line without using up its request budget
+@router.get("/waiting_room", status_code = status.HTTP_200_OK)
+async def read_waiting_room(family: family_dependency):
+    queue = await admission.admission_backend.queue_position(family.get('family_id'))
+    if queue is None:
+        return {"open": False, "queue_position": 0, "retry_after": 0}
+    return {"open": True, "queue_position": queue[0], "retry_after": queue[1]}
+
+
+# Replaces polling the catalog for seat counts. Server-sent events: a snapshot of the remaining seats
+# of every current class, then only the classes whose count changed, pushed as enrollment commits
+@router.get("/seats/stream", status_code = status.HTTP_200_OK)
+async def stream_seats(db: db_dependency, family: family_dependency):
+    return StreamingResponse(
+        seats.seat_events(seats.seat_hub, db, datetime.now().year),
+        media_type = "text/event-stream",
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
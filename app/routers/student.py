@@ -6,12 +6,14 @@ Version: 1.0
 Description: Endpoints handling Student object creation, update, and getting.
 """
 
-from fastapi import APIRouter, HTTPException, status
-from sqlalchemy import desc
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Request, status
+from sqlalchemy import select, desc, func
+from datetime import datetime, timedelta
 from pydantic import BaseModel
 from ..models import Student, StudentClass, Classes
-from .auth import db_dependency, family_dependency
+from .auth import db_dependency, read_db_dependency, family_dependency, create_access_token, get_family_student, check_student_owner, get_family_student_ids
+from ..etag import make_etag, etag_matches, not_modified, with_etag
+from ..serializers import FastJSONResponse
 
 
 router = APIRouter(
@@ -40,7 +42,7 @@ class CreateStudentRequest(BaseModel):
 async def get_students_by_family(family: family_dependency, db: db_dependency):
     if family is None:
         raise HTTPException(status_code=404, detail="Family not found")
-    return db.query(Student).filter(Student.family_id == family.get('family_id')).order_by(Student.dob).all()
+    return (await db.execute(select(Student).filter(Student.family_id == family.get('family_id')).order_by(Student.dob))).scalars().all()
 
 
 # From add_student.php
@@ -72,18 +74,23 @@ async def create_child(db: db_dependency, family: family_dependency, child_reque
     
 
     db.add(child_model)
-    db.commit()
+    await db.commit()
+
+    # reissue the token so its student claims include the new child
+    student_ids = family.get('student_ids')
+    if student_ids is None:
+        student_ids = await get_family_student_ids(family.get('family_id'), db)
+    else:
+        student_ids = [*student_ids, child_model.student_id]
+    token = create_access_token(family.get('email'), family.get('family_id'), timedelta(minutes=20), student_ids)
+    return {'student_id': child_model.student_id, 'access_token': token, 'token_type': 'bearer'}
 
 # From edit_student.php lines 28-63
 @router.put("/student/{student_id}", status_code = status.HTTP_200_OK)
 async def update_student_profile(db: db_dependency, student_id: int, child_request: CreateStudentRequest, family: family_dependency):
-    student = db.query(Student).filter(Student.student_id == student_id, Student.family_id == family.get('family_id')).first()
-    if student is None:
-        raise HTTPException(status_code=401, detail='Authentication Failed')
-
-    profile_model = db.query(Student).filter(Student.student_id == student_id).first()
+    profile_model = await get_family_student(family, student_id, db)
     if profile_model is None:
-        raise HTTPException(status_code=404, detail="Not Found")
+        raise HTTPException(status_code=401, detail='Authentication Failed')
 
     profile_model.first_name = child_request.first_name
     profile_model.last_name = child_request.last_name
@@ -98,26 +105,60 @@ async def update_student_profile(db: db_dependency, student_id: int, child_reque
     profile_model.ins_company = child_request.ins_company
     profile_model.ins_policy = child_request.ins_policy
     profile_model.email = child_request.email
+    profile_model.modified = datetime.utcnow()
 
     db.add(profile_model)
-    db.commit()
+    await db.commit()
 
 
-# From edit_student.php lines 65-70
-@router.get("/student/{student_id}/registration_history", status_code = status.HTTP_200_OK)
-async def view_student_history(db: db_dependency, student_id: int, family: family_dependency):
-    student = db.query(Student).filter(Student.student_id == student_id, Student.family_id == family.get('family_id')).first()
-    if student is None:
-        raise HTTPException(status_code=401, detail='Authentication Failed')
-    
-    history = (
-        db.query(StudentClass, StudentClass.year, Classes.class_code, Classes.title, Classes.chinese_title)
+def student_history(student_id: int, *columns):
+    """The student's paid selections joined to their classes"""
+    return (
+        select(*columns)
+        .select_from(StudentClass)
         .join(Classes, Classes.class_id == StudentClass.class_id)
         .filter(StudentClass.student_id == student_id)
         .filter(StudentClass.paid != 0)
     )
 
-    results = history.all()
+
+# versions the history: rows come and go by sc_id, move by class_id or year, and class edits bump modified
+HISTORY_VERSION = (
+    func.count(StudentClass.sc_id),
+    func.sum(StudentClass.sc_id),
+    func.sum(StudentClass.class_id),
+    func.sum(StudentClass.year),
+    func.max(Classes.modified),
+)
+
+
+def history_version(rows: list) -> tuple:
+    """HISTORY_VERSION computed from rows already loaded, so a 200 needs no second query"""
+    if not rows:
+        return (0, None, None, None, None)
+    return (len(rows), sum(row.sc_id for row in rows), sum(row.class_id for row in rows),
+            sum(row.year for row in rows), max(row.modified for row in rows))
+
+
+# From edit_student.php lines 65-70
+@router.get("/student/{student_id}/registration_history", status_code = status.HTTP_200_OK)
+async def view_student_history(request: Request, db: db_dependency, read_db: read_db_dependency, student_id: int, family: family_dependency):
+    # ownership is checked on the primary so a just-added student is not refused while the replica catches up
+    if not await check_student_owner(family, student_id, db):
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    
+    # a refresh is answered from one aggregate over the rows, the history itself is only read for a 200
+    if request.headers.get("if-none-match"):
+        etag = make_etag(*(await read_db.execute(student_history(student_id, *HISTORY_VERSION))).one())
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
+    results = (await read_db.execute(student_history(
+        student_id, StudentClass.sc_id, StudentClass.class_id, StudentClass.year, Classes.modified,
+        Classes.class_code, Classes.title, Classes.chinese_title,
+    ))).all()
+    etag = make_etag(*history_version(results))
+
     final_history = []
     for row in results:
         item = {
@@ -128,5 +169,5 @@ async def view_student_history(db: db_dependency, student_id: int, family: famil
         }
         final_history.append(item)
 
-    return final_history
+    return with_etag(FastJSONResponse(final_history), etag)
 
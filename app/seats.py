@@ -0,0 +1,222 @@
+"""
+Filename: seats.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Live seat availability, an in-process hub that enrollment writes publish to and
+             that pushes remaining-seat changes to server-sent-event subscribers
+
+Configured from the environment:
+    SEAT_PUSH_INTERVAL      seconds changes are gathered before one push goes out (0.5)
+    SEAT_PUSH_KEEPALIVE     seconds of quiet before a comment line keeps the connection open (15)
+    SEAT_PUSH_QUEUE         messages a slow subscriber may fall behind before it is resynced (32)
+    SEAT_RESYNC_INTERVAL    seconds between full re-reads of the year's seats while anyone is subscribed (5)
+"""
+
+import asyncio
+import logging
+import os
+from sqlalchemy import event, select, func
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from .database import SessionLocal
+from .metrics import Counter, Gauge, collector
+from .models import Classes, ClassSeats, CurrentClasses
+from .serializers import dumps
+
+logger = logging.getLogger(__name__)
+
+SEAT_PUSH_INTERVAL = float(os.environ.get('SEAT_PUSH_INTERVAL', '0.5'))
+SEAT_PUSH_KEEPALIVE = float(os.environ.get('SEAT_PUSH_KEEPALIVE', '15'))
+SEAT_PUSH_QUEUE = int(os.environ.get('SEAT_PUSH_QUEUE', '32'))
+SEAT_RESYNC_INTERVAL = float(os.environ.get('SEAT_RESYNC_INTERVAL', '5'))
+
+seat_pushes = Counter("seat_pushes_total", "Seat change messages built, each sent to every subscriber")
+seat_resyncs = Counter("seat_resyncs_total", "Subscribers that fell behind and were sent a fresh snapshot")
+
+
+def sse(event_name: str, seq: int, seats: dict) -> bytes:
+    data = dumps({str(class_id): remaining for class_id, remaining in seats.items()})
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (seq, event_name.encode(), data)
+
+
+class SeatHub:
+    """
+    Holds the remaining seats of every current class while anyone is subscribed. Publishing only
+    marks classes dirty; every SEAT_PUSH_INTERVAL the dirty classes are read back in one query and
+    the ones that changed go out as one message, encoded once and queued to every subscriber. A
+    subscriber whose queue is full gets the whole snapshot instead of the messages it missed.
+
+    Only this worker's commits are published. Counter changes made by other workers or the
+    enrollment CLI are caught by re-reading every class of the year each SEAT_RESYNC_INTERVAL and
+    pushing the differences, one query per interval however many are subscribed. Seats are read
+    from class_seats, so selections or capacities edited straight in the database only show once
+    reconcile_seats() has recounted the counters (python -m app.enrollment promote|reconcile).
+    With nobody subscribed nothing is read and the snapshot is dropped, so the next subscriber
+    loads a fresh one.
+    """
+
+    def __init__(self, session_factory = SessionLocal, interval: float = None, resync_interval: float = None):
+        self.session_factory = session_factory
+        self.interval = SEAT_PUSH_INTERVAL if interval is None else interval
+        self.resync_interval = SEAT_RESYNC_INTERVAL if resync_interval is None else resync_interval
+        self.subscribers = set()
+        self.year = None
+        self.seats = None
+        self.seq = 0
+        self._dirty = set()
+        self._flush_task = None
+        self._resync_task = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    async def _read_all(db: AsyncSession, year: int) -> dict:
+        rows = await db.execute(
+            select(CurrentClasses.class_id,
+                   func.coalesce(ClassSeats.seats_x - ClassSeats.taken, Classes.seats_x))
+            .join(Classes, Classes.class_id == CurrentClasses.class_id)
+            .outerjoin(ClassSeats, (ClassSeats.class_id == CurrentClasses.class_id) & (ClassSeats.year == year))
+            .filter(CurrentClasses.year == year)
+        )
+        return dict(rows.all())
+
+    async def load(self, db: AsyncSession, year: int) -> dict:
+        """Remaining seats of the year's current classes, queried once and then kept up to date"""
+        async with self._lock:
+            if self.seats is None or self.year != year:
+                self.year, self.seats = year, await self._read_all(db, year)
+            return self.seats
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize = SEAT_PUSH_QUEUE)
+        self.subscribers.add(queue)
+        if self._resync_task is None:
+            self._resync_task = asyncio.get_running_loop().create_task(self._resync_forever())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            self.seats = None
+            if self._resync_task is not None:
+                self._resync_task.cancel()
+                self._resync_task = None
+
+    async def _resync_forever(self):
+        while True:
+            await asyncio.sleep(self.resync_interval)
+            try:
+                await self.resync()
+            except Exception:
+                logger.exception("seat resync failed")
+
+    async def resync(self):
+        """Re-reads every class of the year and pushes the ones that differ from the snapshot"""
+        if self.seats is None:
+            return
+        year = self.year
+        async with self.session_factory() as db:
+            current = await self._read_all(db, year)
+        if self.seats is None or self.year != year:
+            return
+        self._push({class_id: remaining for class_id, remaining in current.items()
+                    if self.seats.get(class_id) != remaining})
+
+    def snapshot(self) -> bytes:
+        return sse("snapshot", self.seq, self.seats or {})
+
+    def publish(self, year: int, class_ids):
+        if not self.subscribers or year != self.year:
+            return
+        self._dirty.update(class_ids)
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+        finally:
+            self._flush_task = None
+
+    async def flush(self):
+        dirty, self._dirty = self._dirty, set()
+        if not dirty or self.seats is None:
+            return
+        async with self.session_factory() as db:
+            rows = await db.execute(
+                select(ClassSeats.class_id, ClassSeats.seats_x - ClassSeats.taken)
+                .filter(ClassSeats.year == self.year, ClassSeats.class_id.in_(dirty))
+            )
+        seats = self.seats
+        if seats is None:
+            return
+        self._push({class_id: remaining for class_id, remaining in rows.all()
+                    if class_id in seats and seats[class_id] != remaining})
+
+    def _push(self, changes: dict):
+        if not changes:
+            return
+        self.seats.update(changes)
+        self.seq += 1
+        message = sse("seats", self.seq, changes)
+        seat_pushes.inc()
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.snapshot())
+                seat_resyncs.inc()
+
+
+seat_hub = SeatHub()
+
+
+def set_hub(hub: SeatHub):
+    global seat_hub
+    seat_hub = hub
+
+
+@collector
+def seat_metrics():
+    subscribers = Gauge("seat_subscribers", "Connected seat availability streams")
+    subscribers.set(value = len(seat_hub.subscribers))
+    return seat_pushes.render() + seat_resyncs.render() + subscribers.render()
+
+
+def seats_changed(db: AsyncSession, year: int, class_ids):
+    """Called by enrollment writes, the classes are published once the transaction commits"""
+    changed = db.info.setdefault("seats_changed", {})
+    changed.setdefault(year, set()).update(class_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed(session: Session):
+    changed = session.info.pop("seats_changed", None)
+    if changed:
+        for year, class_ids in changed.items():
+            seat_hub.publish(year, class_ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session: Session):
+    session.info.pop("seats_changed", None)
+
+
+async def seat_events(hub: SeatHub, db: AsyncSession, year: int):
+    """Server-sent events for one subscriber, the current snapshot first and then the changes"""
+    queue = hub.subscribe()
+    try:
+        await hub.load(db, year)
+        # the request's session is not needed again, give its connection back to the pool
+        await db.close()
+        yield b"retry: 3000\n" + hub.snapshot()
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), SEAT_PUSH_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+    finally:
+        hub.unsubscribe(queue)
@@ -0,0 +1,97 @@
+"""
+Filename: serializers.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Row to dict serializers compiled once per model, and the JSON response class used by the routers
+"""
+
+import json
+from contextvars import ContextVar
+from datetime import date, datetime, time
+from decimal import Decimal
+from operator import attrgetter
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:     # optional, falls back to the standard library encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:     # optional, without it every client gets JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# set per request by EncodingMiddleware when the client's Accept header prefers MessagePack
+use_msgpack = ContextVar("use_msgpack", default=False)
+
+
+def compile_serializer(model, exclude: tuple = ()):
+    """
+    Returns a function that turns an instance of model into a dict of its columns. The column
+    keys and the attribute getter are worked out here once instead of walking
+    __table__.columns for every row.
+    """
+    keys = tuple(c.key for c in model.__table__.columns if c.key not in exclude)
+    getter = attrgetter(*keys)
+
+    if len(keys) == 1:
+        return lambda obj: {keys[0]: getter(obj)}
+    return lambda obj: dict(zip(keys, getter(obj)))
+
+
+def json_default(value):
+    # same output as FastAPI's jsonable_encoder for the types our tables hold
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def accepts_msgpack(accept: str) -> bool:
+    """True when MessagePack is installed and the Accept header ranks it above JSON"""
+    if msgpack is None or not accept:
+        return False
+    ranks = {}
+    for part in accept.split(","):
+        media_type, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranks[media_type.strip().lower()] = q
+    packed = max(ranks.get(MSGPACK_MEDIA_TYPE, 0.0), ranks.get("application/x-msgpack", 0.0))
+    return packed > 0 and packed >= ranks.get("application/json", 0.0)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Encodes plain dicts and lists straight to JSON. Returning one from a handler skips
+    FastAPI's generic jsonable_encoder pass over the payload. Clients asking for
+    application/msgpack get the same content as MessagePack.
+    """
+
+    def render(self, content) -> bytes:
+        if use_msgpack.get():
+            self.media_type = MSGPACK_MEDIA_TYPE
+            return msgpack.packb(content, default = json_default, use_bin_type = True)
+        return dumps(content)
+
+    def init_headers(self, headers = None):
+        super().init_headers(headers)
+        if msgpack is not None:
+            self.headers.append("Vary", "Accept")
@@ -0,0 +1,134 @@
+"""
+Filename: bench_async_db.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Compares concurrent throughput of a blocking Session inside an async handler
+             (how the routers used to work) with the AsyncSession now used by db_dependency.
+
+Usage: python -m benchmarks.bench_async_db [--requests 200] [--concurrency 50]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+
+# stands in for a slow MySQL query: the connection waits on the "server" without holding the GIL
+SLOW_QUERY = text("SELECT server_wait(:ms)")
+
+
+def register_server_wait(dbapi_connection, connection_record):
+    def server_wait(ms):
+        time.sleep(ms / 1000)
+        return ms
+    dbapi_connection.create_function("server_wait", 1, server_wait)
+
+
+def build_sync_app(path: str, ms: int) -> FastAPI:
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}, pool_size=64)
+    event.listen(engine, "connect", register_server_wait)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False)
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = FastAPI()
+
+    @app.get("/slow")
+    async def slow(db: Session = Depends(get_db)):
+        return {"count": db.execute(SLOW_QUERY, {"ms": ms}).scalar()}
+
+    return app
+
+
+def build_async_app(path: str, ms: int) -> FastAPI:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", connect_args={"check_same_thread": False}, pool_size=64)
+    event.listen(engine.sync_engine, "connect", register_server_wait)
+    SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    async def get_db():
+        async with SessionLocal() as db:
+            yield db
+
+    app = FastAPI()
+
+    @app.get("/slow")
+    async def slow(db: AsyncSession = Depends(get_db)):
+        return {"count": (await db.execute(SLOW_QUERY, {"ms": ms})).scalar()}
+
+    return app
+
+
+async def run_load(app: FastAPI, total: int, concurrency: int) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop_lags = []
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.get("/slow")      # warm up the pool
+
+        async def one_slow():
+            async with semaphore:
+                response = await client.get("/slow")
+                response.raise_for_status()
+
+        async def probe_loop(stop: asyncio.Event):
+            # how late a 5ms timer fires while the slow requests run, i.e. how long
+            # every other endpoint would have been stalled behind them
+            while not stop.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.005)
+                loop_lags.append(time.perf_counter() - start - 0.005)
+
+        stop = asyncio.Event()
+        prober = asyncio.create_task(probe_loop(stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(one_slow() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await prober
+
+    loop_lags.sort()
+    return {
+        "requests": total,
+        "seconds": elapsed,
+        "throughput": total / elapsed,
+        "loop_lag_p50_ms": statistics.median(loop_lags) * 1000 if loop_lags else 0.0,
+        "loop_lag_max_ms": loop_lags[-1] * 1000 if loop_lags else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--query-ms", type=int, default=20, help="simulated database time per request")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), "bench_async_db.db")
+    results = {
+        "sync Session (before)": asyncio.run(run_load(build_sync_app(path, args.query_ms), args.requests, args.concurrency)),
+        "AsyncSession (after)": asyncio.run(run_load(build_async_app(path, args.query_ms), args.requests, args.concurrency)),
+    }
+
+    print(f"{'mode':<24}{'req/s':>10}{'total s':>10}{'loop lag p50 ms':>18}{'loop lag max ms':>18}")
+    for mode, r in results.items():
+        print(f"{mode:<24}{r['throughput']:>10.1f}{r['seconds']:>10.2f}{r['loop_lag_p50_ms']:>18.1f}{r['loop_lag_max_ms']:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Filename: bench_compression.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Cost and savings of compressing catalog-shaped JSON payloads of growing size with gzip
+             and brotli at the configured levels, to pick COMPRESSION_MIN_SIZE
+
+Usage: python -m benchmarks.bench_compression [--repeat 200]
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime
+
+os.environ.setdefault("TESTING", "1")
+
+from app.catalog import serialize_class
+from app.encoding import Compressor, brotli
+from app.models import CurrentClasses
+from app.serializers import dumps
+
+ROW_COUNTS = (1, 2, 5, 10, 50, 200, 1000)
+
+
+def payload(rows: int) -> bytes:
+    now = datetime.utcnow()
+    return dumps([
+        {**serialize_class(CurrentClasses(year=now.year, class_id=i, category="LC", weight=i, title=f"Level {i}",
+                                          description="Reading and writing for beginning students " * 4,
+                                          chinese_title="中文", chinese_description="中文课程介绍" * 4)),
+         "class_selected": 0}
+        for i in range(rows)
+    ])
+
+
+def measure(encoding: str, body: bytes, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = Compressor(encoding).compress(body, False)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6, len(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    encodings = ["gzip"] + (["br"] if brotli is not None else [])
+    print(f"{'rows':>6}{'bytes':>10}" + "".join(f"{e + ' us':>10}{e + ' bytes':>12}{e + ' saved':>12}" for e in encodings))
+    for rows in ROW_COUNTS:
+        body = payload(rows)
+        line = f"{rows:>6}{len(body):>10}"
+        for encoding in encodings:
+            us, size = measure(encoding, body, args.repeat)
+            line += f"{us:>10.1f}{size:>12}{1 - size / len(body):>12.0%}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Filename: bench_serializers.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Per-row cost of building and encoding catalog and cart responses, the old
+             __table__.columns walk plus jsonable_encoder against compiled serializers plus FastJSONResponse
+
+Usage: python -m benchmarks.bench_serializers [--rows 10000] [--repeat 5]
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime
+
+os.environ.setdefault("TESTING", "1")
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from app.models import CurrentClasses, StudentClass
+from app.serializers import compile_serializer, FastJSONResponse, orjson
+
+
+def make_rows(count: int):
+    now = datetime.utcnow()
+    classes = [
+        CurrentClasses(year=now.year, class_id=i, category="LC", weight=i, title=f"Level {i}",
+                       description="Reading and writing for beginning students " * 4,
+                       chinese_title="中文", chinese_description="中文课程介绍" * 4)
+        for i in range(count)
+    ]
+    cart = [
+        StudentClass(sc_id=i, year=now.year, student_id=i % 300, class_id=i % 50, wait=False, paid=False,
+                     paid_price=0, created=now, removed=now)
+        for i in range(count)
+    ]
+    return classes, cart
+
+
+def before(rows, extra: dict) -> bytes:
+    data = []
+    for obj in rows:
+        item = {c.name: getattr(obj, c.name) for c in obj.__table__.columns}
+        item.update(extra)
+        data.append(item)
+    return JSONResponse(jsonable_encoder(data)).body
+
+
+def after(rows, serialize, extra: dict) -> bytes:
+    data = []
+    for obj in rows:
+        item = serialize(obj)
+        item.update(extra)
+        data.append(item)
+    return FastJSONResponse(data).body
+
+
+def per_row_us(fn, rows, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best / len(rows) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    classes, cart = make_rows(args.rows)
+    serialize_class = compile_serializer(CurrentClasses)
+    serialize_student_class = compile_serializer(StudentClass)
+    catalog_extra = {"class_selected": 0}
+    cart_extra = {"verified": False, "first_name": "Student", "last_name": "Test", "chinese_name": "同学",
+                  "title": "Level 1", "chinese_title": "东西"}
+
+    print(f"encoder: {'orjson' if orjson else 'json (stdlib)'}, {args.rows} rows, best of {args.repeat}")
+    print(f"{'payload':<10}{'before us/row':>16}{'after us/row':>16}{'speedup':>10}")
+    for name, rows, serialize, extra in (("catalog", classes, serialize_class, catalog_extra),
+                                         ("cart", cart, serialize_student_class, cart_extra)):
+        old = per_row_us(lambda: before(rows, extra), rows, args.repeat)
+        new = per_row_us(lambda: after(rows, serialize, extra), rows, args.repeat)
+        print(f"{name:<10}{old:>16.2f}{new:>16.2f}{old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Filename: bench_startup.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Cold start cost of one worker. Each run is a fresh interpreter that imports app.main,
+             runs the lifespan and serves GET /healthy, timing import and time to first response.
+
+Usage: python -m benchmarks.bench_startup [--runs 10] [--warm-up] [--create-schema]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# runs inside each fresh interpreter
+CHILD = """
+import asyncio, json, time
+start = time.perf_counter()
+from app.main import app
+imported = time.perf_counter()
+
+import httpx
+
+async def first_request():
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+            response = await client.get("/healthy")
+            assert response.status_code == 200
+        served = time.perf_counter()
+    return served
+
+served = asyncio.run(first_request())
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_request_ms": (served - start) * 1000}))
+"""
+
+
+def run_once(env: dict) -> dict:
+    output = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--warm-up", action="store_true", help="set WARM_UP=1 for the lifespan")
+    parser.add_argument("--create-schema", action="store_true", help="set CREATE_SCHEMA=1 for the lifespan")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), "family_register_startup.db")
+    if os.path.exists(path):
+        os.remove(path)
+    env = {k: v for k, v in os.environ.items() if k not in ("WARM_UP", "CREATE_SCHEMA")}
+    env.update(TESTING="1", DATABASE_URL=f"sqlite+aiosqlite:///{path}")
+    if args.warm_up:
+        env["WARM_UP"] = "1"
+    if args.create_schema:
+        env["CREATE_SCHEMA"] = "1"
+
+    runs = [run_once(env) for _ in range(args.runs)]
+    for key in ("import_ms", "first_request_ms"):
+        values = [run[key] for run in runs]
+        print(f"{key:<18} median {statistics.median(values):8.1f}   min {min(values):8.1f}   max {max(values):8.1f}")
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Filename: loadtest.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Registration-day load test. Seeds a sqlite stand-in with families, students and the class
+             catalog, then replays every family's registration session at once through an in-process
+             async client and reports throughput and p50/p95/p99 latency per route as JSON. Requests that
+             fail, with an error status or an exception raised in the app, are counted per route and
+             the run carries on.
+
+Usage: python -m benchmarks.loadtest [--families 300] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+os.environ.setdefault("TESTING", "1")
+
+import httpx
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from app.main import app
+from app.database import Base
+from app.catalog import catalog_cache
+from app.routers.auth import get_db, get_read_db, token_cache
+from app.models import Classes, CurrentClasses, Family, Student, Order, OrderStudentClass, StudentClass
+
+LC_CATEGORIES = ['LC', 'CSL', 'AC', 'SP-FULL', 'SP-HALF', 'SP-EC', 'BOOK', 'SP-lang', 'SP-AC']
+
+
+def seed(path: str, families: int, classes: int, seed_value: int):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    with engine.connect() as connection:
+        # readers do not wait on the writer, writers queue on the busy timeout instead of failing
+        connection.execute(text("PRAGMA journal_mode=WAL"))
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    blank = dict(o_family_id="", father_fname="Father", father_lname="Test", mother_fname="Mother",
+                 mother_lname="Test", father_cname="", mother_cname="", address="", address2="", city="",
+                 state="", zip="", country="US", email2="", phone="", phone2="", created=now, modified=now,
+                 education=0, income=0, main_lang_id="", verified=1, activationCode="000000", status=1, level=0,
+                 help_id=0, directory=0, ecp_name="", ecp_relation="", ecp_phone="", type=0, medical_cond="",
+                 allergy=0, doctor_name="", doctor_phone="", ins_company="", ins_policy="", referral=" ")
+
+    with sessionmaker(bind=engine)() as db:
+        for class_id in range(1, classes + 1):
+            category = LC_CATEGORIES[class_id % len(LC_CATEGORIES)]
+            db.add(Classes(class_id=class_id, class_code=str(class_id), category=category, title=f"Class {class_id}",
+                           description="Class description " * 8, chinese_title="课程", chinese_description="课程介绍",
+                           age=0, created=now, modified=now, seats_x=rng.randint(10, 30), weight=class_id))
+            db.add(CurrentClasses(year=now.year, class_id=class_id, category=category, weight=class_id,
+                                  title=f"Class {class_id}", description="Class description " * 8,
+                                  chinese_title="课程", chinese_description="课程介绍"))
+
+        student_id = 0
+        for family_id in range(1, families + 1):
+            db.add(Family(family_id=family_id, email=f"family{family_id}@e.com", password="pw", **blank))
+            for _ in range(rng.randint(1, 3)):
+                student_id += 1
+                db.add(Student(student_id=student_id, o_student_id="", family_id=family_id, first_name="Student",
+                               last_name=str(student_id), chinese_name="同学", dob="01/01/2015", gender="F",
+                               grade="3", created=now, modified=now, status=1, email="", medical_cond="",
+                               allergy="", doctor_name="Doctor", doctor_phone="555", ins_company="Ins",
+                               ins_policy="1"))
+            # last year's paid order
+            db.add(Order(order_id=family_id, year=now.year - 1, family_id=family_id, created=now, paid=now,
+                         amount=100, payment_method="card", transaction_id=str(family_id)))
+            db.add(StudentClass(sc_id=family_id, year=now.year - 1, student_id=student_id, class_id=1, wait=0,
+                                paid=1, paid_price=100, created=now, removed=now))
+            db.add(OrderStudentClass(osc_id=family_id, order_id=family_id, sc_id=family_id))
+        db.commit()
+    engine.dispose()
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.exceptions = {}
+
+    async def call(self, route: str, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+        except Exception as e:
+            # the family's session cannot go on without this response, run() counts it as failed
+            self.samples.setdefault(route, []).append(time.perf_counter() - start)
+            self.errors[route] = self.errors.get(route, 0) + 1
+            self.exceptions[type(e).__name__] = self.exceptions.get(type(e).__name__, 0) + 1
+            raise
+        self.samples.setdefault(route, []).append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return response
+
+    def report(self, elapsed: float) -> dict:
+        routes = {}
+        for route, samples in self.samples.items():
+            ordered = sorted(samples)
+            routes[route] = {
+                "count": len(ordered),
+                "errors": self.errors.get(route, 0),
+                "throughput_rps": round(len(ordered) / elapsed, 2),
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2),
+            }
+        total = sum(route["count"] for route in routes.values())
+        return {"requests": total, "throughput_rps": round(total / elapsed, 2), "exceptions": self.exceptions,
+                "routes": routes}
+
+
+async def family_session(client: httpx.AsyncClient, recorder: Recorder, family_id: int, classes: int, rng: random.Random):
+    # what a parent does at 9am: log in, look around, pick classes for each child, check out
+    response = await recorder.call("POST /token", client.post(
+        "/token", data={"username": f"family{family_id}@e.com", "password": "pw"}))
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    await recorder.call("GET /family/profile/view", client.get("/family/profile/view", headers=headers))
+    students = (await recorder.call("GET /family/student", client.get("/family/student", headers=headers))).json()
+
+    for student in students:
+        url = f"/student/{student['student_id']}"
+        await recorder.call("GET /student/{id}/read_current_LC_classes",
+                            client.get(f"{url}/read_current_LC_classes", headers=headers))
+        for class_id in rng.sample(range(1, classes + 1), 2):
+            await recorder.call("POST /student/{id}/select_classes",
+                                client.post(f"{url}/select_classes", json={"class_id": class_id}, headers=headers))
+
+    await recorder.call("GET /family/checkout", client.get("/family/checkout", headers=headers))
+    await recorder.call("GET /family/payments", client.get("/family/payments", headers=headers))
+
+
+async def run(path: str, families: int, classes: int, seed_value: int) -> dict:
+    # sqlite allows one writer at a time: a long busy timeout queues writers instead of raising
+    # "database is locked", and the pool waits as long rather than timing out at peak
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 60},
+                                 pool_size=20, max_overflow=0, pool_timeout=120)
+    SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    async def get_loadtest_db():
+        async with SessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = get_loadtest_db
+    app.dependency_overrides[get_read_db] = get_loadtest_db
+    catalog_cache.invalidate()
+    token_cache.clear()
+    recorder = Recorder()
+    rng = random.Random(seed_value)
+
+    # exceptions in the app come back as 500s and are counted, instead of ending the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        start = time.perf_counter()
+        sessions = await asyncio.gather(*(family_session(client, recorder, family_id, classes, random.Random(rng.random()))
+                                          for family_id in range(1, families + 1)), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+    await engine.dispose()
+    failed = sum(isinstance(session, BaseException) for session in sessions)
+    return {"duration_s": round(elapsed, 3), "failed_sessions": failed, **recorder.report(elapsed)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--families", type=int, default=300)
+    parser.add_argument("--classes", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), "family_register_loadtest.db")
+    if os.path.exists(path):
+        os.remove(path)
+    seed(path, args.families, args.classes, args.seed)
+
+    report = {"commit": git_commit(), "families": args.families, "classes": args.classes,
+              **asyncio.run(run(path, args.families, args.classes, args.seed))}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
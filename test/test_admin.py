@@ -0,0 +1,70 @@
+"""
+Filename: test_admin.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for admin.py
+"""
+
+from .utils import *
+from app.routers.auth import get_db, get_current_family
+from fastapi import status
+import csv
+import io
+import json
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+
+@pytest.fixture
+def test_three_students(test_student):
+    db = TestingSessionLocal()
+    student = db.get(Student, 1)
+    columns = {c.name: getattr(student, c.name) for c in Student.__table__.columns}
+    for student_id in (2, 3):
+        db.add(Student(**{**columns, "student_id": student_id, "first_name": f"Student {student_id}"}))
+    db.commit()
+    db.close()
+    yield
+
+
+def test_read_students_keyset_pages(test_three_students):
+    response = client.get("/admin/read_students?limit=2")
+    assert response.status_code == status.HTTP_200_OK
+    page = response.json()
+    assert [item["student_id"] for item in page["items"]] == [1, 2]
+    assert page["next_after"] == 2
+
+    page = client.get(f"/admin/read_students?limit=2&after={page['next_after']}").json()
+    assert [item["student_id"] for item in page["items"]] == [3]
+    assert page["next_after"] is None
+
+
+def test_export_students_ndjson(test_three_students):
+    response = client.get("/admin/read_students/export")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["student_id"] for row in rows] == [1, 2, 3]
+    assert rows[1]["first_name"] == "Student 2"
+    assert rows[0]["chinese_name"] == "同学"
+
+
+def test_export_families_csv(test_family):
+    response = client.get("/admin/read_families/export?format=csv")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == 1
+    assert rows[0]["email"] == "test1@e.com"
+
+
+def test_enrollment_changes_need_admin(test_family, test_classes):
+    assert client.put("/admin/classes/1/seats", params={"seats_x": 3}).status_code == status.HTTP_403_FORBIDDEN
+    assert client.post("/admin/waitlist/promote").status_code == status.HTTP_403_FORBIDDEN
+
+
+def test_enrollment_changes_allowed_for_admin(test_admin, test_classes):
+    assert client.put("/admin/classes/1/seats", params={"seats_x": 3}).status_code == status.HTTP_200_OK
+    assert client.post("/admin/waitlist/promote").json() == {"promoted": {}}
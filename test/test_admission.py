@@ -0,0 +1,103 @@
+"""
+Filename: test_admission.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for admission.py
+"""
+
+from .utils import *
+from app.routers.auth import get_db, get_current_family
+from app.admission import AdmissionBackend, InMemoryAdmissionBackend
+from fastapi import status
+import asyncio
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+
+@pytest.fixture
+def strict_backend(monkeypatch):
+    backend = InMemoryAdmissionBackend(family_rate=0.5, family_burst=1, max_concurrent=1)
+    monkeypatch.setattr(admission, "admission_backend", backend)
+    return backend
+
+
+def test_token_bucket_refills():
+    backend = InMemoryAdmissionBackend(family_rate=100, family_burst=2, max_concurrent=1)
+
+    async def run():
+        taken = [await backend.take_token(1) for _ in range(3)]
+        other_family = await backend.take_token(2)
+        await asyncio.sleep(0.02)
+        return taken, other_family, await backend.take_token(1)
+
+    taken, other_family, refilled = asyncio.run(run())
+    assert taken[:2] == [0.0, 0.0]
+    assert 0 < taken[2] <= 0.01
+    assert other_family == 0.0
+    assert refilled == 0.0
+
+
+def test_concurrency_slots():
+    backend = InMemoryAdmissionBackend(family_rate=1, family_burst=1, max_concurrent=1)
+
+    async def run():
+        first = await backend.acquire_slot(0.01)
+        second = await backend.acquire_slot(0.01)
+        await backend.release_slot()
+        third = await backend.acquire_slot(0.01)
+        return first, second, third
+
+    assert asyncio.run(run()) == (True, False, True)
+
+
+def test_waiting_room_first_come_first_served():
+    backend = InMemoryAdmissionBackend(family_rate=1, family_burst=1, max_concurrent=1)
+
+    async def run():
+        closed = await backend.queue_position(1)
+        await backend.open_waiting_room(rate=2, burst=1)
+        positions = [await backend.queue_position(family_id) for family_id in (1, 2, 3, 2)]
+        return closed, positions, await backend.status()
+
+    closed, positions, backend_status = asyncio.run(run())
+    assert closed is None
+    assert positions == [(0, 0), (1, 1), (2, 1), (1, 1)]
+    assert backend_status["waiting_room"]["tickets"] == 3
+
+
+def test_family_throttled(test_family, test_student, test_current_classes_1, strict_backend):
+    assert client.get("/student/1/read_current_LC_classes").status_code == status.HTTP_200_OK
+    response = client.get("/student/1/read_current_LC_classes")
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert int(response.headers["Retry-After"]) == 2
+
+
+def test_waiting_room_queues_family(test_admin, test_student, strict_backend):
+    response = client.post("/admin/waiting_room/open", params={"rate": 1, "burst": 0})
+    assert response.json()["waiting_room"]["tickets"] == 0
+
+    response = client.post("/student/1/select_classes", json={"class_id": 1})
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json()["detail"]["queue_position"] == 1
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/student/waiting_room").json() == {"open": True, "queue_position": 1, "retry_after": 1}
+
+    client.post("/admin/waiting_room/close")
+    assert client.get("/student/waiting_room").json()["open"] is False
+
+
+def test_waiting_room_controls_need_admin(test_family):
+    assert client.post("/admin/waiting_room/open", params={"rate": 1}).status_code == status.HTTP_403_FORBIDDEN
+    assert client.post("/admin/waiting_room/close").status_code == status.HTTP_403_FORBIDDEN
+    assert client.get("/admin/admission").status_code == status.HTTP_403_FORBIDDEN
+
+
+def test_incomplete_backend_fails_at_construction():
+    class TokensOnly(AdmissionBackend):
+        async def take_token(self, family_id: int) -> float:
+            return 0
+
+    with pytest.raises(TypeError):
+        TokensOnly()
@@ -0,0 +1,134 @@
+"""
+Filename: test_auth.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for auth.py
+"""
+
+from .utils import *
+from app.routers.auth import get_current_family, create_access_token, token_cache, get_oauth_client, complete_oauth_login
+from app import cache
+from app.cache import TTLCache
+from app.models import UserInfo
+from datetime import timedelta
+from fastapi import HTTPException
+from types import SimpleNamespace
+import asyncio
+import time
+
+
+def test_get_current_family_caches_verified_token():
+    token_cache.clear()
+    token = create_access_token("test1@e.com", 1, timedelta(minutes=20))
+    hits, misses = token_cache.hits, token_cache.misses
+
+    assert asyncio.run(get_current_family(token)) == {'email': 'test1@e.com', 'family_id': 1, 'student_ids': None}
+    assert asyncio.run(get_current_family(token)) == {'email': 'test1@e.com', 'family_id': 1, 'student_ids': None}
+    assert (token_cache.hits - hits, token_cache.misses - misses) == (1, 1)
+
+
+def test_cached_token_expires_with_token(monkeypatch):
+    token_cache.clear()
+    token = create_access_token("test1@e.com", 1, timedelta(seconds=1))
+    asyncio.run(get_current_family(token))
+    assert token_cache.get(token) is not None
+
+    # the cache's clock moves past the token's exp, well inside the cache ttl
+    later = time.time() + 2.1
+    monkeypatch.setattr(cache, "time", SimpleNamespace(time=lambda: later))
+    assert token_cache.get(token) is None
+
+    expired = create_access_token("test1@e.com", 1, timedelta(seconds=-1))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(get_current_family(expired))
+    assert error.value.status_code == 401
+    assert token_cache.get(expired) is None
+
+
+def test_token_carries_student_claims():
+    token = create_access_token("test1@e.com", 1, timedelta(minutes=20), [3, 1])
+    assert asyncio.run(get_current_family(token))['student_ids'] == [1, 3]
+
+
+def test_invalid_token_not_cached():
+    token_cache.clear()
+    with pytest.raises(HTTPException):
+        asyncio.run(get_current_family("not-a-token"))
+    assert len(token_cache) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 3, "misses": 1}
+
+
+def test_oauth_provider_without_credentials_unavailable(monkeypatch):
+    monkeypatch.delenv("yahoo-id", raising=False)
+    monkeypatch.delenv("yahoo-secret", raising=False)
+    response = client.get("/login/yahoo")
+    assert response.status_code == 503
+
+
+def test_oauth_provider_registered_on_first_use(monkeypatch):
+    monkeypatch.setenv("facebook-id", "fb-id")
+    monkeypatch.setenv("facebook-secret", "fb-secret")
+    facebook = get_oauth_client("facebook")
+    assert facebook.client_id == "fb-id"
+    assert get_oauth_client("facebook") is facebook
+
+
+@pytest.fixture
+def clean_user_info():
+    yield
+    db = TestingSessionLocal()
+    db.query(UserInfo).delete()
+    db.commit()
+    db.close()
+
+
+def oauth_login(email: str, access_token: str = "provider-token"):
+    async def login():
+        async with AsyncTestingSessionLocal() as db:
+            return await complete_oauth_login(db, {"access_token": access_token}, email, "First", "Last")
+    return asyncio.run(login())
+
+
+def test_oauth_login_with_family_is_one_query(test_family, clean_user_info):
+    db = TestingSessionLocal()
+    db.add(UserInfo(email="test1@e.com", first_name="First", last_name="Last", profile_created=True, token_="old"))
+    db.commit()
+    db.close()
+
+    with count_queries() as statements:
+        assert oauth_login("test1@e.com") == {"access_token": "provider-token", "token_type": "bearer"}
+    assert len([s for s in statements if s.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE"))]) == 1
+
+    db = TestingSessionLocal()
+    assert db.query(UserInfo).filter(UserInfo.email == "test1@e.com").one().profile_created
+    db.close()
+
+
+def test_oauth_login_new_user_upserted(clean_user_info):
+    oauth_login("new@e.com", "first-token")
+    oauth_login("new@e.com", "second-token")
+
+    db = TestingSessionLocal()
+    users = db.query(UserInfo).filter(UserInfo.email == "new@e.com").all()
+    db.close()
+    assert len(users) == 1
+    assert users[0].profile_created is False
+    assert users[0].token_ == "second-token"
+
+
+def test_oauth_login_without_email_rejected():
+    with pytest.raises(HTTPException) as error:
+        oauth_login(None)
+    assert error.value.status_code == 400
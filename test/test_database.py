@@ -0,0 +1,79 @@
+"""
+Filename: test_database.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for database.py
+"""
+
+import asyncio
+from .utils import *
+from app.database import create_engine_from_env, create_sessionmaker
+from app.routers.auth import get_db, get_read_db, get_current_family
+from fastapi import status
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+REPLICA_DATABASE_PATH = os.path.join(tempfile.gettempdir(), "family_register_test_replica.db")
+
+
+@pytest.fixture
+def replica():
+    if os.path.exists(REPLICA_DATABASE_PATH):
+        os.remove(REPLICA_DATABASE_PATH)
+    replica_engine = create_engine_from_env(f"sqlite+aiosqlite:///{REPLICA_DATABASE_PATH}", env={})
+
+    async def setup():
+        async with replica_engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+    asyncio.run(setup())
+
+    ReplicaSessionLocal = create_sessionmaker(replica_engine)
+
+    async def override_get_read_db():
+        async with ReplicaSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_read_db] = override_get_read_db
+    catalog_cache.invalidate()
+    yield ReplicaSessionLocal
+    app.dependency_overrides[get_read_db] = override_get_db
+    catalog_cache.invalidate()
+    asyncio.run(replica_engine.dispose())
+    os.remove(REPLICA_DATABASE_PATH)
+
+
+def test_engine_pool_settings_from_env():
+    test_engine = create_engine_from_env("sqlite+aiosqlite:///" + REPLICA_DATABASE_PATH,
+                                         env={"DB_POOL_SIZE": "3", "DB_MAX_OVERFLOW": "4", "DB_POOL_TIMEOUT": "2",
+                                              "DB_POOL_RECYCLE": "60", "DB_POOL_PRE_PING": "0"})
+    pool = test_engine.sync_engine.pool
+    assert pool.size() == 3
+    assert pool._max_overflow == 4
+    assert pool._timeout == 2
+    assert pool._recycle == 60
+    assert pool._pre_ping is False
+    asyncio.run(test_engine.dispose())
+
+
+def test_catalog_read_from_replica(test_family, test_student, test_student_class_unpaid, test_current_classes_1, replica):
+    async def seed():
+        async with replica() as db:
+            db.add(CurrentClasses(year=now.year, class_id=1, category="LC", weight=1, title="Replica Level 1",
+                                  description="", chinese_title="", chinese_description=""))
+            await db.commit()
+    asyncio.run(seed())
+
+    response = client.get("/student/1/read_current_LC_classes")
+    assert response.status_code == status.HTTP_200_OK
+    assert [item["title"] for item in response.json()] == ["Replica Level 1"]
+    # selections are read-your-writes, they still come from the primary
+    assert response.json()[0]["class_selected"] >= 1
+
+
+def test_history_read_from_replica(test_family, test_student, test_classes, test_student_class_paid, replica):
+    # the paid registration only exists on the primary, so the replica's empty history shows through
+    response = client.get("/family/student/1/registration_history")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == []
@@ -0,0 +1,105 @@
+"""
+Filename: test_encoding.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for encoding.py
+"""
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from app import encoding, serializers
+from app.encoding import EncodingMiddleware, choose_encoding
+from app.serializers import FastJSONResponse, accepts_msgpack
+import pytest
+
+ROWS = [{"class_id": i, "description": "Reading and writing for beginning students", "chinese_description": "中文课程介绍"}
+        for i in range(50)]
+
+encoding_app = FastAPI()
+encoding_app.add_middleware(EncodingMiddleware, minimum_size = 500)
+
+
+@encoding_app.get("/large")
+def large():
+    return FastJSONResponse(ROWS)
+
+
+@encoding_app.get("/small")
+def small():
+    return FastJSONResponse({"status": "Healthy"})
+
+
+@encoding_app.get("/stream")
+def stream():
+    return StreamingResponse((serializers.dumps(row) + b"\n" for row in ROWS), media_type = "application/x-ndjson")
+
+
+encoding_client = TestClient(encoding_app)
+
+
+def test_large_response_gzipped():
+    response = encoding_client.get("/large", headers = {"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert int(response.headers["content-length"]) < len(serializers.dumps(ROWS))
+    assert response.json() == ROWS
+
+
+def test_small_response_not_compressed():
+    response = encoding_client.get("/small", headers = {"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.json() == {"status": "Healthy"}
+
+
+def test_identity_when_not_accepted():
+    response = encoding_client.get("/large", headers = {"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.json() == ROWS
+
+
+def test_streamed_response_compressed():
+    response = encoding_client.get("/stream", headers = {"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert len(response.text.splitlines()) == len(ROWS)
+
+
+def test_choose_encoding(monkeypatch):
+    monkeypatch.setattr(encoding, "brotli", None)
+    assert choose_encoding("gzip, deflate, br") == "gzip"
+    assert choose_encoding("gzip;q=0") is None
+    assert choose_encoding("*") == "gzip"
+    assert choose_encoding("") is None
+
+    monkeypatch.setattr(encoding, "brotli", object())
+    assert choose_encoding("gzip, deflate, br") == "br"
+    assert choose_encoding("gzip, br;q=0.5") == "gzip"
+
+
+def test_msgpack_negotiation(monkeypatch):
+    monkeypatch.setattr(serializers, "msgpack", None)
+    assert not accepts_msgpack("application/msgpack")
+    response = encoding_client.get("/small", headers = {"Accept": "application/msgpack"})
+    assert response.headers["content-type"] == "application/json"
+
+    monkeypatch.setattr(serializers, "msgpack", object())
+    assert accepts_msgpack("application/msgpack")
+    assert accepts_msgpack("application/json;q=0.5, application/x-msgpack")
+    assert not accepts_msgpack("application/json, application/msgpack;q=0.9")
+    assert not accepts_msgpack("*/*")
+
+
+def test_msgpack_response():
+    msgpack = pytest.importorskip("msgpack")
+    response = encoding_client.get("/large", headers = {"Accept": "application/msgpack"})
+    assert response.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(response.content) == ROWS
+
+
+def test_brotli_preferred_when_installed():
+    brotli = pytest.importorskip("brotli")
+    response = encoding_client.get("/large", headers = {"Accept-Encoding": "gzip, br"})
+    assert response.headers["content-encoding"] == "br"
+    assert response.json() == ROWS
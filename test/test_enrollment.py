@@ -0,0 +1,215 @@
+"""
+Filename: test_enrollment.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for enrollment.py
+"""
+
+from .utils import *
+from app.routers.auth import get_db, get_current_family
+from app.models import ClassSeats
+from app.enrollment import expire_holds, promote_all, HOLD_WINDOW
+from datetime import timedelta
+from fastapi import status
+import asyncio
+import httpx
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+
+@pytest.fixture
+def test_many_students():
+    db = TestingSessionLocal()
+    for student_id in range(1, 301):
+        db.add(Student(
+            student_id = student_id,
+            o_student_id = "",
+            family_id = 1,
+            first_name = "Student",
+            last_name = str(student_id),
+            chinese_name = "同学",
+            dob = "01/01/2000",
+            gender = "M",
+            grade = "0",
+            created = now,
+            modified = now,
+            status = 1,
+            email = "test@e.com",
+            medical_cond = "Example",
+            allergy = "Example",
+            doctor_name = "Example",
+            doctor_phone = "Example",
+            ins_company = "Example",
+            ins_policy = "Example"
+        ))
+    db.commit()
+    db.close()
+    yield
+    with engine.connect() as connection:
+        connection.execute(text("DELETE FROM students;"))
+        connection.execute(text("DELETE FROM student_class;"))
+        connection.commit()
+
+
+def test_select_full_class_waitlists(test_family, test_many_students, test_classes):
+    response = client.post("/student/1/select_classes", json={'class_id': 1})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json() == {'class_id': 1, 'wait': False}
+
+    # test_classes only has one seat
+    response = client.post("/student/2/select_classes", json={'class_id': 1})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json() == {'class_id': 1, 'wait': True}
+
+    db = TestingSessionLocal()
+    waits = [row.wait for row in db.query(StudentClass).order_by(StudentClass.sc_id)]
+    assert waits == [False, True]
+    db.close()
+
+
+def test_concurrent_selections_never_oversell(test_family, test_many_students):
+    seats = 25
+    db = TestingSessionLocal()
+    db.add(Classes(class_id = 7, class_code = "7", category = "LC", title = "Level 7", description = "",
+                   chinese_title = "东西", chinese_description = "东西", age = 0, created = now, modified = now,
+                   seats_x = seats, weight = 1))
+    db.commit()
+    db.close()
+
+    async def select_all():
+        transport = httpx.ASGITransport(app = app)
+        async with httpx.AsyncClient(transport = transport, base_url = "http://test") as async_client:
+            return await asyncio.gather(*(
+                async_client.post(f"/student/{student_id}/select_classes", json = {'class_id': 7})
+                for student_id in range(1, 301)
+            ))
+
+    responses = asyncio.run(select_all())
+    assert all(response.status_code == status.HTTP_201_CREATED for response in responses)
+    assert sum(not response.json()['wait'] for response in responses) == seats
+
+    db = TestingSessionLocal()
+    try:
+        assert db.query(StudentClass).filter(StudentClass.class_id == 7, StudentClass.wait == 0).count() == seats
+        assert db.query(StudentClass).filter(StudentClass.class_id == 7, StudentClass.wait == 1).count() == 300 - seats
+        assert db.query(ClassSeats).filter(ClassSeats.class_id == 7).one().taken == seats
+    finally:
+        db.close()
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM classes;"))
+            connection.execute(text("DELETE FROM class_seats;"))
+            connection.commit()
+
+
+def test_freed_seats_promote_waitlist(test_admin, test_many_students, test_classes):
+    for student_id in (1, 2, 3):
+        client.post(f"/student/{student_id}/select_classes", json={'class_id': 1})
+
+    # student 1 drops the class, the oldest waitlisted selection takes the seat
+    response = client.put("/student/cart", json={"students": [{"student_id": 1, "class_ids": []}]})
+    assert response.status_code == status.HTTP_200_OK
+
+    db = TestingSessionLocal()
+    waits = {row.student_id: row.wait for row in db.query(StudentClass)}
+    assert waits == {2: False, 3: True}
+    assert db.query(ClassSeats).filter(ClassSeats.class_id == 1).one().taken == 1
+    db.close()
+
+    # added capacity goes to the rest of the waitlist
+    response = client.put("/admin/classes/1/seats", params={"seats_x": 3})
+    assert response.json()["promoted"] == [3]
+
+    db = TestingSessionLocal()
+    assert db.query(StudentClass).filter(StudentClass.wait == 1).count() == 0
+    assert db.query(ClassSeats).filter(ClassSeats.class_id == 1).one().taken == 2
+    db.close()
+
+
+def test_expired_holds_released(test_family, test_many_students, test_classes):
+    for student_id in (1, 2, 3):
+        client.post(f"/student/{student_id}/select_classes", json={'class_id': 1})
+
+    db = TestingSessionLocal()
+    db.query(StudentClass).filter(StudentClass.student_id == 1).update({"created": datetime(2000, 1, 1), "removed": datetime(2000, 1, 3)})
+    db.commit()
+    db.close()
+
+    async def sweep():
+        async with AsyncTestingSessionLocal() as async_db:
+            return await expire_holds(async_db, now.year, batch_size=1)
+
+    assert asyncio.run(sweep()) == 1
+    # a promoted selection starts a fresh hold, a second sweep has nothing to do
+    assert asyncio.run(sweep()) == 0
+
+    db = TestingSessionLocal()
+    waits = {row.student_id: row.wait for row in db.query(StudentClass)}
+    assert waits == {2: False, 3: True}
+    assert db.query(ClassSeats).filter(ClassSeats.class_id == 1).one().taken == 1
+    db.close()
+
+
+def test_paid_and_waitlisted_selections_never_expire(test_family, test_many_students, test_classes):
+    for student_id in (1, 2):
+        client.post(f"/student/{student_id}/select_classes", json={'class_id': 1})
+
+    db = TestingSessionLocal()
+    db.query(StudentClass).filter(StudentClass.student_id == 1).update({"paid": True})
+    db.query(StudentClass).update({"created": datetime(2000, 1, 1), "removed": datetime(2000, 1, 3)})
+    db.commit()
+    db.close()
+
+    async def sweep():
+        async with AsyncTestingSessionLocal() as async_db:
+            return await expire_holds(async_db, now.year)
+
+    assert asyncio.run(sweep()) == 0
+    db = TestingSessionLocal()
+    assert db.query(StudentClass).count() == 2
+    db.close()
+
+
+def test_rows_without_deadline_expire_from_created(test_family, test_many_students, test_classes):
+    for student_id in (1, 2, 3):
+        client.post(f"/student/{student_id}/select_classes", json={'class_id': 1})
+
+    db = TestingSessionLocal()
+    waitlisted = db.query(StudentClass).filter(StudentClass.wait == 1).all()
+    assert all(row.removed == row.created for row in waitlisted)
+
+    # legacy rows carry removed == created, a recent one keeps its seat until created plus the window
+    seated = db.query(StudentClass).filter(StudentClass.wait == 0).one()
+    db.query(StudentClass).filter(StudentClass.sc_id == seated.sc_id).update({"removed": seated.created})
+    db.commit()
+    db.close()
+
+    async def sweep(at):
+        async with AsyncTestingSessionLocal() as async_db:
+            return await expire_holds(async_db, now.year, now=at)
+
+    assert asyncio.run(sweep(datetime.now())) == 0
+    assert asyncio.run(sweep(datetime.now() + HOLD_WINDOW + timedelta(minutes=1))) == 1
+
+
+def test_promote_all_reconciles_counters_first(test_family, test_many_students, test_classes):
+    for student_id in (1, 2, 3):
+        client.post(f"/student/{student_id}/select_classes", json={'class_id': 1})
+
+    # staff drop the seated selection and raise the capacity straight in the database
+    with engine.connect() as connection:
+        connection.execute(text("DELETE FROM student_class WHERE student_id = 1"))
+        connection.execute(text("UPDATE classes SET seats_x = 2 WHERE class_id = 1"))
+        connection.commit()
+
+    async def promote():
+        async with AsyncTestingSessionLocal() as async_db:
+            return await promote_all(async_db, now.year)
+
+    assert {class_id: len(sc_ids) for class_id, sc_ids in asyncio.run(promote()).items()} == {1: 2}
+    db = TestingSessionLocal()
+    seats = db.query(ClassSeats).filter(ClassSeats.class_id == 1).one()
+    assert (seats.seats_x, seats.taken) == (2, 2)
+    assert db.query(StudentClass).filter(StudentClass.wait == 1).count() == 0
+    db.close()
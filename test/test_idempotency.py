@@ -0,0 +1,138 @@
+"""
+Filename: test_idempotency.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for idempotency.py
+"""
+
+from .utils import *
+from app.routers.auth import get_db, get_current_family
+from app.cache import TTLCache
+from app import idempotency
+from app.idempotency import IdempotencyMiddleware, idempotency_store
+from app.admission import InMemoryAdmissionBackend
+from fastapi import FastAPI, status
+from fastapi.responses import JSONResponse
+import asyncio
+import httpx
+import time
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+CHILD = {"first_name": "Student", "last_name": "Retry", "chinese_name": "同学", "dob": "01/01/2016", "gender": "F",
+         "grade": "3", "email": "", "medical_cond": "", "allergy": "", "doctor_name": "Doctor",
+         "doctor_phone": "555", "ins_company": "Ins", "ins_policy": "1"}
+
+# keys are only honoured for callers with credentials, the token itself is not checked here
+AUTH = {"Authorization": "Bearer test-token"}
+
+
+def test_retried_select_classes_replayed(test_family, test_student, test_classes, test_student_class_unpaid):
+    idempotency_store.clear()
+    headers = {**AUTH, "Idempotency-Key": "select-2"}
+    first = client.post("/student/1/select_classes", json={"class_id": 2}, headers=headers)
+    retry = client.post("/student/1/select_classes", json={"class_id": 2}, headers=headers)
+
+    assert first.status_code == retry.status_code == status.HTTP_201_CREATED
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+
+    db = TestingSessionLocal()
+    assert db.query(StudentClass).filter(StudentClass.student_id == 1, StudentClass.class_id == 2).count() == 1
+    db.close()
+
+
+def test_retried_student_add_creates_one_student(test_family, test_student):
+    idempotency_store.clear()
+    first = client.post("/family/student/add", json=CHILD, headers={**AUTH, "Idempotency-Key": "add-child"})
+    retry = client.post("/family/student/add", json=CHILD, headers={**AUTH, "Idempotency-Key": "add-child"})
+    assert first.status_code == retry.status_code == status.HTTP_201_CREATED
+    assert retry.json()["student_id"] == first.json()["student_id"]
+
+    db = TestingSessionLocal()
+    assert db.query(Student).filter(Student.last_name == "Retry").count() == 1
+    db.close()
+
+
+def test_key_reused_with_other_body_rejected(test_family, test_student):
+    idempotency_store.clear()
+    client.post("/family/student/add", json=CHILD, headers={**AUTH, "Idempotency-Key": "add-child"})
+    response = client.post("/family/student/add", json={**CHILD, "first_name": "Other"}, headers={**AUTH, "Idempotency-Key": "add-child"})
+    assert response.status_code == 422
+
+
+def make_counting_app(status_code: int = 200, delay: float = 0.0):
+    calls = []
+    counting_app = FastAPI()
+    counting_app.add_middleware(IdempotencyMiddleware, store=TTLCache(maxsize=10, ttl=60))
+
+    @counting_app.post("/write")
+    async def write():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return JSONResponse({"call": len(calls)}, status_code=status_code)
+
+    return counting_app, calls
+
+
+def test_concurrent_duplicates_run_once():
+    counting_app, calls = make_counting_app(delay=0.05)
+
+    async def burst():
+        transport = httpx.ASGITransport(app=counting_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            return await asyncio.gather(*(async_client.post("/write", headers={**AUTH, "Idempotency-Key": "k"}) for _ in range(5)))
+
+    responses = asyncio.run(burst())
+    assert len(calls) == 1
+    assert [response.json() for response in responses] == [{"call": 1}] * 5
+
+
+def test_server_errors_not_stored():
+    counting_app, calls = make_counting_app(status_code=503)
+    counting_client = TestClient(counting_app)
+    counting_client.post("/write", headers={**AUTH, "Idempotency-Key": "k"})
+    counting_client.post("/write", headers={**AUTH, "Idempotency-Key": "k"})
+    assert len(calls) == 2
+
+
+def test_anonymous_requests_not_stored():
+    counting_app, calls = make_counting_app()
+    counting_client = TestClient(counting_app)
+    counting_client.post("/write", headers={"Idempotency-Key": "k"})
+    second = counting_client.post("/write", headers={"Idempotency-Key": "k"})
+    assert len(calls) == 2
+    assert "Idempotent-Replayed" not in second.headers
+
+
+def test_oversized_body_rejected(monkeypatch):
+    monkeypatch.setattr(idempotency, "MAX_BODY", 16)
+    counting_app, calls = make_counting_app()
+    counting_client = TestClient(counting_app)
+    response = counting_client.post("/write", content=b"x" * 17, headers={**AUTH, "Idempotency-Key": "k"})
+    assert response.status_code == 413
+    assert calls == []
+
+
+def test_retry_after_throttled_request_runs(test_family, test_student, test_classes, monkeypatch):
+    idempotency_store.clear()
+    monkeypatch.setattr(admission, "admission_backend", InMemoryAdmissionBackend(family_rate=20, family_burst=1, max_concurrent=1))
+    asyncio.run(admission.admission_backend.take_token(1))
+
+    headers = {**AUTH, "Idempotency-Key": "select-throttled"}
+    response = client.post("/student/1/select_classes", json={"class_id": 1}, headers=headers)
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+
+    # the bucket has refilled, the retry runs instead of replaying the 429
+    time.sleep(0.06)
+    try:
+        retry = client.post("/student/1/select_classes", json={"class_id": 1}, headers=headers)
+        assert retry.status_code == status.HTTP_201_CREATED
+        assert "Idempotent-Replayed" not in retry.headers
+    finally:
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM student_class;"))
+            connection.commit()
@@ -0,0 +1,65 @@
+"""
+Filename: test_instrumentation.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for instrumentation.py
+"""
+
+from .utils import *
+from app.routers.auth import get_db, get_current_family
+from app import instrumentation
+from fastapi import status
+import logging
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+
+def test_debug_headers_report_queries(test_family, test_student, monkeypatch):
+    monkeypatch.setattr(instrumentation, "SQL_DEBUG", True)
+    response = client.get("/family/student")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["X-DB-Queries"] == "1"
+    assert float(response.headers["X-DB-Time-ms"]) >= 0
+    assert response.headers["X-DB-Repeated"] == "1"
+
+
+def test_no_debug_headers_by_default(test_family):
+    response = client.get("/family/profile/view")
+    assert "X-DB-Queries" not in response.headers
+
+
+def test_queries_aggregated_per_route(test_admin, test_student):
+    before = instrumentation.route_summary().get("/family/student/{student_id}/registration_history", {}).get("requests", 0)
+    client.get("/family/student/1/registration_history")
+    client.get("/family/student/1/registration_history")
+    summary = client.get("/admin/sql_stats").json()["/family/student/{student_id}/registration_history"]
+    assert summary["requests"] == before + 2
+    assert summary["max_queries"] == 2
+
+
+def test_sql_stats_need_admin(test_family):
+    assert client.get("/admin/sql_stats").status_code == status.HTTP_403_FORBIDDEN
+
+
+def test_unmatched_paths_share_one_entry():
+    before = set(instrumentation.route_summary())
+    for n in range(3):
+        client.get(f"/scanner/probe-{n}")
+    added = set(instrumentation.route_summary()) - before
+    assert added <= {"<unmatched>"}
+    assert not any(path.startswith("/scanner") for path in instrumentation.route_summary())
+
+
+def test_repeated_statement_warns(test_family, test_student, monkeypatch, caplog):
+    monkeypatch.setattr(instrumentation, "REPEAT_THRESHOLD", 0)
+    with caplog.at_level(logging.WARNING, logger="app.instrumentation"):
+        client.get("/family/student")
+    assert any("ran the same statement 1 times" in record.getMessage() for record in caplog.records)
+
+
+def test_statement_shape_collapses_in_lists():
+    assert (instrumentation.statement_shape("SELECT a FROM t\n WHERE id IN (?, ?, ?)")
+            == instrumentation.statement_shape("SELECT a FROM t WHERE id IN (?, ?)")
+            == "SELECT a FROM t WHERE id IN (?...)")
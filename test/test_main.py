@@ -8,11 +8,48 @@ Description: Unit tests for main.py
 
 from fastapi.testclient import TestClient
 from app.main import app
+from app import main
 from fastapi import status
+import asyncio
 
 client = TestClient(app)
 
 def test_return_health_check():
     response = client.get("/healthy")
     assert response.status_code == status.HTTP_200_OK
-    assert response.json() == {'status': 'Healthy'}
\ No newline at end of file
+    assert response.json() == {'status': 'Healthy'}
+
+
+def test_startup_creates_schema_only_when_asked(monkeypatch):
+    calls = []
+
+    async def create_schema():
+        calls.append("create_schema")
+
+    monkeypatch.setattr(main, "create_schema", create_schema)
+    monkeypatch.delenv("CREATE_SCHEMA", raising=False)
+    with TestClient(app):
+        pass
+    assert calls == []
+
+    monkeypatch.setenv("CREATE_SCHEMA", "1")
+    with TestClient(app):
+        pass
+    assert calls == ["create_schema"]
+
+
+def test_hold_sweeper_runs_for_app_lifetime(monkeypatch):
+    events = []
+
+    async def run_hold_sweeper():
+        events.append("started")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            events.append("stopped")
+
+    monkeypatch.setattr(main.enrollment, "run_hold_sweeper", run_hold_sweeper)
+    monkeypatch.setenv("HOLD_SWEEP", "1")
+    with TestClient(app) as lifespan_client:
+        lifespan_client.get("/healthy")
+    assert events == ["started", "stopped"]
@@ -0,0 +1,89 @@
+"""
+Filename: test_metrics.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for metrics.py
+"""
+
+from .utils import *
+from app.routers.auth import get_db, get_current_family
+from app import metrics
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from fastapi import status
+import asyncio
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+
+def sample(text: str, line_start: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(line_start + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_latency_recorded_per_route_template(test_family, test_student):
+    key = 'http_request_duration_seconds_count{method="GET",route="/family/student/{student_id}/registration_history"}'
+    before = sample(client.get("/metrics").text, key)
+    client.get("/family/student/1/registration_history")
+    client.get("/family/student/1/registration_history")
+
+    response = client.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain")
+    assert sample(response.text, key) == before + 2
+    assert '# TYPE http_request_duration_seconds histogram' in response.text
+    assert 'route="/family/student/{student_id}/registration_history",le="+Inf"} ' in response.text
+
+
+def test_errors_counted_by_status(test_family):
+    key = 'http_request_errors_total{method="GET",route="<unmatched>",status="404"}'
+    before = sample(client.get("/metrics").text, key)
+    client.get("/no/such/page")
+    assert sample(client.get("/metrics").text, key) == before + 1
+
+
+def test_pool_and_cache_metrics_exposed(test_family):
+    client.get("/family/profile/view")
+    text = client.get("/metrics").text
+    assert '# TYPE db_pool_events_total counter' in text
+    assert 'db_pool_connections{engine="primary",state="checkedout"} 0' in text
+    assert 'cache_hit_ratio{cache="catalog"}' in text
+    assert 'cache_hits_total{cache="token"}' in text
+    assert sample(text, 'http_requests_in_flight') == 1
+
+
+def test_pool_timeout_counted_for_its_engine(tmp_path):
+    pool_engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=1, max_overflow=0, pool_timeout=0.01)
+    try:
+        with pool_engine.connect():
+            with pytest.raises(PoolTimeoutError), metrics.count_pool_timeouts("pool_test"):
+                pool_engine.connect()
+    finally:
+        pool_engine.dispose()
+    assert metrics.pool_events.values[("pool_test", "timeout")] == 1
+
+
+def test_session_dependency_counts_pool_timeouts():
+    async def run():
+        session = get_db()
+        await session.__anext__()
+        with pytest.raises(PoolTimeoutError):
+            await session.athrow(PoolTimeoutError("timed out"))
+
+    before = metrics.pool_events.values.get(("primary", "timeout"), 0)
+    asyncio.run(run())
+    assert metrics.pool_events.values[("primary", "timeout")] == before + 1
+
+
+def test_histogram_buckets_cumulative():
+    histogram = metrics.Histogram("test_seconds", "Test", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, "/x")
+    lines = histogram.render()
+    assert 'test_seconds_bucket{route="/x",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/x",le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{route="/x",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{route="/x"} 4' in lines
@@ -0,0 +1,111 @@
+"""
+Filename: test_migrate.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for migrate.py
+"""
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.migrate import migrate
+import asyncio
+import pytest
+
+# student_class and userinfo as the legacy PHP application created them
+LEGACY_SCHEMA = [
+    """CREATE TABLE student_class (sc_id INTEGER PRIMARY KEY, year INTEGER NOT NULL, student_id INTEGER NOT NULL,
+       class_id INTEGER NOT NULL, wait BOOLEAN NOT NULL, paid BOOLEAN NOT NULL, paid_price INTEGER,
+       created DATETIME NOT NULL, removed DATETIME NOT NULL)""",
+    """CREATE TABLE userinfo (id INTEGER PRIMARY KEY, first_name VARCHAR(100), last_name VARCHAR(100),
+       email VARCHAR(100) NOT NULL, profile_created BOOLEAN, token_ VARCHAR(100) NOT NULL)""",
+    """CREATE TABLE order_student_class (osc_id INTEGER PRIMARY KEY, order_id INTEGER, sc_id INTEGER)""",
+]
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = tmp_path / "legacy.db"
+    sync_engine = create_engine(f"sqlite:///{path}")
+    with sync_engine.begin() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(text(statement))
+    yield sync_engine, create_async_engine(f"sqlite+aiosqlite:///{path}")
+    sync_engine.dispose()
+
+
+def run_migrate(async_engine, apply=True):
+    async def run():
+        try:
+            return await migrate(async_engine, apply=apply)
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
+
+
+def test_creates_missing_tables(legacy_db):
+    sync_engine, async_engine = legacy_db
+    pending = run_migrate(async_engine, apply=False)
+    assert "create table class_seats" in pending
+    assert "class_seats" not in inspect(sync_engine).get_table_names()
+
+    assert "create table order_summary" in run_migrate(async_engine)
+    assert {"class_seats", "order_summary"} <= set(inspect(sync_engine).get_table_names())
+    # a second run finds nothing left to do
+    assert run_migrate(async_engine) == []
+
+
+def test_student_class_deduplicated_before_unique_key(legacy_db):
+    sync_engine, async_engine = legacy_db
+    with sync_engine.begin() as connection:
+        # sc 2 is on an order, sc 1 and 3 are copies of it, sc 4 is a different class
+        for sc_id, class_id, paid in ((1, 7, 0), (2, 7, 1), (3, 7, 0), (4, 8, 0)):
+            connection.execute(text(
+                "INSERT INTO student_class VALUES "
+                f"({sc_id}, 2026, 1, {class_id}, 0, {paid}, 0, '2026-01-01', '2026-01-01')"))
+        connection.execute(text("INSERT INTO order_student_class VALUES (1, 1, 2)"))
+
+    assert "student_class: remove 2 duplicate selections" in run_migrate(async_engine)
+    with sync_engine.connect() as connection:
+        assert [row[0] for row in connection.execute(text("SELECT sc_id FROM student_class ORDER BY sc_id"))] == [2, 4]
+        with pytest.raises(Exception):
+            connection.execute(text(
+                "INSERT INTO student_class VALUES (5, 2026, 1, 7, 0, 0, 0, '2026-01-01', '2026-01-01')"))
+
+
+def test_lookup_indexes_added_to_existing_tables(legacy_db):
+    sync_engine, async_engine = legacy_db
+    assert "create index ix_student_class_waitlist on student_class" in run_migrate(async_engine, apply=False)
+    run_migrate(async_engine)
+    indexes = {index["name"] for index in inspect(sync_engine).get_indexes("order_student_class")}
+    assert {"ix_order_student_class_order_id", "ix_order_student_class_sc_id"} <= indexes
+
+
+def test_userinfo_deduplicated_before_unique_email(legacy_db):
+    sync_engine, async_engine = legacy_db
+    with sync_engine.begin() as connection:
+        for user_id, email, profile_created in ((1, "a@e.com", 0), (2, "a@e.com", 1), (3, "b@e.com", 0)):
+            connection.execute(text(
+                f"INSERT INTO userinfo VALUES ({user_id}, '', '', '{email}', {profile_created}, 'token')"))
+
+    assert "userinfo: remove 1 duplicate logins" in run_migrate(async_engine)
+    with sync_engine.connect() as connection:
+        assert [row[0] for row in connection.execute(text("SELECT id FROM userinfo ORDER BY id"))] == [2, 3]
+    unique = {index["name"] for index in inspect(sync_engine).get_indexes("userinfo") if index["unique"]}
+    assert "ix_userinfo_email" in unique
+
+
+def test_order_summary_filled_for_existing_orders(legacy_db):
+    sync_engine, async_engine = legacy_db
+    run_migrate(async_engine)
+    with sync_engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO orders (order_id, year, family_id, created, amount, payment_method, transaction_id) "
+            "VALUES (1, 2025, 1, '2025-01-01', 10, 'card', '1')"))
+        connection.execute(text("INSERT INTO order_student_class VALUES (1, 1, 1), (2, 1, 2)"))
+
+    assert run_migrate(async_engine, apply=False) == ["order_summary: summarize 1 orders"]
+    run_migrate(async_engine)
+    with sync_engine.connect() as connection:
+        assert connection.execute(text("SELECT order_id, family_id, number_of_classes FROM order_summary")).all() == [(1, 1, 2)]
+    assert run_migrate(async_engine) == []
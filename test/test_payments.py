@@ -8,6 +8,11 @@ Description: Unit tests for payments.py
 
 from .utils import *
 from app.routers.auth import get_db, get_current_family
+from app.models import OrderSummary
+from app import order_summary, pricing
+from app.pricing import PricingRules
+from sqlalchemy import insert, update, delete, select
+import asyncio
 from fastapi import status
 
 app.dependency_overrides[get_db] = override_get_db
@@ -23,6 +28,20 @@ def test_view_cart(test_family, test_student, test_student_class_unpaid, test_cl
     assert any(item["class_id"] == 1 for item in data)
     assert any(item["title"] == "Level 1" for item in data)
 
+def test_view_cart_not_modified(test_family, test_student, test_student_class_unpaid, test_classes):
+    etag = client.get("/family/checkout").headers["ETag"]
+    response = client.get("/family/checkout", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    db = TestingSessionLocal()
+    db.query(Student).filter(Student.student_id == 1).update({Student.first_name: "Renamed", Student.modified: datetime.utcnow()})
+    db.commit()
+    db.close()
+    response = client.get("/family/checkout", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()[0]["first_name"] == "Renamed"
+
+
 def test_view_payments(test_family, test_order_paid, test_order_student_class):
     response = client.get("/family/payments")
     assert response.status_code == status.HTTP_200_OK
@@ -73,3 +92,182 @@ def test_view_order_classes_not_found(test_family):
     assert data[0].get("Price") == 0
 
 
+def seed_order(order_id: int, lines: int):
+    # every other line is a volunteer line, the rest are classes for different siblings
+    db = TestingSessionLocal()
+    db.add(Order(order_id = order_id, year = 2026, family_id = 1, created = now, paid = now, canceled = None,
+                 amount = 1.00, payment_method = "card", transaction_id = str(order_id)))
+    for line in range(lines):
+        sc_id = order_id * 100 + line
+        student_id = -sc_id if line % 2 == 1 else sc_id
+        db.add(StudentClass(sc_id = sc_id, year = 2026, student_id = student_id,
+                            class_id = 1, wait = False, paid = True, paid_price = 10, created = now, removed = now))
+        db.add(OrderStudentClass(osc_id = sc_id, order_id = order_id, sc_id = sc_id))
+        if student_id > 0:
+            db.add(Student(student_id = student_id, o_student_id = "", family_id = 1, first_name = "Student",
+                           last_name = str(line), chinese_name = "同学", dob = "01/01/2000", gender = "M", grade = "0",
+                           created = now, modified = now, status = 1, email = "", medical_cond = "", allergy = "",
+                           doctor_name = "", doctor_phone = "", ins_company = "", ins_policy = ""))
+    db.commit()
+    db.close()
+
+
+def test_view_order_classes_query_count_is_constant(test_family, test_voluneer_activity, test_volunteer_activity_year):
+    try:
+        seed_order(10, 2)
+        seed_order(20, 20)
+
+        with count_queries() as small:
+            small_response = client.get("/family/payments/view_order_classes/10")
+        with count_queries() as large:
+            large_response = client.get("/family/payments/view_order_classes/20")
+
+        assert len(small) == len(large) == 1
+
+        small_data = small_response.json()
+        assert small_data[1]["title"] == "Some Activity"
+        assert small_data[-1] == {"name": "Total", "Price": 20}
+
+        large_data = large_response.json()
+        assert large_data[-2] == {"name": "Sibling Discount", "paid_price": -135}
+        assert large_data[-1] == {"name": "Total", "Price": 200 - 135}
+    finally:
+        with engine.connect() as connection:
+            for table in ("orders", "order_summary", "order_student_class", "student_class", "students"):
+                connection.execute(text(f"DELETE FROM {table};"))
+            connection.commit()
+
+
+def test_order_summary_tracks_order_classes(test_family, test_order_paid):
+    db = TestingSessionLocal()
+    try:
+        summary = db.query(OrderSummary).filter(OrderSummary.order_id == test_order_paid.order_id).one()
+        assert summary.number_of_classes == 0
+
+        db.add_all([OrderStudentClass(order_id = test_order_paid.order_id, sc_id = sc_id) for sc_id in (1, 2, 3)])
+        db.commit()
+        db.refresh(summary)
+        assert summary.number_of_classes == 3
+
+        db.delete(db.query(OrderStudentClass).filter(OrderStudentClass.sc_id == 2).one())
+        db.commit()
+        db.refresh(summary)
+        assert summary.number_of_classes == 2
+
+        response = client.get("/family/payments")
+        assert response.json()[0]["number_of_classes"] == 2
+    finally:
+        db.close()
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM order_student_class;"))
+            connection.commit()
+
+
+def test_order_summary_backfill_and_check(test_family, test_order_paid, test_order_student_class):
+    async def run(command):
+        async with AsyncTestingSessionLocal() as db:
+            return await command(db)
+
+    with engine.connect() as connection:
+        connection.execute(text("UPDATE order_summary SET number_of_classes = 5;"))
+        connection.commit()
+    assert asyncio.run(run(order_summary.check)) == [{"order_id": 1, "number_of_classes": 1, "summary": 5}]
+
+    assert asyncio.run(run(order_summary.backfill)) == 1
+    assert asyncio.run(run(order_summary.check)) == []
+
+
+def test_order_summary_follows_moved_rows(test_family, test_order_paid):
+    db = TestingSessionLocal()
+    try:
+        other = Order(year = 2026, family_id = 1, created = now, paid = now, amount = 1.00,
+                      payment_method = "card", transaction_id = "7654321")
+        db.add(other)
+        db.add_all([OrderStudentClass(order_id = test_order_paid.order_id, sc_id = sc_id) for sc_id in (1, 2)])
+        db.commit()
+
+        moved = db.query(OrderStudentClass).filter(OrderStudentClass.sc_id == 2).one()
+        db.expire(moved)
+        moved.order_id = other.order_id
+        db.commit()
+        counts = dict(db.query(OrderSummary.order_id, OrderSummary.number_of_classes).all())
+        assert counts == {test_order_paid.order_id: 1, other.order_id: 1}
+    finally:
+        db.close()
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM order_student_class;"))
+            connection.commit()
+
+
+def test_order_summary_follows_statements(test_family, test_order_paid):
+    order_id = test_order_paid.order_id
+
+    async def run():
+        async with AsyncTestingSessionLocal() as db:
+            await db.execute(insert(OrderStudentClass), [{"order_id": order_id, "sc_id": sc_id} for sc_id in (1, 2, 3)])
+            await db.execute(insert(OrderStudentClass).values(order_id = order_id, sc_id = 4))
+            await db.commit()
+            counts = [await db.scalar(select(OrderSummary.number_of_classes))]
+
+            await db.execute(update(OrderStudentClass).filter(OrderStudentClass.sc_id <= 2).values(order_id = 99))
+            await db.execute(delete(OrderStudentClass).filter(OrderStudentClass.sc_id == 3))
+            await db.commit()
+            counts.append(await db.scalar(select(OrderSummary.number_of_classes)))
+            return counts
+
+    try:
+        # the rows moved to order 99 have no order to summarize
+        assert asyncio.run(run()) == [4, 1]
+    finally:
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM order_student_class;"))
+            connection.commit()
+
+
+def test_view_payments_without_summary(test_family, test_order_paid, test_order_student_class):
+    with engine.connect() as connection:
+        connection.execute(text("DELETE FROM order_summary;"))
+        connection.commit()
+    assert client.get("/family/payments").json()[0]["number_of_classes"] == 1
+
+
+def test_view_cart_total(test_family, test_student, test_student_class_unpaid, test_classes, monkeypatch):
+    monkeypatch.setattr(pricing, "pricing_rules", PricingRules({"prices": {"LC": 400}, "volunteer_buyout": 100}))
+    pricing.pricing_cache.clear()
+
+    with count_queries() as first:
+        response = client.get("/family/checkout/total")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        "lines": [{"student_id": 1, "category": "LC", "classes": 1, "unit_price": 400, "amount": 400}],
+        "subtotal": 400,
+        "adjustments": [{"name": "Volunteer Buy-out", "amount": 100}],
+        "total": 500,
+    }
+
+    # same cart version, the quote comes from the cache and only the version is queried
+    with count_queries() as second:
+        assert client.get("/family/checkout/total").json()["total"] == 500
+    assert len(first) == 2 and len(second) == 1
+
+    response = client.get("/family/checkout/total", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+
+def test_view_cart_total_without_prices(test_family, monkeypatch):
+    monkeypatch.setattr(pricing, "pricing_rules", PricingRules({}))
+    response = client.get("/family/checkout/total")
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+def test_order_receipt_not_repriced(test_family, monkeypatch):
+    monkeypatch.setattr(pricing, "pricing_rules", PricingRules({"prices": {"LC": 400}, "sibling_discount": 50}))
+    try:
+        seed_order(20, 20)
+        data = client.get("/family/payments/view_order_classes/20").json()
+        assert data[-2] == {"name": "Sibling Discount", "paid_price": -135}
+    finally:
+        with engine.connect() as connection:
+            for table in ("orders", "order_summary", "order_student_class", "student_class", "students"):
+                connection.execute(text(f"DELETE FROM {table};"))
+            connection.commit()
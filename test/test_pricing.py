@@ -0,0 +1,58 @@
+"""
+Filename: test_pricing.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for pricing.py
+"""
+
+from datetime import date
+from app.pricing import PricingRules
+
+RULES = {
+    "prices": {"LC": 400, "BOOK": 30},
+    "default_price": 50,
+    "sibling_discount": 15,
+    "early_bird": {"until": "2026-06-01", "per_class": 20},
+    "volunteer_buyout": 100,
+}
+CART = [(1, "LC", 1), (1, "BOOK", 2), (2, "LC", 1), (3, "CSL", 1)]
+
+
+def test_every_rule_applied():
+    quote = PricingRules(RULES).price(CART, volunteered = False, today = date(2026, 5, 1))
+    assert [line["amount"] for line in quote["lines"]] == [400, 60, 400, 50]
+    assert quote["subtotal"] == 910
+    assert quote["adjustments"] == [
+        {"name": "Sibling Discount", "amount": -30},
+        {"name": "Early Bird Discount", "amount": -100},
+        {"name": "Volunteer Buy-out", "amount": 100},
+    ]
+    assert quote["total"] == 880
+
+
+def test_rules_that_do_not_apply_are_left_out():
+    quote = PricingRules(RULES).price(CART[:2], volunteered = True, today = date(2026, 6, 2))
+    assert quote["adjustments"] == []
+    assert quote["total"] == 460
+
+
+def test_defaults_keep_legacy_sibling_discount():
+    rules = PricingRules({})
+    assert rules.sibling_discount(1) == 0
+    assert rules.sibling_discount(3) == -30
+    assert PricingRules({}).price([], volunteered = False, today = date(2026, 1, 1))["total"] == 0
+    assert rules.fingerprint != PricingRules(RULES).fingerprint
+
+
+def test_total_never_below_zero():
+    rules = PricingRules({"prices": {"LC": 10}, "early_bird": {"until": "2026-06-01", "per_class": 20}})
+    quote = rules.price([(1, "LC", 2), (2, "LC", 1)], volunteered = True, today = date(2026, 5, 1))
+    assert quote["subtotal"] == 30
+    assert quote["total"] == 0
+
+
+def test_no_prices_not_configured():
+    assert not PricingRules({}).configured
+    assert PricingRules({"default_price": 100}).configured
+    assert PricingRules(RULES).configured
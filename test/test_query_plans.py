@@ -0,0 +1,99 @@
+"""
+Filename: test_query_plans.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Query plan regression tests. Runs every router against a seeded database, captures the
+             SQL it sends and fails if sqlite would answer any of it with a full scan of a hot table
+"""
+
+from .utils import *
+from app.routers.auth import get_db, get_current_family
+from app.models import UserInfo
+from sqlalchemy import select
+import re
+
+app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_current_family] = override_get_current_family
+
+HOT_TABLES = {"families", "family_year", "students", "student_class", "orders", "order_student_class",
+              "order_summary", "userinfo", "class_seats"}
+
+# every router endpoint that reads or writes the database, admin dumps read whole tables on purpose
+ENDPOINTS = [
+    ("post", "/token", {"data": {"username": "test1@e.com", "password": "1234"}}),
+    ("get", "/family/profile/view", {}),
+    ("get", "/family/profile/volunteer", {}),
+    ("post", "/family/profile/create", {"json": {"email": "new@e.com", "password": "1", "check_password": "1"}}),
+    ("get", "/family/student", {}),
+    ("get", "/family/student/1/registration_history", {}),
+    ("get", "/student/1/read_current_LC_classes", {}),
+    ("get", "/student/1/read_current_EP_classes", {}),
+    ("post", "/student/1/select_classes", {"json": {"class_id": 2}}),
+    ("put", "/student/cart", {"json": {"students": [{"student_id": 1, "class_ids": [1, 3]}]}}),
+    ("get", "/family/checkout", {}),
+    ("get", "/family/payments", {}),
+    ("get", "/family/payments/view_order_details/1", {}),
+    ("get", "/family/payments/view_order_classes/1", {}),
+]
+
+STUDENT_REQUEST = {
+    "first_name": "Student", "last_name": "Test", "chinese_name": "同学", "dob": "01/01/2000", "gender": "M",
+    "grade": "0", "email": "test@e.com", "medical_cond": "", "allergy": "", "doctor_name": "Example",
+    "doctor_phone": "Example", "ins_company": "Example", "ins_policy": "Example",
+}
+
+
+def full_scans(statement: str, parameters) -> list:
+    with engine.connect() as connection:
+        plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    scans = []
+    for row in plan:
+        match = re.match(r"SCAN (\w+)", row[3])
+        if match and match.group(1) in HOT_TABLES:
+            scans.append(row[3])
+    return scans
+
+
+def capture_statements(requests) -> list:
+    captured = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and not statement.lstrip().upper().startswith(("INSERT INTO", "BEGIN", "COMMIT", "ROLLBACK")):
+            captured.append((statement, parameters))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        for method, url, kwargs in requests:
+            response = getattr(client, method)(url, **kwargs)
+            assert response.status_code < 500, (url, response.text)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    return captured
+
+
+def test_router_queries_use_indexes(test_family, test_family_year, test_student, test_classes, test_current_classes_1,
+                                    test_student_class_paid, test_order_paid, test_order_student_class,
+                                    test_voluneer_activity, test_volunteer_activity_year):
+    try:
+        captured = capture_statements(ENDPOINTS + [
+            ("post", "/family/student/add", {"json": STUDENT_REQUEST}),
+            ("put", "/family/student/1", {"json": STUDENT_REQUEST}),
+        ])
+    finally:
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM families WHERE family_id != 1;"))
+            connection.execute(text("DELETE FROM students WHERE student_id != 1;"))
+            connection.commit()
+
+    assert len(captured) > len(ENDPOINTS)
+    scans = {statement: full_scans(statement, parameters) for statement, parameters in captured}
+    assert {statement: plan for statement, plan in scans.items() if plan} == {}
+
+
+def test_login_and_oauth_lookups_use_indexes():
+    for statement in (select(Family).filter(Family.email == "test1@e.com"),
+                      select(UserInfo).filter(UserInfo.email == "test1@e.com")):
+        compiled = statement.compile(engine)
+        parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+        assert full_scans(str(compiled), parameters) == []
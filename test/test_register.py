@@ -8,7 +8,11 @@ Description: Unit tests for register.py
 
 from .utils import *
 from app.routers.auth import get_db, get_current_family
+from app.models import ClassSeats
+from app.catalog import CatalogCache
+from sqlalchemy import update
 from fastapi import status
+import asyncio
 
 app.dependency_overrides[get_db] = override_get_db
 app.dependency_overrides[get_current_family] = override_get_current_family
@@ -39,3 +43,114 @@ def test_select_classes(test_family, test_student):
     assert model.student_id == 1
     assert model.class_id == int(request_data.get('class_id'))
 
+    response = client.post("/student/1/select_classes", json=request_data)
+    assert response.status_code == 409
+    db.close()
+    with engine.connect() as connection:
+        connection.execute(text("DELETE FROM student_class;"))
+        connection.commit()
+
+
+def test_read_classes_uses_cached_catalog(test_admin, test_student, test_student_class_unpaid, test_current_classes_1):
+    misses = catalog_cache.misses
+    first = client.get("/student/1/read_current_LC_classes").json()
+    second = client.get("/student/1/read_current_LC_classes").json()
+    assert first == second
+    assert catalog_cache.misses == misses + 1
+    assert first[0]["title"] == "Level 1"
+    assert first[0]["class_selected"] >= 1
+
+    db = TestingSessionLocal()
+    db.query(CurrentClasses).filter(CurrentClasses.class_id == 1).update({CurrentClasses.title: "Level 1A"})
+    db.commit()
+    db.close()
+    assert client.get("/student/1/read_current_LC_classes").json()[0]["title"] == "Level 1"
+
+    response = client.post("/admin/catalog/invalidate")
+    assert response.status_code == status.HTTP_200_OK
+    assert client.get("/student/1/read_current_LC_classes").json()[0]["title"] == "Level 1A"
+
+
+def test_read_classes_not_modified(test_admin, test_student, test_classes, test_student_class_unpaid, test_current_classes_1):
+    first = client.get("/student/1/read_current_LC_classes")
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    again = client.get("/student/1/read_current_LC_classes", headers={"If-None-Match": etag})
+    assert again.status_code == status.HTTP_304_NOT_MODIFIED
+    assert again.content == b""
+    assert again.headers["ETag"] == etag
+
+    client.post("/student/1/select_classes", json={"class_id": 2})
+    changed = client.get("/student/1/read_current_LC_classes", headers={"If-None-Match": etag})
+    assert changed.status_code == status.HTTP_200_OK
+    assert changed.headers["ETag"] != etag
+
+    client.post("/admin/catalog/invalidate")
+    assert client.get("/student/1/read_current_LC_classes").headers["ETag"] == changed.headers["ETag"]
+
+
+def test_catalog_invalidate_needs_admin(test_family):
+    assert client.post("/admin/catalog/invalidate").status_code == status.HTTP_403_FORBIDDEN
+
+
+def test_catalog_invalidated_in_other_workers(test_current_classes_1):
+    # two caches stand in for two workers, the admin call lands on the first
+    first, second = CatalogCache(version_ttl=0), CatalogCache(version_ttl=0)
+
+    async def run():
+        async with AsyncTestingSessionLocal() as db:
+            await first.get(db, now.year, ["LC"])
+            await second.get(db, now.year, ["LC"])
+            await db.execute(update(CurrentClasses).filter(CurrentClasses.class_id == 1).values(title="Level 1A"))
+            await first.bump(db)
+            return (await second.get(db, now.year, ["LC"]))[0]["title"]
+
+    try:
+        assert asyncio.run(run()) == "Level 1A"
+        assert second.shared_version == first.shared_version
+    finally:
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM cache_version;"))
+            connection.commit()
+
+
+def test_sync_cart(test_family, test_student, test_classes):
+    response = client.put("/student/cart", json={'students': [{'student_id': 1, 'class_ids': [1, 2]}]})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'added': [{'student_id': 1, 'class_id': 1, 'wait': False},
+                                         {'student_id': 1, 'class_id': 2, 'wait': False}],
+                               'removed': []}
+
+    response = client.put("/student/cart", json={'students': [{'student_id': 1, 'class_ids': [2, 3]}]})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'added': [{'student_id': 1, 'class_id': 3, 'wait': False}],
+                               'removed': [{'student_id': 1, 'class_id': 1}]}
+
+    db = TestingSessionLocal()
+    try:
+        rows = db.query(StudentClass.class_id).filter(StudentClass.student_id == 1).order_by(StudentClass.class_id).all()
+        assert [row.class_id for row in rows] == [2, 3]
+        # the seat in class 1 was given back
+        assert db.query(ClassSeats).filter(ClassSeats.class_id == 1).one().taken == 0
+    finally:
+        db.close()
+        with engine.connect() as connection:
+            connection.execute(text("DELETE FROM student_class;"))
+            connection.commit()
+
+
+def test_sync_cart_other_family_student(test_family, test_student):
+    response = client.put("/student/cart", json={'students': [{'student_id': 99, 'class_ids': [1]}]})
+    assert response.status_code == 404
+
+
+def test_sync_cart_checks_claims_before_querying(test_family, test_student):
+    app.dependency_overrides[get_current_family] = lambda: {'email': 'test1@e.com', 'family_id': 1, 'student_ids': [1]}
+    try:
+        with count_queries() as statements:
+            response = client.put("/student/cart", json={'students': [{'student_id': 2, 'class_ids': [1]}]})
+        assert response.status_code == 404
+        assert statements == []
+    finally:
+        app.dependency_overrides[get_current_family] = override_get_current_family
@@ -0,0 +1,96 @@
+"""
+Filename: test_seats.py
+Author: Meghan Dang
+Date: 2025-01-16
+Version: 1.0
+Description: Unit tests for seats.py
+"""
+
+from .utils import *
+from app import seats
+from app.seats import SeatHub, seat_events
+from app.enrollment import reserve_seat, set_capacity
+from app.models import ClassSeats
+import asyncio
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    hub = SeatHub(session_factory=AsyncTestingSessionLocal, interval=0)
+    monkeypatch.setattr(seats, "seat_hub", hub)
+    return hub
+
+
+def test_committed_enrollment_pushed(test_classes, test_current_classes_1, hub):
+    async def run():
+        async with AsyncTestingSessionLocal() as db:
+            events = seat_events(hub, db, now.year)
+            snapshot = await events.__anext__()
+
+            async with AsyncTestingSessionLocal() as write_db:
+                assert await reserve_seat(write_db, now.year, 1)
+                await write_db.commit()
+            change = await asyncio.wait_for(events.__anext__(), 1)
+            await events.aclose()
+        return snapshot, change
+
+    snapshot, change = asyncio.run(run())
+    assert b"event: snapshot" in snapshot and b'{"1":1}' in snapshot
+    assert b"event: seats" in change and b'{"1":0}' in change
+    assert not hub.subscribers and hub.seats is None
+
+
+def test_rolled_back_enrollment_not_published(test_classes, test_current_classes_1, hub):
+    async def run():
+        async with AsyncTestingSessionLocal() as db:
+            await hub.load(db, now.year)
+        queue = hub.subscribe()
+        async with AsyncTestingSessionLocal() as write_db:
+            await reserve_seat(write_db, now.year, 1)
+            await write_db.rollback()
+        await asyncio.sleep(0.01)
+        return queue
+
+    assert asyncio.run(run()).empty()
+
+
+def test_slow_subscriber_resynced(test_classes, test_current_classes_1, hub, monkeypatch):
+    monkeypatch.setattr(seats, "SEAT_PUSH_QUEUE", 1)
+
+    async def run():
+        async with AsyncTestingSessionLocal() as db:
+            await hub.load(db, now.year)
+            queue = hub.subscribe()
+            await reserve_seat(db, now.year, 1)
+            await db.commit()
+            await asyncio.sleep(0.01)
+            # the first change is still queued when the second goes out
+            await set_capacity(db, now.year, 1, 5)
+            await asyncio.sleep(0.01)
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    messages = asyncio.run(run())
+    assert len(messages) == 1
+    assert b"event: snapshot" in messages[0] and b'{"1":4}' in messages[0]
+
+
+def test_changes_from_other_workers_resynced(test_classes, test_current_classes_1, monkeypatch):
+    hub = SeatHub(session_factory=AsyncTestingSessionLocal, interval=0, resync_interval=0.01)
+    monkeypatch.setattr(seats, "seat_hub", hub)
+
+    async def run():
+        async with AsyncTestingSessionLocal() as db:
+            await hub.load(db, now.year)
+        queue = hub.subscribe()
+        # a seat taken by another worker or the CLI, nothing is published in this process
+        with TestingSessionLocal() as db:
+            db.add(ClassSeats(year=now.year, class_id=1, seats_x=1, taken=1))
+            db.commit()
+        try:
+            return await asyncio.wait_for(queue.get(), 1)
+        finally:
+            hub.unsubscribe(queue)
+
+    message = asyncio.run(run())
+    assert b"event: seats" in message and b'{"1":0}' in message
+    assert hub._resync_task is None
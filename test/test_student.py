@@ -10,6 +10,7 @@ from .utils import *
 from app.routers.auth import get_db, get_current_family
 from fastapi import status
 from datetime import date
+import asyncio
 
 app.dependency_overrides[get_db] = override_get_db
 app.dependency_overrides[get_current_family] = override_get_current_family
@@ -48,6 +49,9 @@ def test_create_child(test_family, test_student):
                     
     response = client.post("/family/student/add", json=request_data)
     assert response.status_code == 201
+    assert response.json()['student_id'] == 2
+    claims = asyncio.run(get_current_family(response.json()['access_token']))
+    assert claims['student_ids'] == [1, 2]
 
     db = TestingSessionLocal()
     try:
@@ -99,4 +103,51 @@ def test_view_student_history(test_family, test_student, test_classes, test_stud
     row = data[0]
     assert row["class_code"] == "1" 
     assert row["title"] == "Level 1"
-    assert row["chinese_title"] == "东西" 
\ No newline at end of file
+    assert row["chinese_title"] == "东西" 
+
+
+def test_student_history_not_modified(test_family, test_student, test_classes, test_student_class_paid):
+    etag = client.get("/family/student/1/registration_history").headers["ETag"]
+    response = client.get("/family/student/1/registration_history", headers={"If-None-Match": f'"x", {etag}'})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    response = client.get("/family/student/1/registration_history", headers={"If-None-Match": '"x"'})
+    assert response.status_code == status.HTTP_200_OK
+
+
+def test_student_history_not_modified_skips_history_query(test_family, test_student, test_classes, test_student_class_paid):
+    app.dependency_overrides[get_current_family] = lambda: {'email': 'test1@e.com', 'family_id': 1, 'student_ids': [1]}
+    try:
+        etag = client.get("/family/student/1/registration_history").headers["ETag"]
+        with count_queries() as statements:
+            response = client.get("/family/student/1/registration_history", headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert len(statements) == 1 and "count(" in statements[0].lower()
+        assert "chinese_title" not in statements[0]
+
+        # a paid class added changes the version
+        db = TestingSessionLocal()
+        db.add(StudentClass(year = 2025, student_id = 1, class_id = 1, wait = False, paid = True, paid_price = 10,
+                            created = now, removed = now))
+        db.commit()
+        db.close()
+        response = client.get("/family/student/1/registration_history", headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.json()) == 2
+    finally:
+        app.dependency_overrides[get_current_family] = override_get_current_family
+
+
+def test_student_claims_skip_ownership_query(test_family, test_student, test_classes, test_student_class_paid):
+    app.dependency_overrides[get_current_family] = lambda: {'email': 'test1@e.com', 'family_id': 1, 'student_ids': [1]}
+    try:
+        with count_queries() as statements:
+            response = client.get("/family/student/1/registration_history")
+        assert response.status_code == status.HTTP_200_OK
+        assert len(statements) == 1
+
+        with count_queries() as statements:
+            response = client.get("/family/student/2/registration_history")
+        assert response.status_code == 401
+        assert statements == []
+    finally:
+        app.dependency_overrides[get_current_family] = override_get_current_family
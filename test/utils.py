@@ -6,35 +6,72 @@ Version: 1.0
 Description: Utilities for unit testing. Overriding functions and creating testing models
 """
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import StaticPool
+import os
+import tempfile
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from app.database import Base
 from app.main import app
 from fastapi.testclient import TestClient
 from datetime import datetime
 import pytest
+from app.catalog import catalog_cache
+from app.routers.auth import get_read_db
+from app import admission
 from app.models import Classes, CurrentClasses, Family, FamilyYear, Student, StudentClass, Order, OrderStudentClass, VolunteerActivities, VolunteerActivityYear
 
-SQLALCHEMY_DATABASE_URL = "sqlite://"
+# The app talks to the database through an async engine while the fixtures below
+# seed it synchronously, so both engines share one sqlite file
+TEST_DATABASE_PATH = os.path.join(tempfile.gettempdir(), "family_register_test.db")
+if os.path.exists(TEST_DATABASE_PATH):
+    os.remove(TEST_DATABASE_PATH)
+
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DATABASE_PATH}"
+ASYNC_SQLALCHEMY_DATABASE_URL = f"sqlite+aiosqlite:///{TEST_DATABASE_PATH}"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    poolclass = StaticPool,
+)
+
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
 )
 
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncTestingSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base.metadata.create_all(bind=engine)
 
 
-def override_get_db():
-    db = TestingSessionLocal()
-    try:
+async def override_get_db():
+    async with AsyncTestingSessionLocal() as db:
         yield db
+
+
+# No replica under test, read-only handlers share the primary test database
+app.dependency_overrides[get_read_db] = override_get_db
+
+# Every test request comes from family 1, give it a request budget no test reaches
+admission.set_backend(admission.InMemoryAdmissionBackend(family_rate=1000, family_burst=10000, max_concurrent=25))
+
+
+@contextmanager
+def count_queries():
+    """Collects every statement the app sends to the test database while the block runs"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
     finally:
-        db.close()
+        event.remove(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
 
 def override_get_current_family():
     return {'email': 'test1@e.com', 'family_id': 1}
@@ -66,6 +103,7 @@ def test_classes():
     yield test_class
     with engine.connect() as connection:
         connection.execute(text("DELETE FROM classes;"))
+        connection.execute(text("DELETE FROM class_seats;"))
         connection.commit()
 
 
@@ -85,10 +123,12 @@ def test_current_classes_1():
     db = TestingSessionLocal()
     db.add(test_class_1)
     db.commit()
+    catalog_cache.invalidate()
     yield test_class_1
     with engine.connect() as connection:
         connection.execute(text("DELETE FROM current_classes;"))
         connection.commit()
+    catalog_cache.invalidate()
 
 
 @pytest.fixture
@@ -107,10 +147,12 @@ def test_current_classes_2():
     db = TestingSessionLocal()
     db.add(test_class_2)
     db.commit()
+    catalog_cache.invalidate()
     yield test_class_2
     with engine.connect() as connection:
         connection.execute(text("DELETE FROM current_classes;"))
         connection.commit()
+    catalog_cache.invalidate()
 
 
 
@@ -170,6 +212,15 @@ def test_family():
         connection.commit()
 
 
+@pytest.fixture
+def test_admin(test_family):
+    db = TestingSessionLocal()
+    db.query(Family).filter(Family.family_id == 1).update({Family.level: True})
+    db.commit()
+    db.close()
+    yield test_family
+
+
 @pytest.fixture
 def test_family_year():
     test_fam_year = FamilyYear(
@@ -280,6 +331,7 @@ def test_order():
     yield order
     with engine.connect() as connection:
         connection.execute(text("DELETE FROM orders;"))
+        connection.execute(text("DELETE FROM order_summary;"))
         connection.commit()
 
 
@@ -302,6 +354,7 @@ def test_order_paid():
     yield order
     with engine.connect() as connection:
         connection.execute(text("DELETE FROM orders;"))
+        connection.execute(text("DELETE FROM order_summary;"))
         connection.commit()
 
 